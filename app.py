@@ -1,197 +1,368 @@
-from flask import Flask, jsonify, request
-from flask_cors import CORS
-
-from database import DataBase
-from task import Task
-from run import start_scraper
-
-from multiprocessing import Pool
-import json
-import pandas as pd
-import os
-
-
-app = Flask(__name__)
-CORS(app)
-
-web_app_url = os.environ.get('WEB_APP_URL')
-app.config["CORS_ORIGINS"] = []
-
-
-db = DataBase()
-
-
-@app.route('/', methods=['GET'])
-def index():
-    return jsonify({"message": "Welcome to the API"}), 200
-
-
-@app.route('/task/', methods=['POST'])
-def create_task():
-    session_id = request.json.get('sessionId')
-    if not session_id:
-        return jsonify({"error": "Session ID not found"}), 404
-
-    db.delete_task(session_id)
-    key = db.create_task(session_id)
-
-    pool = Pool(1)
-    pool.apply_async(start_scraper, args=(session_id,))
-
-    db.update_task_status(session_id, Task.STARTED)
-
-    return jsonify({'task_id': session_id, "key": key}), 202
-
-
-@app.route('/task/<task_id>', methods=['GET'])
-def get_task_status(task_id):
-    # task = long_running_task.AsyncResult(task_id)
-    response = {'status': task.status}
-    if task.status == 'SUCCESS':
-        response['result'] = task.result
-    return jsonify(response)
-
-
-@app.route('/demo', methods=['GET'])
-def get_demo_data():
-    with open("demo.json", "r") as f:
-        data = json.load(f)
-
-    return jsonify({
-        "status": Task.SUCCESS,
-        "data": data,
-        "message": "Task completed successfully",
-        "taskCompleted": True
-    }), 200
-
-
-@app.route("/taskdata/<task_id>", methods=["GET"])
-def get_task_data(task_id):
-    task = db.get_task(task_id)
-    # getting key from request
-    key = request.args.get("key", type=str)
-    if not task or not key:
-        return jsonify({"error": "Task or Key not found"}), 404
-    
-    # checking if key is valid
-    if key != task.key:
-        return jsonify({"error": "Invalid key"}), 403
-
-    if task.status in [Task.STARTED, Task.IN_PROGRESS, Task.PENDING]:
-        return jsonify({
-            "status": task.status,
-            "message": "Task is in progress",
-            }), 200
-
-    if task.status == Task.FAILED:
-        return jsonify({
-            "error": "Task failed.",
-            "status": task.status,
-            "message": task.message
-            }), 200
-
-    score_data = task.course_score
-    score_data = [i.to_dict() for i in score_data]
-    if not score_data:
-        return jsonify({
-            "status": "ERROR",
-            "error": "An unknown error occurred.",
-            "message": "Please resubmit Session ID",
-            "taskCompleted": False
-        }), 200
-
-    response = prepare_response(task)
-
-    return jsonify({
-        "status": task.status,
-        "data": response,
-        "message": "Task completed successfully",
-        "taskCompleted": True
-    }), 200
-
-
-def prepare_response(task):
-    profile_data = task.student_profile.to_dict()
-    score_data = task.course_score
-    score_data = [i.to_dict() for i in score_data]
-    # sorting by class time
-    attendace_data = sorted(task.attendance, key=lambda x: x.start_time)
-    attendance_data = [i.to_dict() for i in attendace_data]
-
-    attendance_df = pd.DataFrame(attendance_data)
-    
-    course_score_df = pd.DataFrame(score_data)
-    to_int_cols = ["marks", "total_marks"]
-    for col in to_int_cols:
-        course_score_df[col] = course_score_df[col].apply(float)
-    course_ids = course_score_df["course_id"].unique().tolist()
-
-    response = {
-        "profileData": profile_data,
-        "courseIds": course_ids,
-        "columns": ["section_title", "title", "marks", "total_marks", "datetime"],
-        "courseInfoColumns": ["course_id", "course_name", "credit_hours", "teacher"],
-        "columnsTitles": {
-            "course_id": "Course ID",
-            "course_name": "Course Name",
-            "credit_hours": "Credit Hours",
-            "teacher": "Teacher",
-            "section_title": "Section",
-            "title": "Title",
-            "marks": "Marks",
-            "total_marks": "Total Marks",
-            "datetime": "Date"
-        },
-        "coursesData": {}
-    }
-
-    for course_id, course_df in course_score_df.groupby("course_id"):
-        attendance_obj = {"attendanceData": []}
-        if course_id not in response["coursesData"]:
-            response["coursesData"][course_id] = {
-                "courseScore": {},
-            }
-
-        course_attendance_df = attendance_df[attendance_df["course_id"] == course_id]
-        attendance_obj['overview'] = {
-            "total": course_attendance_df.shape[0],
-            "present": course_attendance_df[course_attendance_df['attended'] == True].shape[0],
-            "absent": course_attendance_df[course_attendance_df['attended'] == False].shape[0],
-        }
-        for attendance_type, attendance_type_df in course_attendance_df.groupby("attendance_type"):
-            attendance_obj["attendanceData"].append({
-                "attendanceType": attendance_type,
-                "attendance": attendance_type_df.shape[0],
-                "total": attendance_type_df.shape[0],
-                "present": attendance_type_df[attendance_type_df['attended'] == True].shape[0],
-                "absent": attendance_type_df[attendance_type_df['attended'] == False].shape[0],
-                "attendance": attendance_type_df.to_dict(orient="records")
-            })
-
-        response["coursesData"][course_id]["attendance"] = attendance_obj
-
-        response["coursesData"][course_id]['overview'] = {
-            "totalMarks": course_df["total_marks"].sum(),
-            "marks": course_df["marks"].sum(),
-            "percentage": round(((course_df["marks"].sum() / course_df["total_marks"].sum()) * 100), 2)
-        }
-
-        for section_title, section_df in course_df.groupby('section_title'):
-            total_marks = section_df["total_marks"].sum()
-            marks = section_df["marks"].sum()
-            percentage = round(((marks / total_marks) * 100), 2)
-            section_data = section_df.to_dict(orient="records")
-            response["coursesData"][course_id]['courseScore'][section_title] = {
-                "totalMarks": total_marks,
-                "marks": marks,
-                "percentage": percentage,
-                "data": section_data
-            }
-
-    return response
-
-
-os.mkdir("Logs") if not os.path.exists("Logs") else None
-
-if __name__ == '__main__':
-    app.run()
+from flask import Flask, jsonify, request
+from flask_cors import CORS
+
+from database import DataBase, task_progress
+from task import Task
+from scrape_pool import ScrapePool, QueueFull, context as scrape_pool_context
+from response import task_response_body, response_body, compact_response
+from static_response import StaticResponse, compress_response
+import json_encoding
+from retention import RetentionSweeper
+from events import TaskEvents, NO_PROGRESS
+import metrics
+
+from datetime import datetime, timedelta
+import collections
+import threading
+import json
+import gzip
+import time
+import os
+
+
+app = Flask(__name__)
+app.json = json_encoding.JSONProvider(app)
+app.after_request(compress_response)
+CORS(app)
+
+web_app_url = os.environ.get('WEB_APP_URL')
+app.config["CORS_ORIGINS"] = []
+
+
+# longest a /taskdata long poll (?wait=) may block, and an event stream may stay open
+TASK_WAIT_MAX = int(os.environ.get("TASK_WAIT_MAX", 60))
+TASK_STREAM_MAX = int(os.environ.get("TASK_STREAM_MAX", 600))
+TASK_STREAM_KEEPALIVE = 15
+# seconds a cached status of a running task is served before the database
+# is read again, in case an event of its workers got lost
+TASK_STATUS_REFRESH = float(os.environ.get("TASK_STATUS_REFRESH", 5))
+FINISHED_STATUSES = [Task.SUCCESS, Task.FAILED]
+RUNNING_STATUSES = [Task.PENDING, Task.STARTED, Task.IN_PROGRESS]
+# a submission of a session that finished successfully this many seconds
+# ago gets that result instead of a new scrape (unless it asks for a refresh)
+RESULT_TTL = int(os.environ.get("RESULT_TTL", 300))
+# a running task not updated for this long is taken as dead and scraped again
+RUNNING_TASK_TIMEOUT = int(os.environ.get("RUNNING_TASK_TIMEOUT", 600))
+# a session scraped before keeps its data and key, its next scrape only
+# fetches again the course pages that changed (see PortalPipeline)
+INCREMENTAL_SCRAPE = os.environ.get("INCREMENTAL_SCRAPE", "1") == "1"
+
+DEMO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo.json")
+DEMO_MAX_AGE = int(os.environ.get("DEMO_MAX_AGE", 3600))
+# compact /taskdata bodies (?shape=compact) kept in memory, by stored response
+COMPACT_CACHE_SIZE = int(os.environ.get("COMPACT_CACHE_SIZE", 64))
+
+# submissions of the same session are handled one at a time
+submit_locks = [threading.Lock() for _ in range(64)]
+submissions = collections.Counter()
+compact_responses = collections.OrderedDict()
+compact_responses_lock = threading.Lock()
+
+# demo.json is read and compressed once, at startup
+with open(DEMO_FILE, "r") as f:
+    demo_response = StaticResponse(response_body(json.load(f)), max_age=DEMO_MAX_AGE)
+
+db = DataBase()
+task_events = TaskEvents()
+scrape_pool = ScrapePool()
+retention_sweeper = RetentionSweeper(db, task_events=task_events)
+started = False
+
+
+def start():
+    # the threads and queues of the API process, started by the entry points
+    # (wsgi.py, python app.py) and not on import: spawned scrape workers
+    # import the main module again
+    global started
+    if started:
+        return
+    started = True
+    scrape_pool.events = task_events.listen(scrape_pool_context)
+    task_events.follow(scrape_pool.dispatcher)
+    retention_sweeper.start()
+    metrics.start_writer()
+
+
+def server_busy_response():
+    retry_after = scrape_pool.retry_after()
+    return jsonify({
+        "error": "Server is busy, please try again later",
+        "retryAfter": retry_after
+    }), 503, {"Retry-After": str(retry_after)}
+
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    db.remove()
+
+
+@app.route('/', methods=['GET'])
+def index():
+    return jsonify({"message": "Welcome to the API"}), 200
+
+
+@app.route('/task/', methods=['POST'])
+def create_task():
+    session_id = request.json.get('sessionId')
+    if not session_id:
+        return jsonify({"error": "Session ID not found"}), 404
+
+    with submit_locks[hash(session_id) % len(submit_locks)]:
+        return submit_task(session_id, refresh=bool(request.json.get('refresh')))
+
+
+def submit_task(session_id, refresh=False):
+    # single flight: a session that is being scraped (or was just scraped)
+    # isn't scraped again, the caller gets the existing task
+    task = db.get_task(session_id)
+    if task is not None and task.updated_at is not None:
+        age = datetime.utcnow() - task.updated_at
+        if task.status in RUNNING_STATUSES and age < timedelta(seconds=RUNNING_TASK_TIMEOUT):
+            submissions["coalesced"] += 1
+            return jsonify({'task_id': session_id, "key": task.key, "status": task.status}), 202
+        if task.status == Task.SUCCESS and not refresh and age < timedelta(seconds=RESULT_TTL):
+            submissions["cached"] += 1
+            return jsonify({'task_id': session_id, "key": task.key, "status": task.status}), 202
+
+    # rejecting before the previous data of this session is deleted
+    if scrape_pool.is_full():
+        return server_busy_response()
+
+    # tasks stored without page fingerprints (before incremental re-scrapes,
+    # or by the legacy path) are scraped from scratch, their rows can't be
+    # diffed
+    if INCREMENTAL_SCRAPE and task is not None and db.has_course_pages(session_id):
+        submissions["rescraped"] += 1
+        key = task.key
+        db.update_progress(session_id, courses_total=None, courses_done=0, rows_ingested=0,
+                           pages_skipped=0, rows_skipped=0, commit=False)
+    else:
+        submissions["scraped"] += 1
+        db.delete_task(session_id)
+        key = db.create_task(session_id)
+    db.update_task_status(session_id, Task.STARTED)
+    task_events.publish(scrape_pool.dispatcher, session_id, Task.STARTED, progress=NO_PROGRESS)
+
+    try:
+        scrape_pool.submit(session_id)
+    except QueueFull:
+        db.update_task_status(session_id, Task.FAILED, "Server is busy, please try again later")
+        task_events.publish(scrape_pool.dispatcher, session_id, Task.FAILED,
+                            "Server is busy, please try again later")
+        return server_busy_response()
+
+    return jsonify({'task_id': session_id, "key": key}), 202
+
+
+@app.route('/task/<task_id>', methods=['GET'])
+def get_task_status(task_id):
+    # status, message and progress only, from the status cache the pipelines
+    # keep up to date; the database is read for tasks it doesn't know and
+    # every TASK_STATUS_REFRESH seconds for the ones still running
+    state = task_events.get(task_id)
+    if state is None or (state["status"] not in FINISHED_STATUSES
+                         and time.monotonic() - state["checked"] > TASK_STATUS_REFRESH):
+        row = db.get_task_status(task_id)
+        if row is None:
+            task_events.forget([task_id])
+            return jsonify({"error": "Task not found"}), 404
+        state = task_events.remember(task_id, row.status, row.message or "", task_progress(row),
+                                     version=state and state["version"])
+
+    return jsonify({
+        "taskId": task_id,
+        "status": state["status"],
+        "message": state["message"],
+        "progress": state["progress"],
+        **queue_wait(task_id, state["status"]),
+        "taskCompleted": state["status"] == Task.SUCCESS,
+    }), 200
+
+
+def queue_wait(task_id, status):
+    # where a task waiting for a crawl slot is in the queue, and about how
+    # long until its crawl starts; kept with its cached state for
+    # TASK_STATUS_REFRESH seconds, polls of queued tasks don't query the queue
+    estimate = None
+    if status == Task.STARTED:
+        cached = (task_events.get(task_id) or {}).get("queue_wait")
+        if cached is None or time.monotonic() - cached[0] > TASK_STATUS_REFRESH:
+            cached = (time.monotonic(), scrape_pool.wait_estimate(task_id))
+            task_events.annotate(task_id, queue_wait=cached)
+        estimate = cached[1]
+    return {
+        "queuePosition": estimate and estimate[0],
+        "estimatedWait": estimate and estimate[1],
+    }
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        **scrape_pool.stats(),
+        "submissions": dict(submissions),
+        "retention": retention_sweeper.stats,
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # prometheus text format, of this process and every scrape worker
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return app.response_class(metrics.collect(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/demo', methods=['GET'])
+def get_demo_data():
+    return demo_response.response()
+
+
+@app.route("/taskdata/<task_id>", methods=["GET"])
+def get_task_data(task_id):
+    task = db.get_task(task_id)
+    # getting key from request
+    key = request.args.get("key", type=str)
+    if not task or not key:
+        return jsonify({"error": "Task or Key not found"}), 404
+    
+    # checking if key is valid
+    if key != task.key:
+        return jsonify({"error": "Invalid key"}), 403
+
+    # long poll, answering once the task finished or the wait is over
+    wait = min(request.args.get("wait", 0, type=float), TASK_WAIT_MAX)
+    if wait > 0 and task.status not in FINISHED_STATUSES:
+        task = wait_for_task(task_id, wait)
+        if task is None:
+            # deleted while waiting
+            return jsonify({"error": "Task or Key not found"}), 404
+
+    if task.status in [Task.STARTED, Task.IN_PROGRESS, Task.PENDING]:
+        return jsonify({
+            "status": task.status,
+            "message": "Task is in progress",
+            "progress": task.progress(),
+            **queue_wait(task.task_id, task.status),
+            }), 200
+
+    if task.status == Task.FAILED:
+        return jsonify({
+            "error": "Task failed.",
+            "status": task.status,
+            "message": task.message
+            }), 200
+
+    if task.response_etag is None:
+        task_data = db.get_task_data(task.task_id)
+        if not task_data[1]:
+            return jsonify({
+                "status": "ERROR",
+                "error": "An unknown error occurred.",
+                "message": "Please resubmit Session ID",
+                "taskCompleted": False
+            }), 200
+        # tasks that finished before responses were stored with them
+        with metrics.span("response", task.task_id):
+            response = task_response_body(task_data)
+        db.update_task_status(task.task_id, task.status, task.message, response=response)
+
+    if request.args.get("shape") == "compact":
+        return compact_stored_response(task)
+    return stored_response(task)
+
+
+@app.route("/taskdata/<task_id>/events", methods=["GET"])
+def get_task_events(task_id):
+    task = db.get_task(task_id)
+    key = request.args.get("key", type=str)
+    if not task or not key:
+        return jsonify({"error": "Task or Key not found"}), 404
+    if key != task.key:
+        return jsonify({"error": "Invalid key"}), 403
+
+    state = task_events.get(task_id)
+    if state is None or state["status"] != task.status:
+        # the row wins over a cached state it doesn't agree with
+        state = task_events.remember(task_id, task.status, task.message or "", task.progress(),
+                                     version=state and state["version"])
+    db.remove()
+
+    def stream(state):
+        # a status event for every change, ending with SUCCESS or FAILED
+        # (the data itself is fetched from /taskdata)
+        deadline = time.monotonic() + TASK_STREAM_MAX
+        while True:
+            yield "event: status\ndata: %s\n\n" % json.dumps(
+                {"status": state["status"], "message": state["message"], "progress": state["progress"]})
+            if state["status"] in FINISHED_STATUSES:
+                return
+            version = state["version"]
+            while state is None or state["version"] <= version:
+                if time.monotonic() > deadline:
+                    return
+                state = task_events.wait(task_id, version, TASK_STREAM_KEEPALIVE)
+                if state is None or state["version"] <= version:
+                    yield ": keepalive\n\n"
+
+    return app.response_class(stream(state), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def wait_for_task(task_id, timeout):
+    # the db session is given back while waiting, the task is read again
+    # once it finished or the wait is over
+    db.remove()
+    deadline = time.monotonic() + timeout
+    state = task_events.get(task_id)
+    while state is None or state["status"] not in FINISHED_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        state = task_events.wait(task_id, state["version"] if state else 0, remaining)
+    return db.get_task(task_id)
+
+
+def stored_response(task):
+    # serving the response stored by the pipeline
+    return gzipped_response(task.response_etag, task.response_data)
+
+
+def compact_stored_response(task):
+    # the stored response in the compact shape, made once per stored response
+    with compact_responses_lock:
+        data = compact_responses.get(task.response_etag)
+        if data is not None:
+            compact_responses.move_to_end(task.response_etag)
+    if data is None:
+        body = json_encoding.loads(gzip.decompress(task.response_data))
+        body["data"] = compact_response(body["data"])
+        data = gzip.compress(json_encoding.dumps(body) + b"\n", 6)
+        with compact_responses_lock:
+            compact_responses[task.response_etag] = data
+            while len(compact_responses) > COMPACT_CACHE_SIZE:
+                compact_responses.popitem(last=False)
+    return gzipped_response(task.response_etag + "-compact", data)
+
+
+def gzipped_response(etag, data):
+    # a gzipped body, sent as it is when the client accepts gzip
+    gzipped = "gzip" in request.accept_encodings
+    etag = etag + ("-gzip" if gzipped else "")
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif gzipped:
+        response = app.response_class(data, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = app.response_class(gzip.decompress(data), mimetype="application/json")
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+os.mkdir("Logs") if not os.path.exists("Logs") else None
+
+if __name__ == '__main__':
+    start()
+    app.run()
@@ -0,0 +1,105 @@
+"""
+Tasks/sec of one CrawlerProcess per task (the old create_task model) against
+the long running CrawlerService used by ScrapePool, both crawling the local
+fake portal.
+
+    python benchmarks/bench_crawler_engine.py --tasks 40 --latency 0.02
+"""
+from common import workdir, print_table
+
+from multiprocessing import Process
+import argparse
+import sqlite3
+import time
+import os
+
+from fake_portal import FakePortal
+
+
+def finished_tasks():
+    try:
+        with sqlite3.connect("tasks_db____.db") as conn:
+            return conn.execute(
+                "SELECT count(*) FROM task WHERE status IN ('SUCCESS', 'FAILED')"
+            ).fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+def wait_for(n_tasks, timeout=600):
+    deadline = time.monotonic() + timeout
+    while finished_tasks() < n_tasks:
+        if time.monotonic() > deadline:
+            raise TimeoutError("only %d of %d tasks finished" % (finished_tasks(), n_tasks))
+        time.sleep(0.05)
+
+
+def process_per_task(n_tasks, concurrency):
+    from run import start_scraper
+
+    finished = finished_tasks()
+    started = time.monotonic()
+    running = []
+    for i in range(n_tasks):
+        while len(running) >= concurrency:
+            time.sleep(0.01)
+            running = [p for p in running if p.is_alive()]
+        process = Process(target=start_scraper, args=("process-%d" % i,))
+        process.start()
+        running.append(process)
+    for process in running:
+        process.join()
+    wait_for(finished + n_tasks)
+    return time.monotonic() - started
+
+
+def crawler_service(n_tasks, workers, crawls_per_worker):
+    from scrape_pool import ScrapePool
+
+    pool = ScrapePool(workers=workers, queue_size=n_tasks, crawls_per_worker=crawls_per_worker)
+    pool.start()
+    # reactor and scrapy startup happen here, once per worker
+    time.sleep(2)
+    finished = finished_tasks()
+    started = time.monotonic()
+    for i in range(n_tasks):
+        pool.submit("service-%d" % i)
+    wait_for(finished + n_tasks)
+    elapsed = time.monotonic() - started
+    pool.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--crawls", type=int, default=8, help="concurrent crawls per worker")
+    parser.add_argument("--latency", type=float, default=0.02, help="portal latency in seconds")
+    args = parser.parse_args()
+
+    portal = FakePortal(latency=args.latency).start()
+    os.environ["PORTAL_URL"] = portal.url
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    capacity = args.workers * args.crawls
+
+    from database import DataBase
+
+    rows = []
+    # one database for both runs, this process keeps its connections to the
+    # first file it opened
+    with workdir():
+        # creating the schema up front, concurrent create_all calls race
+        DataBase()
+        elapsed = process_per_task(args.tasks, capacity)
+        rows.append(["CrawlerProcess per task", capacity, "%.2f" % elapsed, "%.2f" % (args.tasks / elapsed)])
+        elapsed = crawler_service(args.tasks, args.workers, args.crawls)
+        rows.append(["CrawlerService", capacity, "%.2f" % elapsed, "%.2f" % (args.tasks / elapsed)])
+    portal.stop()
+
+    print("%d tasks, %.0f ms portal latency" % (args.tasks, args.latency * 1000))
+    print_table(rows, ["model", "concurrency", "seconds", "tasks/sec"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Date parsing at ingest, over the date strings of demo.json as the portal
+renders them (one marks date per row, a start and an end time per class):
+dateutil for every string, the fixed strptime formats the bulk insert path
+tried before, and database.DateParser, new for every task (cold) and kept
+for the life of the worker process (warm). Fails if a parser returns a
+different datetime than dateutil.
+
+    python benchmarks/bench_dates.py --repeat 200
+"""
+from common import print_table
+
+import argparse
+import time
+
+import dateutil.parser
+
+from fake_portal import PortalData
+
+
+def date_strings(data):
+    _, scores, attendance = data.scraped_items()
+    return [row["datetime"] for row in scores] + \
+        [row[key] for row in attendance for key in ("start_time", "end_time")]
+
+
+def fixed_formats(date_str):
+    from database import PORTAL_DATE_FORMATS
+    from datetime import datetime
+
+    for date_format in PORTAL_DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, date_format)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(date_str)
+
+
+def measure(parse_task, strings, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        results = parse_task(strings)
+    return (time.perf_counter() - started) / repeat, results
+
+
+def main():
+    from database import DateParser
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    strings = date_strings(PortalData.from_demo())
+    warm = DateParser()
+    parsers = [
+        ("dateutil", lambda strings: [dateutil.parser.parse(s) for s in strings]),
+        ("fixed formats", lambda strings: [fixed_formats(s) for s in strings]),
+        ("DateParser, cold", lambda strings: list(map(DateParser().parse, strings))),
+        ("DateParser, warm", lambda strings: list(map(warm.parse, strings))),
+    ]
+
+    rows = []
+    reference = None
+    for name, parse_task in parsers:
+        seconds, results = measure(parse_task, strings, args.repeat)
+        reference = reference or results
+        if results != reference:
+            raise SystemExit("%s parsed the dates differently than dateutil" % name)
+        rows.append([name, "%.3f" % (seconds * 1000), "%.2f" % (seconds / len(strings) * 1e6)])
+
+    print("%d date strings per task, %d distinct" % (len(strings), len(set(strings))))
+    print_table(rows, ["parser", "ms/task", "us/string"])
+    print("warm DateParser:", warm.stats())
+
+
+if __name__ == "__main__":
+    main()
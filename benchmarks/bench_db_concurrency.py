@@ -0,0 +1,136 @@
+"""
+Load test for the database layer: N reader threads share one DataBase the way
+the flask app does, while M writer processes store demo.json sized tasks the
+way scraper pipelines do, all on one sqlite file. Runs once with WAL and a
+busy timeout (the defaults) and once with sqlite's rollback journal and no
+timeout.
+
+    python benchmarks/bench_db_concurrency.py --readers 8 --writers 4 --seconds 5
+"""
+from common import workdir, print_table
+
+from multiprocessing import Process, Value
+import subprocess
+import threading
+import argparse
+import random
+import json
+import time
+import sys
+import os
+
+from fake_portal import PortalData
+
+
+CONFIGS = [
+    ("WAL, 5s busy timeout", {"SQLITE_WAL": "1", "SQLITE_BUSY_TIMEOUT": "5000"}),
+    ("rollback journal, no timeout", {"SQLITE_WAL": "0", "SQLITE_BUSY_TIMEOUT": "0"}),
+]
+
+
+def writer(n, deadline, written, errors):
+    from database import DataBase
+    from task import Task
+
+    db = DataBase()
+    profile, scores, attendance = PortalData.from_demo().scraped_items()
+    body = json.dumps({"scores": scores}).encode()
+    i = 0
+    while time.monotonic() < deadline:
+        task_id = "writer-%d-%d" % (n, i)
+        i += 1
+        try:
+            db.create_task(task_id)
+            db.add_student_profile_data(task_id, profile)
+            db.add_bulk_data(task_id, scores, attendance)
+            db.update_task_status(task_id, Task.SUCCESS, response=body)
+            with written.get_lock():
+                written.value += 1
+        except Exception:
+            db.session.rollback()
+            with errors.get_lock():
+                errors.value += 1
+
+
+def reader(db, task_ids, deadline, counts):
+    while time.monotonic() < deadline:
+        try:
+            task = db.get_task(random.choice(task_ids))
+            task.status
+            task.response_data
+            counts["reads"] += 1
+        except Exception:
+            counts["errors"] += 1
+        finally:
+            db.remove()
+
+
+def child(args):
+    from database import DataBase
+    from task import Task
+
+    with workdir():
+        db = DataBase()
+        profile, scores, attendance = PortalData.from_demo().scraped_items()
+        task_ids = []
+        for i in range(20):
+            task_id = "seed-%d" % i
+            db.create_task(task_id)
+            db.add_bulk_data(task_id, scores, attendance)
+            db.update_task_status(task_id, Task.SUCCESS, response=b"{}")
+            task_ids.append(task_id)
+        db.remove()
+
+        deadline = time.monotonic() + args.seconds
+        written, write_errors = Value("i", 0), Value("i", 0)
+        writers = [Process(target=writer, args=(n, deadline, written, write_errors))
+                   for n in range(args.writers)]
+        for process in writers:
+            process.start()
+
+        counts = [{"reads": 0, "errors": 0} for _ in range(args.readers)]
+        readers = [threading.Thread(target=reader, args=(db, task_ids, deadline, c)) for c in counts]
+        for thread in readers:
+            thread.start()
+        for thread in readers + writers:
+            thread.join()
+
+    print(json.dumps({
+        "reads": sum(c["reads"] for c in counts),
+        "read_errors": sum(c["errors"] for c in counts),
+        "writes": written.value,
+        "write_errors": write_errors.value,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    rows = []
+    for name, env in CONFIGS:
+        # the sqlite settings are read at import, so every config runs in its own interpreter
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", "--readers", str(args.readers),
+             "--writers", str(args.writers), "--seconds", str(args.seconds)],
+            env=dict(os.environ, **env), capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        rows.append([
+            name,
+            "%.0f" % (result["reads"] / args.seconds), result["read_errors"],
+            "%.1f" % (result["writes"] / args.seconds), result["write_errors"],
+        ])
+
+    print("%d reader threads, %d writer processes, %.0fs" % (args.readers, args.writers, args.seconds))
+    print_table(rows, ["sqlite", "reads/sec", "read errors", "tasks written/sec", "write errors"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Rows/sec of the per-row ORM inserts (add_course_score_data and
+add_attendance_data) against DataBase.add_bulk_data, for demo.json sized
+payloads written to a sqlite file.
+
+    python benchmarks/bench_db_inserts.py --tasks 50
+"""
+from common import workdir, print_table
+
+import argparse
+import time
+
+from fake_portal import PortalData
+
+
+def orm_rows(db, task_id, scores, attendance):
+    db.add_course_score_data(task_id, scores)
+    db.add_attendance_data(task_id, attendance)
+
+
+def bulk_rows(db, task_id, scores, attendance):
+    db.add_bulk_data(task_id, scores, attendance)
+
+
+def run(insert, n_tasks, scores, attendance):
+    from database import DataBase
+
+    with workdir():
+        db = DataBase()
+        for i in range(n_tasks):
+            db.create_task("task-%d" % i)
+        started = time.perf_counter()
+        for i in range(n_tasks):
+            insert(db, "task-%d" % i, scores, attendance)
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=50)
+    args = parser.parse_args()
+
+    _, scores, attendance = PortalData.from_demo().scraped_items()
+    n_rows = args.tasks * (len(scores) + len(attendance))
+
+    rows = []
+    for name, insert in [("ORM per row", orm_rows), ("bulk executemany", bulk_rows)]:
+        elapsed = run(insert, args.tasks, scores, attendance)
+        rows.append([name, n_rows, "%.3f" % elapsed, "%.0f" % (n_rows / elapsed)])
+
+    print("%d tasks of %d score + %d attendance rows" % (args.tasks, len(scores), len(attendance)))
+    print_table(rows, ["path", "rows", "seconds", "rows/sec"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+GET /demo: demo.json read and re-serialized on every request (how the route
+worked before) against the payload serialized and compressed at startup,
+for clients without compression, with gzip and revalidating with an ETag.
+Fails if the served JSON isn't the old one.
+
+    python benchmarks/bench_demo.py --requests 500
+"""
+from common import workdir, print_table
+
+import argparse
+import gzip
+import json
+import time
+
+
+def old_demo():
+    from flask import jsonify
+    from app import DEMO_FILE
+    from task import Task
+
+    with open(DEMO_FILE, "r") as f:
+        data = json.load(f)
+    return jsonify({
+        "status": Task.SUCCESS,
+        "data": data,
+        "message": "Task completed successfully",
+        "taskCompleted": True
+    }), 200
+
+
+def measure(client, path, n, headers):
+    started = time.perf_counter()
+    for _ in range(n):
+        response = client.get(path, headers=headers)
+    return (time.perf_counter() - started) / n, response
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    with workdir():
+        from app import app, demo_response
+
+        app.add_url_rule("/demo-old", "demo_old", old_demo)
+        client = app.test_client()
+        expected = json.loads(client.get("/demo-old").data)
+        etag = client.get("/demo", headers={"Accept-Encoding": "gzip"}).headers["ETag"]
+
+        cases = [
+            ("old", "/demo-old", {}),
+            ("preloaded, identity", "/demo", {}),
+            ("preloaded, gzip", "/demo", {"Accept-Encoding": "gzip"}),
+            ("preloaded, If-None-Match", "/demo", {"Accept-Encoding": "gzip", "If-None-Match": etag}),
+        ]
+        rows = []
+        for name, path, headers in cases:
+            seconds, response = measure(client, path, args.requests, headers)
+            body = response.data
+            if response.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            if response.status_code == 200 and json.loads(body) != expected:
+                raise SystemExit("%s served a different payload" % name)
+            rows.append([name, response.status_code, len(response.data), "%.3f" % (seconds * 1000)])
+
+    print("encodings precomputed:", ", ".join(demo_response.variants))
+    print_table(rows, ["request", "status", "bytes", "ms/request"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Dispatch backends (dispatch.py): the database table and redis, the latter
+against benchmarks/fake_redis.py. First the cost of a submit, lease and
+complete, then two worker.py processes scraping the fake portal with one of
+them killed mid crawl: its leases expire, the other worker runs those tasks
+again, and every task has to end up SUCCESS with its events reaching the
+API side through the backend.
+
+    python benchmarks/bench_dispatch.py --tasks 12 --latency 0.1
+"""
+from common import workdir, print_table, ROOT_DIR
+
+import collections
+import subprocess
+import argparse
+import signal
+import time
+import sys
+import os
+
+from fake_portal import FakePortal
+from fake_redis import FakeRedis
+
+
+def operations(dispatcher, n):
+    started = time.perf_counter()
+    for i in range(n):
+        dispatcher.submit("ops-%d" % i)
+    submitted = time.perf_counter()
+    task_ids = [dispatcher.lease("bench", timeout=0) for _ in range(n)]
+    leased = time.perf_counter()
+    dispatcher.heartbeat("bench", task_ids)
+    for task_id in task_ids:
+        dispatcher.complete("bench", task_id)
+    completed = time.perf_counter()
+    return [(submitted - started) / n * 1000, (leased - submitted) / n * 1000, (completed - leased) / n * 1000]
+
+
+def start_worker(env, crawls):
+    return subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "worker.py"), "--crawls", str(crawls)],
+                            env=env, cwd=os.getcwd())
+
+
+def failover(backend, dispatcher, env, args):
+    from database import DataBase
+    from events import TaskEvents
+    from task import Task
+
+    task_events = TaskEvents()
+    seen = collections.defaultdict(list)
+    update = task_events.update
+
+    def record(task_id, status, message="", progress=None):
+        # a crawl starting publishes IN PROGRESS without progress
+        seen[task_id].append("started" if status == Task.IN_PROGRESS and progress is None else status)
+        update(task_id, status, message, progress)
+
+    task_events.update = record
+    task_events.follow(dispatcher)
+    time.sleep(0.5)
+
+    workers = [start_worker(env, args.crawls) for _ in range(2)]
+    # scrapy's startup in the workers
+    time.sleep(3)
+
+    db = DataBase()
+    task_ids = ["%s-%d" % (backend, i) for i in range(args.tasks)]
+    started = time.monotonic()
+    for task_id in task_ids:
+        db.create_task(task_id)
+        db.update_task_status(task_id, Task.STARTED)
+        dispatcher.submit(task_id)
+    time.sleep(args.kill_after)
+    workers[0].send_signal(signal.SIGKILL)
+
+    deadline = time.monotonic() + 300
+    while True:
+        db.session.expire_all()
+        statuses = [db.get_task(task_id).status for task_id in task_ids]
+        if all(status in (Task.SUCCESS, Task.FAILED) for status in statuses):
+            break
+        if time.monotonic() > deadline:
+            raise SystemExit("%s: tasks didn't finish: %s" % (backend, collections.Counter(statuses)))
+        time.sleep(0.2)
+    elapsed = time.monotonic() - started
+    # the last events may still be on their way
+    time.sleep(1)
+
+    workers[1].send_signal(signal.SIGTERM)
+    workers[1].wait(60)
+    workers[0].wait()
+    db.remove()
+
+    restarted = sum(1 for task_id in task_ids if seen[task_id].count("started") > 1)
+    events_ok = all(seen[task_id] and seen[task_id][-1] == status for task_id, status in zip(task_ids, statuses))
+    return [backend, "%d/%d" % (statuses.count(Task.SUCCESS), len(task_ids)), restarted,
+            "yes" if events_ok else "NO", "%.1f" % elapsed]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=12)
+    parser.add_argument("--crawls", type=int, default=4, help="concurrent crawls per worker")
+    parser.add_argument("--latency", type=float, default=0.1, help="portal latency in seconds")
+    parser.add_argument("--kill-after", type=float, default=1.0, help="seconds until a worker is killed")
+    parser.add_argument("--ops", type=int, default=500)
+    args = parser.parse_args()
+
+    portal = FakePortal(latency=args.latency).start()
+    redis = FakeRedis().start()
+    env = dict(os.environ, PORTAL_URL=portal.url, REDIS_URL=redis.url, LEASE_SECONDS="2",
+               LOG_LEVEL="WARNING", PYTHONPATH=ROOT_DIR)
+    # this process uses the same settings as its workers
+    os.environ.update(env)
+
+    from dispatch import DatabaseDispatcher, RedisDispatcher
+
+    op_rows, failover_rows = [], []
+    with workdir():
+        for backend, dispatcher in [("db", DatabaseDispatcher()), ("redis", RedisDispatcher(redis.url))]:
+            op_rows.append([backend] + ["%.3f" % ms for ms in operations(dispatcher, args.ops)])
+            failover_rows.append(failover(backend, dispatcher, dict(env, DISPATCH_BACKEND=backend), args))
+    portal.stop()
+    redis.stop()
+
+    print_table(op_rows, ["backend", "submit ms", "lease ms", "complete ms"])
+    print()
+    print("%d tasks, 2 workers x %d crawls, one worker killed after %.1fs, 2s leases"
+          % (args.tasks, args.crawls, args.kill_after))
+    print_table(failover_rows, ["backend", "succeeded", "tasks run again", "events reached API", "seconds"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+A burst of tasks against a fake portal that slows down past its capacity and
+answers 503 past twice that, through the API with a real ScrapePool: without
+the portal governor (portal/governor.py) and with it. Counts the 503s, the
+tasks that got all their marks, and the most requests the portal had at
+once. Also compares the estimatedWait GET /task gives a queued task right
+after it was submitted with the time until its crawl actually started.
+
+    python benchmarks/bench_governor.py --tasks 40 --latency 0.05 --capacity 3
+"""
+from common import workdir, print_table
+
+import statistics
+import threading
+import argparse
+import logging
+import sqlite3
+import time
+import os
+
+import requests
+from werkzeug.serving import make_server
+
+from fake_portal import FakePortal, PortalData
+
+
+def complete_tasks(prefix, n_rows):
+    # tasks with every marks row of the portal stored
+    with sqlite3.connect("tasks_db____.db") as conn:
+        counts = conn.execute(
+            "SELECT task_id, count(*) FROM course_score WHERE task_id LIKE ? GROUP BY task_id", (prefix + "%",)
+        ).fetchall()
+    return sum(1 for _, count in counts if count == n_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--crawls", type=int, default=12, help="concurrent crawls per worker")
+    parser.add_argument("--latency", type=float, default=0.05, help="portal latency in seconds")
+    parser.add_argument("--capacity", type=int, default=3, help="requests the portal serves at full speed")
+    parser.add_argument("--target-latency", type=float, default=0.08)
+    args = parser.parse_args()
+
+    data = PortalData.generate(courses=6, rows=10, attendance=10)
+    portal = FakePortal(data, latency=args.latency, capacity=args.capacity).start()
+    os.environ.update({
+        "PORTAL_URL": portal.url,
+        "SCRAPE_WORKERS": str(args.workers),
+        "CONCURRENT_CRAWLS": str(args.crawls),
+        "SCRAPE_QUEUE_SIZE": str(args.tasks * 2),
+        "GOVERNOR_TARGET_LATENCY": str(args.target_latency),
+        "RESULT_TTL": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    rows, estimate_rows = [], []
+    with workdir():
+        import app as api
+        api.start()
+
+        server = make_server("127.0.0.1", 0, api.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:%d" % server.server_port
+
+        started_at = {}
+        update = api.task_events.update
+
+        def record(task_id, status, message="", progress=None):
+            if status == "IN PROGRESS":
+                started_at.setdefault(task_id, time.monotonic())
+            update(task_id, status, message, progress)
+
+        api.task_events.update = record
+
+        def run(prefix, n):
+            submitted, estimates = {}, {}
+            for i in range(n):
+                task_id = "%s-%d" % (prefix, i)
+                requests.post(base + "/task/", json={"sessionId": task_id}).raise_for_status()
+                submitted[task_id] = time.monotonic()
+                estimates[task_id] = requests.get("%s/task/%s" % (base, task_id)).json()["estimatedWait"]
+            while True:
+                statuses = [requests.get("%s/task/%s" % (base, task_id)).json()["status"] for task_id in submitted]
+                if all(status in ("SUCCESS", "FAILED") for status in statuses):
+                    break
+                time.sleep(0.2)
+            waits = {task_id: started_at[task_id] - submitted[task_id]
+                     for task_id in submitted if task_id in started_at}
+            return statuses, estimates, waits
+
+        for name, enabled in [("off", "0"), ("on", "1")]:
+            # the workers are spawned, they read the settings when they start
+            os.environ["GOVERNOR_ENABLED"] = enabled
+            api.scrape_pool.start()
+            time.sleep(3)
+            # a first round to learn how long a crawl takes
+            run("warmup-%s" % name, args.workers * args.crawls)
+
+            portal.requests.clear()
+            portal.peak_in_flight = 0
+            started = time.monotonic()
+            statuses, estimates, waits = run(name, args.tasks)
+            elapsed = time.monotonic() - started
+            api.scrape_pool.close()
+
+            rows.append([name, "%d/%d" % (statuses.count("SUCCESS"), args.tasks),
+                         "%d/%d" % (complete_tasks(name + "-", data.n_score_rows), args.tasks),
+                         portal.requests["503"], portal.peak_in_flight, "%.1f" % elapsed])
+            queued = [task_id for task_id in waits if estimates[task_id] is not None]
+            errors = [abs(estimates[task_id] - waits[task_id]) for task_id in queued]
+            estimate_rows.append([name, len(queued),
+                                  "%.1f" % statistics.mean(waits[task_id] for task_id in queued) if queued else "-",
+                                  "%.1f" % statistics.median(errors) if errors else "-"])
+        server.shutdown()
+    portal.stop()
+
+    print("%d tasks, %d workers x %d crawls, %.0f ms portal latency, portal capacity %d"
+          % (args.tasks, args.workers, args.crawls, args.latency * 1000, args.capacity))
+    print_table(rows, ["governor", "succeeded", "all marks", "503s", "peak in flight", "seconds"])
+    print()
+    print_table(estimate_rows, ["governor", "queued tasks", "mean wait s", "median |estimate - wait| s"])
+
+
+if __name__ == "__main__":
+    main()
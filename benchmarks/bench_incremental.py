@@ -0,0 +1,140 @@
+"""
+Incremental re-scrapes: scrapes a session once, then scrapes it again after
+nothing changed, after one course got a new marks row and after a course was
+dropped. Every re-scrape keeps the session's data and only parses and writes
+the course pages whose fingerprint changed. Its response has to be the same
+as a fresh scrape of the same portal data.
+
+    python benchmarks/bench_incremental.py --courses 8 --rows 40 --attendance 60
+"""
+from common import workdir, print_table
+
+from multiprocessing import Process, Queue
+import argparse
+import json
+import time
+import os
+
+from fake_portal import FakePortal, PortalData
+
+
+def crawl(results, session_id):
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from portal.spiders.comsats_edu_pk import ComsatsEduPkSpider
+    from database import DataBase
+    from response import prepare_response
+    from task import Task
+
+    db = DataBase()
+    # what submit_task does for a session scraped before
+    if db.has_course_pages(session_id):
+        db.update_progress(session_id, courses_total=None, courses_done=0, rows_ingested=0,
+                           pages_skipped=0, rows_skipped=0, commit=False)
+        db.update_task_status(session_id, Task.STARTED)
+    elif db.get_task(session_id) is not None:
+        db.delete_task(session_id)
+    db.remove()
+
+    process = CrawlerProcess(settings={
+        **get_project_settings(),
+        "SESSION_ID": session_id,
+    })
+    started = time.monotonic()
+    process.crawl(ComsatsEduPkSpider)
+    process.start()
+    elapsed = time.monotonic() - started
+
+    db = DataBase()
+    task = db.get_task(session_id)
+    response = prepare_response(task) if task.status == Task.SUCCESS else None
+    n_rows = len(db.get_task_data(session_id)[1])
+    results.put((elapsed, task.status, task.progress(), json.dumps(response, sort_keys=True), n_rows))
+
+
+def run(portal, session_id):
+    results = Queue()
+    portal.requests.clear()
+    process = Process(target=crawl, args=(results, session_id))
+    process.start()
+    result = results.get()
+    process.join()
+    return result + (sum(portal.requests.values()),)
+
+
+def store_legacy(data, session_id):
+    # a task written without page fingerprints, like tasks stored before
+    # incremental re-scrapes
+    from database import DataBase
+    from task import Task
+
+    db = DataBase()
+    profile, scores, attendance = data.scraped_items()
+    for position, row in enumerate(scores):
+        row["position"] = position
+    db.create_task(session_id)
+    db.write_batch(session_id, profile=profile, course_score_data=scores, attendance_data=attendance)
+    db.update_task_status(session_id, Task.SUCCESS)
+    db.remove()
+
+
+def change_marks(data):
+    course = data.courses[0]
+    section_title = next(iter(course["sections"]))
+    course["sections"][section_title] = course["sections"][section_title] + [("Added", "7", "10", "1/6/2023")]
+
+
+def drop_course(data):
+    course = data.courses.pop()
+    del data.by_id[course["course_id"]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--courses", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=40)
+    parser.add_argument("--attendance", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    data = PortalData.generate(args.courses, args.rows, args.attendance)
+    portal = FakePortal(data, latency=args.latency).start()
+    os.environ["PORTAL_URL"] = portal.url
+    steps = [
+        ("first scrape", None),
+        ("nothing changed", None),
+        ("one course changed", change_marks),
+        ("course dropped", drop_course),
+    ]
+
+    rows = []
+    with workdir():
+        store_legacy(data, "legacy")
+        for n, (name, change) in enumerate(steps):
+            if change is not None:
+                change(data)
+            elapsed, status, progress, response, n_rows, n_requests = run(portal, "incremental")
+            # a session that was never scraped gets everything again
+            fresh = run(portal, "fresh-%d" % n)[3]
+            rows.append([name, status, n_requests, progress["pagesSkipped"], progress["rowsSkipped"],
+                         progress["rowsIngested"], "%.2f" % elapsed, "yes" if response == fresh else "NO"])
+        # a task without fingerprints is scraped from scratch, not on top of
+        # its old rows
+        elapsed, status, progress, response, n_rows, n_requests = run(portal, "legacy")
+        rows.append(["stored without fingerprints", status, n_requests, progress["pagesSkipped"],
+                     progress["rowsSkipped"], progress["rowsIngested"], "%.2f" % elapsed,
+                     "yes" if response == fresh else "NO"])
+        if n_rows != data.n_score_rows:
+            raise SystemExit("re-scrape of a task without fingerprints left %d marks rows instead of %d"
+                             % (n_rows, data.n_score_rows))
+    portal.stop()
+
+    print("%d courses, %d score + %d attendance rows" % (
+        len(data.courses), data.n_score_rows, data.n_attendance_rows))
+    print_table(rows, ["scrape", "status", "requests", "pages skipped", "rows skipped",
+                       "rows parsed", "seconds", "same as fresh"])
+
+
+if __name__ == "__main__":
+    main()
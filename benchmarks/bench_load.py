@@ -0,0 +1,140 @@
+"""
+End to end load: simulated students each submit their session to the API
+(POST /task/) and long poll /taskdata until their data comes back, one task
+after the other, against the API with a real ScrapePool crawling the fake
+portal serving generated courses. Reports task latency from the POST to
+the data (p50, p99), tasks/sec, how much the database grew and the memory
+of the API process and every scrape worker.
+
+    python benchmarks/bench_load.py --students 20 --tasks-per-student 3 --courses 6 --rows 20 --latency 0.05
+"""
+from common import workdir, print_table
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import threading
+import argparse
+import logging
+import time
+import os
+
+import requests
+from werkzeug.serving import make_server
+
+from fake_portal import FakePortal, PortalData
+
+
+DB_FILES = ["tasks_db____.db", "tasks_db____.db-wal"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def db_size():
+    return sum(os.path.getsize(path) for path in DB_FILES if os.path.exists(path))
+
+
+def memory(pid):
+    # current and peak resident set size in MB, linux only
+    try:
+        with open("/proc/%d/status" % pid, "r") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None, None
+    return [int(fields[name].split()[0]) / 1024 if name in fields else None for name in ("VmRSS", "VmHWM")]
+
+
+def student(base, name, n_tasks, counts):
+    # latency of every task of the student, None for a failed one
+    latencies = []
+    session = requests.Session()
+    for i in range(n_tasks):
+        session_id = "%s-%d" % (name, i)
+        started = time.monotonic()
+        while True:
+            r = session.post(base + "/task/", json={"sessionId": session_id})
+            if r.status_code != 503:
+                break
+            counts["busy"] += 1
+            time.sleep(float(r.headers.get("Retry-After", 1)))
+        task = r.json()
+        while True:
+            body = session.get("%s/taskdata/%s" % (base, task["task_id"]),
+                               params={"key": task["key"], "wait": 30}).json()
+            if body["status"] not in ("STARTED", "IN PROGRESS"):
+                break
+        if body["status"] == "SUCCESS" and body["data"]:
+            latencies.append(time.monotonic() - started)
+        else:
+            counts["failed"] += 1
+            latencies.append(None)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--students", type=int, default=20, help="students submitting at the same time")
+    parser.add_argument("--tasks-per-student", type=int, default=3)
+    parser.add_argument("--courses", type=int, default=6)
+    parser.add_argument("--rows", type=int, default=20, help="marks rows per course")
+    parser.add_argument("--attendance", type=int, default=30, help="attendance rows per course")
+    parser.add_argument("--latency", type=float, default=0.05, help="portal latency in seconds")
+    args = parser.parse_args()
+
+    data = PortalData.generate(args.courses, args.rows, args.attendance)
+    portal = FakePortal(data, latency=args.latency).start()
+    os.environ.update({"PORTAL_URL": portal.url, "SCRAPE_QUEUE_SIZE": str(args.students * 2)})
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    with workdir():
+        import app as api
+        api.start()
+
+        server = make_server("127.0.0.1", 0, api.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:%d" % server.server_port
+        api.scrape_pool.start()
+        # reactor and scrapy startup of the workers, then one task each
+        time.sleep(3)
+        student(base, "warmup", api.scrape_pool.workers, collections.Counter())
+
+        counts = collections.Counter()
+        size_before = db_size()
+        started = time.monotonic()
+        with ThreadPoolExecutor(args.students) as pool:
+            results = list(pool.map(lambda n: student(base, "student%d" % n, args.tasks_per_student, counts),
+                                    range(args.students)))
+        elapsed = time.monotonic() - started
+        size_after = db_size()
+
+        processes = [("api", os.getpid())] + [
+            ("scrape worker %d" % n, process.pid) for n, process in enumerate(api.scrape_pool.processes)]
+        memory_rows = [[name] + ["%.1f" % mb if mb is not None else "-" for mb in memory(pid)]
+                       for name, pid in processes]
+        api.scrape_pool.close()
+        server.shutdown()
+    portal.stop()
+
+    latencies = [latency for latencies in results for latency in latencies if latency is not None]
+    n_tasks = args.students * args.tasks_per_student
+    print("%d students x %d tasks, %d courses x %d marks + %d attendance rows, %.0f ms portal latency"
+          % (args.students, args.tasks_per_student, args.courses, args.rows, args.attendance,
+             args.latency * 1000))
+    print_table([[
+        "%d/%d" % (len(latencies), n_tasks),
+        counts["busy"],
+        "%.2f" % percentile(latencies, 50) if latencies else "-",
+        "%.2f" % percentile(latencies, 99) if latencies else "-",
+        "%.2f" % (len(latencies) / elapsed),
+        "%.1f" % ((size_after - size_before) / 1024 / 1024),
+        "%.1f" % ((size_after - size_before) / 1024 / max(len(latencies), 1)),
+    ]], ["succeeded", "busy (503)", "p50 s", "p99 s", "tasks/sec", "db growth MB", "KB/task"])
+    print()
+    print_table(memory_rows, ["process", "rss MB", "peak rss MB"])
+
+
+if __name__ == "__main__":
+    main()
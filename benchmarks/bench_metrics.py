@@ -0,0 +1,112 @@
+"""
+Cost of the instrumentation in metrics.py: a histogram observation and a
+span, with metrics on and with METRICS_ENABLED=0, then tasks/sec of the API
+with a real ScrapePool crawling the local fake portal without and with
+metrics. Prints where the time of the instrumented tasks went, read back
+from the API's /metrics.
+
+    python benchmarks/bench_metrics.py --tasks 30 --latency 0.02
+"""
+from common import workdir, print_table
+
+import importlib
+import threading
+import argparse
+import logging
+import timeit
+import time
+import re
+import os
+
+import requests
+from werkzeug.serving import make_server
+
+from fake_portal import FakePortal
+
+
+def micro(n):
+    import metrics
+
+    rows = []
+    for enabled in ["1", "0"]:
+        os.environ["METRICS_ENABLED"] = enabled
+        importlib.reload(metrics)
+        histogram = metrics.histogram("bench_seconds", "", ["stage"])
+
+        def observe():
+            histogram.labels("flush").observe(0.01)
+
+        def span():
+            with metrics.span("flush", "task"):
+                pass
+
+        rows.append(["on" if enabled == "1" else "off"] + [
+            "%.3f" % (min(timeit.repeat(f, number=n, repeat=3)) / n * 1e6) for f in (observe, span)])
+    os.environ["METRICS_ENABLED"] = "1"
+    importlib.reload(metrics)
+    return rows
+
+
+def stages(text, metric, label):
+    sums = dict(re.findall(r'%s_sum\{%s="([^"]+)"\} (\S+)' % (metric, label), text))
+    counts = dict(re.findall(r'%s_count\{%s="([^"]+)"\} (\S+)' % (metric, label), text))
+    return [[name, counts[name], "%.1f" % (float(sums[name]) / float(counts[name]) * 1000)]
+            for name in sorted(sums) if float(counts[name])]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.02, help="portal latency in seconds")
+    parser.add_argument("--ops", type=int, default=200000)
+    args = parser.parse_args()
+
+    micro_rows = micro(args.ops)
+
+    portal = FakePortal(latency=args.latency).start()
+    os.environ.update({"PORTAL_URL": portal.url, "SCRAPE_QUEUE_SIZE": str(args.tasks * 2), "RESULT_TTL": "0"})
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    rows = []
+    with workdir():
+        import app as api
+        api.start()
+
+        server = make_server("127.0.0.1", 0, api.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:%d" % server.server_port
+
+        for name, enabled in [("off", "0"), ("on", "1")]:
+            # read by the workers when they're spawned
+            os.environ["METRICS_ENABLED"] = enabled
+            api.scrape_pool.start()
+            time.sleep(3)
+            task_ids = ["%s-%d" % (name, i) for i in range(args.tasks)]
+            started = time.monotonic()
+            for task_id in task_ids:
+                requests.post(base + "/task/", json={"sessionId": task_id}).raise_for_status()
+            while not all(requests.get("%s/task/%s" % (base, task_id)).json()["status"] in ("SUCCESS", "FAILED")
+                          for task_id in task_ids):
+                time.sleep(0.1)
+            elapsed = time.monotonic() - started
+            # the workers retire their metrics when they stop, /metrics keeps them
+            api.scrape_pool.close()
+            rows.append([name, args.tasks, "%.2f" % elapsed, "%.2f" % (args.tasks / elapsed)])
+
+        text = requests.get(base + "/metrics").text
+        server.shutdown()
+    portal.stop()
+
+    print_table(micro_rows, ["metrics", "observe us", "span us"])
+    print()
+    print("%d tasks, %.0f ms portal latency" % (args.tasks, args.latency * 1000))
+    print_table(rows, ["metrics", "tasks", "seconds", "tasks/sec"])
+    print()
+    print_table(stages(text, "portal_stage_seconds", "stage"), ["stage", "count", "mean ms"])
+    print()
+    print_table(stages(text, "portal_request_seconds", "callback"), ["portal round trip", "count", "mean ms"])
+
+
+if __name__ == "__main__":
+    main()
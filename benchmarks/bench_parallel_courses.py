@@ -0,0 +1,93 @@
+"""
+Harness for PARALLEL_COURSES: crawls the fake portal one course at a time and
+with all courses at once, against a portal that keeps the selected course in
+session state (responses can come back for the wrong course) and one that
+keeps it per cookiejar, and one whose pages don't name their course (the
+crawl falls back to one course at a time). Every mode has to produce the
+serial crawl's data.
+
+    python benchmarks/bench_parallel_courses.py --latency 0.2
+"""
+from common import workdir, print_table
+
+from multiprocessing import Process, Queue
+import argparse
+import json
+import time
+import os
+
+from fake_portal import FakePortal, PortalData
+
+
+def crawl(results, parallel):
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from portal.spiders.comsats_edu_pk import ComsatsEduPkSpider
+    with workdir():
+        from database import DataBase
+        from response import prepare_response
+
+        process = CrawlerProcess(settings={
+            **get_project_settings(),
+            "SESSION_ID": "harness",
+            "PARALLEL_COURSES": parallel,
+        })
+        started = time.monotonic()
+        process.crawl(ComsatsEduPkSpider)
+        process.start()
+        elapsed = time.monotonic() - started
+
+        task = DataBase().get_task("harness")
+        response = prepare_response(task) if task.status == "SUCCESS" else None
+        results.put((elapsed, task.status, json.dumps(response, sort_keys=True)))
+
+
+def run(portal, parallel):
+    results = Queue()
+    portal.requests.clear()
+    process = Process(target=crawl, args=(results, parallel))
+    process.start()
+    result = results.get()
+    process.join()
+    return result + (sum(portal.requests.values()),)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--courses", type=int, help="generated courses instead of demo.json")
+    args = parser.parse_args()
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    data = PortalData.generate(args.courses) if args.courses else PortalData.from_demo()
+    modes = [
+        ("serial", "session", False, True),
+        ("parallel", "session", True, True),
+        ("parallel", "cookie", True, True),
+        ("parallel", "session", True, False),
+    ]
+
+    rows = []
+    reference = None
+    for name, course_state, parallel, course_titles in modes:
+        portal = FakePortal(data, latency=args.latency, course_state=course_state,
+                            course_titles=course_titles).start()
+        os.environ["PORTAL_URL"] = portal.url
+        elapsed, status, response, n_requests = run(portal, parallel)
+        portal.stop()
+
+        reference = reference or response
+        rows.append([name, course_state, "yes" if course_titles else "no", status, n_requests, "%.2f" % elapsed,
+                     "yes" if response == reference else "NO"])
+
+    if not args.courses:
+        with open(os.path.join(os.path.dirname(__file__), "..", "demo.json")) as f:
+            demo = json.dumps(json.load(f), sort_keys=True)
+        print("serial crawl matches demo.json:", reference == demo)
+
+    print("%d courses, %.0f ms portal latency" % (len(data.courses), args.latency * 1000))
+    print_table(rows, ["mode", "course state", "course titles", "status", "requests", "seconds", "same data"])
+
+
+if __name__ == "__main__":
+    main()
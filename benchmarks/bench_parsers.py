@@ -0,0 +1,125 @@
+"""
+Rows/sec and CPU time per task of the marks and attendance extraction: the
+spider's old per-cell css selectors against portal/parsers.py, over pages
+rendered by the fake portal (demo.json and generated courses) plus a few
+hand written pages with markup the portal might send. Fails if the two
+don't extract the same rows.
+
+    python benchmarks/bench_parsers.py --repeat 20
+"""
+from common import print_table
+
+import argparse
+import time
+
+from scrapy.http import HtmlResponse
+
+from fake_portal import PortalData, render_marks, render_attendance, page
+
+
+EDGE_CASES = [
+    # markup inside cells, comments and whitespace only text nodes
+    page('<div class="quiz_listing"><div> <b>Quizzes</b></div><table><tbody>'
+         "<tr><td><!-- title -->Quiz 1</td><td><span>4</span> / 5</td><td>5</td>"
+         "<td>1/2/2023</td><td>extra</td></tr>"
+         "<tr><td>Quiz 2<br>retake</td><td>3</td><td>5</td><td>\n 2/2/2023 \n</td></tr>"
+         "</tbody></table></div>"),
+    # two listings, header rows in tbody, a table nested in a cell
+    page('<div class="quiz_listing x"><div>A</div><table><tbody><tr><td>a</td><td>1</td>'
+         "<td>2</td><td>3/3/2023</td></tr></tbody></table></div>"
+         '<div class="quiz_listing"><div>B</div><table><tbody>'
+         "<tr><td><table><tbody><tr><td>x</td><td>inner</td><td>i</td><td>j</td></tr></tbody></table>b</td>"
+         "<td>1</td><td>2</td><td>4/4/2023</td></tr></tbody></table></div>"),
+    page('<div id="Class"><div class="table-responsive"><table><tbody>'
+         "<tr><td>Topic <i>1</i></td><td> Present </td><td>2/1/2023 10:00:00 AM</td>"
+         "<td>2/1/2023 11:00:00 AM</td></tr>"
+         "<tr><td>Topic 2</td><td>Absent</td><td>x</td><td>y</td><td>z</td></tr>"
+         '</tbody></table></div></div><div id="Lab"><div><div class="table-responsive">'
+         "<table><tbody><tr><td>Lab</td><td>Present</td><td>a</td><td>b</td></tr>"
+         "</tbody></table></div></div></div>"),
+    # a row without a text cell, extraction fails
+    page('<div id="Class"><div class="table-responsive"><table><tbody>'
+         "<tr><th>Topic</th><td>Absent</td><td>x</td><td>y</td></tr></tbody></table></div></div>"),
+]
+
+
+def legacy_marks_rows(response):
+    quizes_elems = response.css("div.quiz_listing")
+    quizes = zip(quizes_elems.xpath("./div"), quizes_elems.xpath("./table"))
+    for section_title_elem, quiz_table in quizes:
+        section_title = section_title_elem.css("::text").get().strip()
+        for quiz_row in quiz_table.css("tbody > tr"):
+            title = quiz_row.css("td:nth-child(1)::text").get().strip()
+            marks = quiz_row.css("td:nth-child(2)::text").get().strip()
+            total_marks = quiz_row.css("td:nth-child(3)::text").get().strip()
+            datetime = quiz_row.css("td:nth-child(4)::text").get().strip()
+            yield section_title, title, marks, total_marks, datetime
+
+
+def legacy_attendance_rows(response, _id):
+    for row in response.css(f"#{_id} .table-responsive table tbody > tr"):
+        topic = row.css("td:nth-child(1)::text").get().strip()
+        status = row.css("td:nth-child(2)::text").get().strip()
+        start_time = row.css("td:nth-child(3)::text").get().strip()
+        end_time = row.css("td:nth-child(4)::text").get().strip()
+        yield topic, status, start_time, end_time
+
+
+def extract(html, marks_rows, attendance_rows):
+    # a fresh response every time, the parsed tree is cached on it
+    response = HtmlResponse(url="http://portal/", body=html, encoding="utf-8")
+    rows = list(marks_rows(response))
+    for _id in ["Class", "Lab"]:
+        rows.extend(attendance_rows(response, _id))
+    return rows
+
+
+def safe_extract(html, marks_rows, attendance_rows):
+    try:
+        return extract(html, marks_rows, attendance_rows)
+    except (AttributeError, IndexError):
+        # a missing text fails both ways
+        return "error"
+
+
+def measure(pages, marks_rows, attendance_rows, repeat):
+    n_rows = 0
+    started, cpu_started = time.perf_counter(), time.process_time()
+    for _ in range(repeat):
+        for html in pages:
+            n_rows += len(extract(html, marks_rows, attendance_rows))
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    return n_rows / elapsed, cpu / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    from portal import parsers
+
+    datasets = [("demo.json", PortalData.from_demo()), ("generated", PortalData.generate(8, 40, 60))]
+    for html in EDGE_CASES + [page("")] + [render_marks(c) + render_attendance(c)
+                                          for _, data in datasets for c in data.courses]:
+        old = safe_extract(html, legacy_marks_rows, legacy_attendance_rows)
+        new = safe_extract(html, parsers.marks_rows, parsers.attendance_rows)
+        if old != new:
+            raise SystemExit("rows differ:\n%s\n%s\n%s" % (html, old, new))
+    print("same rows for all %d pages" % (len(EDGE_CASES) + 1 + sum(len(d.courses) for _, d in datasets)))
+
+    rows = []
+    for name, data in datasets:
+        # a task parses the marks and the attendance page of every course
+        pages = [render_marks(c) for c in data.courses] + [render_attendance(c) for c in data.courses]
+        for parser_name, marks_rows, attendance_rows in [
+            ("css per cell", legacy_marks_rows, legacy_attendance_rows),
+            ("parsers.py", parsers.marks_rows, parsers.attendance_rows),
+        ]:
+            rows_per_sec, cpu_ms = measure(pages, marks_rows, attendance_rows, args.repeat)
+            rows.append([name, parser_name, "%.0f" % rows_per_sec, "%.2f" % cpu_ms])
+    print_table(rows, ["pages", "parser", "rows/sec", "cpu ms/task"])
+
+
+if __name__ == "__main__":
+    main()
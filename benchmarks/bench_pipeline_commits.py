@@ -0,0 +1,135 @@
+"""
+Commits per task and pipeline time of PortalPipeline against the pipeline
+it replaced (profile committed on its own, a flush every 100 items),
+feeding the items of a portal in the order the spider yields them.
+
+    python benchmarks/bench_pipeline_commits.py --courses 6 --rows 20 --attendance 30
+"""
+from common import workdir, print_table
+
+import argparse
+import logging
+import time
+
+from sqlalchemy import event
+
+from fake_portal import PortalData
+
+
+class LegacyPipeline:
+    def open_spider(self, spider):
+        from database import DataBase
+        from task import Task
+
+        self.task_id = spider.settings.get("SESSION_ID")
+        self.db = DataBase()
+        self.items = []
+        self.db.create_task(self.task_id)
+        self.db.update_task_status(self.task_id, Task.IN_PROGRESS)
+
+    def process_item(self, item, spider):
+        from portal.items import StudentProfileItem, CoursePageItem
+
+        if isinstance(item, StudentProfileItem):
+            self.db.add_student_profile_data(self.task_id, item)
+        elif not isinstance(item, CoursePageItem):
+            self.items.append(item)
+            if len(self.items) >= 100:
+                self.add_data_to_db()
+        return item
+
+    def close_spider(self, spider):
+        from response import prepare_response_body
+        from task import Task
+
+        self.add_data_to_db()
+        task = self.db.get_task(self.task_id)
+        response = prepare_response_body(task) if task.course_score else None
+        self.db.update_task_status(self.task_id, Task.SUCCESS, response=response)
+        self.db.remove()
+
+    def add_data_to_db(self):
+        from portal.items import CourseScoreItem, AttendanceItem
+
+        self.db.create_task(self.task_id)
+        course_score_items = [i for i in self.items if isinstance(i, CourseScoreItem)]
+        attendance_items = [i for i in self.items if isinstance(i, AttendanceItem)]
+        self.db.add_bulk_data(self.task_id, course_score_items, attendance_items)
+        self.items = []
+
+
+class Spider:
+    def __init__(self, settings, courses_total):
+        self.settings = settings
+        self.courses_total = courses_total
+        self.logger = logging.getLogger("bench")
+
+
+def spider_items(data):
+    # profile first, then the marks and attendance of one course after another,
+    # each page followed by its CoursePageItem
+    from portal.items import StudentProfileItem, CourseScoreItem, AttendanceItem, CoursePageItem
+
+    profile, scores, attendance = data.scraped_items()
+    yield StudentProfileItem(**profile)
+    for course in data.courses:
+        course_id = course["course_id"]
+        marks = [CourseScoreItem(**row) for row in scores if row["course_id"] == course_id]
+        classes = [AttendanceItem(**row) for row in attendance if row["course_id"] == course_id]
+        yield marks + [CoursePageItem(course_id=course_id, page="marks", fingerprint="", rows=len(marks), changed=True)] + \
+            classes + [CoursePageItem(course_id=course_id, page="attendance", fingerprint="", rows=len(classes), changed=True)]
+
+
+def run(pipeline_class, data, n_tasks, course_delay):
+    from scrapy.utils.project import get_project_settings
+    from database import DataBase
+
+    commits = []
+
+    def count_commit(conn):
+        commits.append(1)
+
+    db = DataBase()
+    engine = db.session.get_bind()
+    event.listen(engine, "commit", count_commit)
+    started = time.perf_counter()
+    for n in range(n_tasks):
+        settings = get_project_settings()
+        settings.set("SESSION_ID", "%s-%d" % (pipeline_class.__name__, n))
+        spider = Spider(settings, len(data.courses))
+        pipeline = pipeline_class()
+        pipeline.open_spider(spider)
+        for items in spider_items(data):
+            for item in items if isinstance(items, list) else [items]:
+                pipeline.process_item(item, spider)
+            time.sleep(course_delay)
+        pipeline.close_spider(spider)
+    elapsed = time.perf_counter() - started - course_delay * (len(data.courses) + 1) * n_tasks
+    event.remove(engine, "commit", count_commit)
+    return len(commits) / n_tasks, elapsed / n_tasks * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--courses", type=int, default=6)
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--attendance", type=int, default=30)
+    parser.add_argument("--course-delay", type=float, default=0.0,
+                        help="seconds between courses, like the portal's response time")
+    args = parser.parse_args()
+
+    from portal.pipelines import PortalPipeline
+
+    data = PortalData.generate(args.courses, args.rows, args.attendance)
+    rows = []
+    with workdir():
+        for name, pipeline_class in [("legacy", LegacyPipeline), ("PortalPipeline", PortalPipeline)]:
+            commits, ms = run(pipeline_class, data, args.tasks, args.course_delay)
+            rows.append([name, "%.1f" % commits, "%.1f" % ms])
+    print("%d score + %d attendance rows per task" % (data.n_score_rows, data.n_attendance_rows))
+    print_table(rows, ["pipeline", "commits/task", "ms/task"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Golden check and benchmark for response.prepare_response.
+
+The response built from demo.json's rows has to be exactly demo.json. When
+pandas is installed the old DataFrame implementation is timed as well and
+compared against on generated data.
+
+    python benchmarks/bench_prepare_response.py --courses 8 --rows 40
+"""
+from common import print_table
+
+import statistics
+import tracemalloc
+import argparse
+import json
+import time
+import sys
+
+from fake_portal import PortalData, DEMO_FILE
+
+
+def load_task(data, task_id):
+    from database import DataBase
+
+    db = DataBase("sqlite://")
+    profile, scores, attendance = data.scraped_items()
+    db.create_task(task_id)
+    db.add_student_profile_data(task_id, profile)
+    db.add_bulk_data(task_id, scores, attendance)
+    task = db.get_task(task_id)
+    # loading the relationships once, only the aggregation is measured
+    task.course_score, task.attendance, task.student_profile
+    return task
+
+
+def pandas_prepare_response(task):
+    # prepare_response as it was before response.py, kept for comparison
+    import pandas as pd
+
+    profile_data = task.student_profile.to_dict()
+    score_data = [i.to_dict() for i in task.course_score]
+    attendace_data = sorted(task.attendance, key=lambda x: x.start_time)
+    attendance_data = [i.to_dict() for i in attendace_data]
+    attendance_df = pd.DataFrame(attendance_data)
+    course_score_df = pd.DataFrame(score_data)
+    for col in ["marks", "total_marks"]:
+        course_score_df[col] = course_score_df[col].apply(float)
+    response = {
+        "profileData": profile_data,
+        "courseIds": course_score_df["course_id"].unique().tolist(),
+        "coursesData": {},
+    }
+    for course_id, course_df in course_score_df.groupby("course_id"):
+        attendance_obj = {"attendanceData": []}
+        response["coursesData"][course_id] = {"courseScore": {}}
+        course_attendance_df = attendance_df[attendance_df["course_id"] == course_id]
+        attendance_obj["overview"] = {
+            "total": course_attendance_df.shape[0],
+            "present": course_attendance_df[course_attendance_df["attended"] == True].shape[0],
+            "absent": course_attendance_df[course_attendance_df["attended"] == False].shape[0],
+        }
+        for attendance_type, attendance_type_df in course_attendance_df.groupby("attendance_type"):
+            attendance_obj["attendanceData"].append({
+                "attendanceType": attendance_type,
+                "total": attendance_type_df.shape[0],
+                "present": attendance_type_df[attendance_type_df["attended"] == True].shape[0],
+                "absent": attendance_type_df[attendance_type_df["attended"] == False].shape[0],
+                "attendance": attendance_type_df.to_dict(orient="records"),
+            })
+        response["coursesData"][course_id]["attendance"] = attendance_obj
+        response["coursesData"][course_id]["overview"] = {
+            "totalMarks": course_df["total_marks"].sum(),
+            "marks": course_df["marks"].sum(),
+            "percentage": round(((course_df["marks"].sum() / course_df["total_marks"].sum()) * 100), 2),
+        }
+        for section_title, section_df in course_df.groupby("section_title"):
+            total_marks = section_df["total_marks"].sum()
+            marks = section_df["marks"].sum()
+            response["coursesData"][course_id]["courseScore"][section_title] = {
+                "totalMarks": total_marks,
+                "marks": marks,
+                "percentage": round(((marks / total_marks) * 100), 2),
+                "data": section_df.to_dict(orient="records"),
+            }
+    return response
+
+
+def comparable(response):
+    response = json.loads(json.dumps(response))
+    for key in ["columns", "courseInfoColumns", "columnsTitles"]:
+        response.pop(key, None)
+    return response
+
+
+def measure(prepare, task, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        prepare(task)
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    prepare(task)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(timings), max(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--courses", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=40)
+    parser.add_argument("--attendance", type=int, default=60)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    from response import prepare_response
+
+    with open(DEMO_FILE) as f:
+        demo = json.load(f)
+    demo_task = load_task(PortalData.from_demo(), "demo")
+    golden = json.loads(json.dumps(prepare_response(demo_task))) == demo
+    print("demo.json golden check:", "ok" if golden else "FAILED")
+
+    implementations = [("single pass", prepare_response)]
+    try:
+        import pandas  # noqa: F401
+        implementations.append(("pandas", pandas_prepare_response))
+    except ImportError:
+        print("pandas is not installed, only timing the single pass builder")
+
+    generated_task = load_task(PortalData.generate(args.courses, args.rows, args.attendance), "generated")
+    if len(implementations) > 1:
+        same = all(
+            comparable(prepare_response(task)) == comparable(pandas_prepare_response(task))
+            for task in [demo_task, generated_task]
+        )
+        print("same output as pandas:", "ok" if same else "FAILED")
+
+    rows = []
+    for data_name, task in [("demo.json", demo_task), ("generated", generated_task)]:
+        for name, prepare in implementations:
+            median, worst, peak = measure(prepare, task, args.iterations)
+            rows.append([data_name, name, "%.3f" % (median * 1000), "%.3f" % (worst * 1000),
+                         "%.1f" % (peak / 1024)])
+    print_table(rows, ["data", "implementation", "median ms", "max ms", "peak KiB"])
+    if not golden:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Records one crawl of the fake portal with REPLAY_MODE=record, stops the
+portal and replays the recording for many tasks through ScrapePool, with
+and without injected latency. Shows the tasks/sec and seconds per task
+of the scrape path with no network, and checks every replayed task stored
+the same response as the recorded crawl.
+
+    python benchmarks/bench_replay.py --tasks 40 --latency 0.2
+"""
+from common import workdir, print_table
+
+from multiprocessing import Process
+import argparse
+import sqlite3
+import time
+import os
+
+from fake_portal import FakePortal, PortalData
+
+
+def task_rows(pattern):
+    with sqlite3.connect("tasks_db____.db") as conn:
+        return conn.execute(
+            "SELECT task_id, status, response_etag, julianday(updated_at) - julianday(created_at)"
+            " FROM task WHERE task_id LIKE ? AND status IN ('SUCCESS', 'FAILED')", (pattern,)
+        ).fetchall()
+
+
+def record(portal_url, session_id):
+    os.environ.update(PORTAL_URL=portal_url, REPLAY_MODE="record")
+    from run import start_scraper
+    start_scraper(session_id)
+
+
+def replay(prefix, n_tasks, workers, crawls, latency, timeout=600):
+    os.environ.update(REPLAY_MODE="replay", REPLAY_SESSION="recorded", REPLAY_LATENCY=str(latency))
+    from scrape_pool import ScrapePool
+
+    pool = ScrapePool(workers=workers, queue_size=n_tasks, crawls_per_worker=crawls)
+    pool.start()
+    # reactor and scrapy startup happen here, once per worker
+    time.sleep(2)
+    started = time.monotonic()
+    for i in range(n_tasks):
+        pool.submit("%s-%d" % (prefix, i))
+    deadline = started + timeout
+    while len(task_rows(prefix + "-%")) < n_tasks:
+        if time.monotonic() > deadline:
+            raise TimeoutError("only %d of %d tasks finished" % (len(task_rows(prefix + "-%")), n_tasks))
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    pool.close()
+    return elapsed, task_rows(prefix + "-%")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--crawls", type=int, default=8, help="concurrent crawls per worker")
+    parser.add_argument("--latency", type=float, default=0.2, help="injected latency in seconds")
+    args = parser.parse_args()
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    rows = []
+    with workdir() as path:
+        os.environ["REPLAY_DIR"] = os.path.join(path, "fixtures")
+        from database import DataBase
+        # creating the schema up front, concurrent create_all calls race
+        DataBase()
+
+        portal = FakePortal(PortalData.from_demo(), latency=args.latency).start()
+        process = Process(target=record, args=(portal.url, "recorded"))
+        process.start()
+        process.join()
+        portal.stop()
+        (_, status, reference, _), = task_rows("recorded")
+        blobs = sum(len(files) for _, _, files in os.walk(os.path.join(path, "fixtures", "blobs")))
+        print("recorded crawl: %s, %d bodies stored, portal stopped" % (status, blobs))
+
+        for latency in [args.latency, 0]:
+            prefix = "replay-%dms" % (latency * 1000)
+            elapsed, results = replay(prefix, args.tasks, args.workers, args.crawls, latency)
+            same = sum(1 for _, status, etag, _ in results if status == "SUCCESS" and etag == reference)
+            per_task = sum(days for _, _, _, days in results) / len(results) * 86400
+            rows.append(["%.0f ms" % (latency * 1000), "%d/%d" % (same, args.tasks),
+                         "%.2f" % (args.tasks / elapsed), "%.2f" % per_task])
+
+    print_table(rows, ["injected latency", "same response", "tasks/sec", "seconds/task"])
+
+
+if __name__ == "__main__":
+    main()
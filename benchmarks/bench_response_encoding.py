@@ -0,0 +1,84 @@
+"""
+Bytes on the wire and encode time of a /taskdata response built from
+demo.json: the full and the compact (?shape=compact) shape, sent as is,
+gzipped and brotli compressed (when brotli is installed), and the time to
+serialize it with the standard library json module and with orjson.
+
+    python benchmarks/bench_response_encoding.py --repeat 200
+"""
+from common import workdir, print_table
+
+import argparse
+import json
+import time
+
+from fake_portal import DEMO_FILE
+
+
+def encode_time(dumps, obj, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        dumps(obj)
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    from response import compact_response
+    from static_response import compress, encodings
+    from task import Task
+    import json_encoding
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(DEMO_FILE, "r") as f:
+        data = json.load(f)
+    shapes = [("full", data), ("compact", compact_response(data))]
+
+    encoders = [("json", lambda obj: json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8"))]
+    if json_encoding.orjson is not None:
+        orjson = json_encoding.orjson
+        encoders.append(("orjson", lambda obj: orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)))
+
+    rows = []
+    for shape, shape_data in shapes:
+        body = {"status": Task.SUCCESS, "data": shape_data,
+                "message": "Task completed successfully", "taskCompleted": True}
+        for encoder, dumps in encoders:
+            encoded = dumps(body)
+            row = [shape, encoder, "%.3f" % encode_time(dumps, body, args.repeat), len(encoded)]
+            for encoding in ["gzip", "br"]:
+                row.append(len(compress(encoded, encoding)) if encoding in encodings() else "-")
+            rows.append(row)
+
+    print_table(rows, ["shape", "encoder", "encode ms", "identity bytes", "gzip bytes", "br bytes"])
+
+    # the same through the API, with the after_request compression
+    with workdir():
+        from app import app, db
+        from response import prepare_response_body
+        from fake_portal import PortalData
+
+        profile, scores, attendance = PortalData.from_demo().scraped_items()
+        for position, row in enumerate(scores):
+            row["position"] = position
+        db.create_task("demo")
+        db.write_batch("demo", profile=profile, course_score_data=scores, attendance_data=attendance)
+        task = db.get_task("demo")
+        db.update_task_status("demo", Task.SUCCESS, response=prepare_response_body(task))
+        key = db.get_task("demo").key
+
+        client = app.test_client()
+        rows = []
+        for shape in ["full", "compact"]:
+            for accept in ["identity", "gzip"]:
+                response = client.get("/taskdata/demo?key=%s&shape=%s" % (key, shape),
+                                      headers={"Accept-Encoding": accept})
+                rows.append([shape, accept, response.headers.get("Content-Encoding", "-"), len(response.data)])
+        print()
+        print_table(rows, ["/taskdata shape", "accept", "content-encoding", "bytes"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Retention sweep over a database of old tasks: time of the sweep, size of
+the sqlite file before and after it, and the worst task lookup latency
+seen by a reader while the sweep runs.
+
+    python benchmarks/bench_retention.py --tasks 50000 --expired 0.8
+"""
+from common import workdir, print_table
+
+from datetime import datetime, timedelta
+import threading
+import argparse
+import random
+import time
+import os
+
+from sqlalchemy import insert
+
+
+def populate(db, n_tasks, n_rows, expired):
+    from database import Task, CourseScore, Attendance
+
+    now = datetime.utcnow()
+    old = now - timedelta(days=30)
+    for start in range(0, n_tasks, 5000):
+        task_ids = ["session-%d" % i for i in range(start, min(start + 5000, n_tasks))]
+        db.session.execute(insert(Task.__table__), [
+            {"task_id": task_id, "key": "key-" + task_id, "status": "SUCCESS",
+             "updated_at": old if random.random() < expired else now}
+            for task_id in task_ids
+        ])
+        db.session.execute(insert(CourseScore.__table__), [
+            {"task_id": task_id, "course_id": "CSC%d" % (n % 5), "title": "Quiz %d" % n,
+             "marks": "1", "total_marks": "2", "datetime": now}
+            for task_id in task_ids for n in range(n_rows)
+        ])
+        db.session.execute(insert(Attendance.__table__), [
+            {"task_id": task_id, "course_id": "CSC%d" % (n % 5), "attended": True,
+             "start_time": now, "end_time": now}
+            for task_id in task_ids for n in range(n_rows)
+        ])
+        db.session.commit()
+    db.remove()
+
+
+def db_size(path):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path) if name.startswith("tasks_db"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=50000)
+    parser.add_argument("--rows", type=int, default=10, help="score and attendance rows per task")
+    parser.add_argument("--expired", type=float, default=0.8, help="share of tasks past their ttl")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    from database import DataBase
+    from retention import RetentionSweeper
+
+    with workdir() as path:
+        db = DataBase()
+        populate(db, args.tasks, args.rows, args.expired)
+        size_before = db_size(path)
+
+        stop = threading.Event()
+        latencies = []
+
+        def reader():
+            reader_db = DataBase()
+            while not stop.is_set():
+                started = time.perf_counter()
+                reader_db.get_task("session-%d" % random.randrange(args.tasks))
+                reader_db.remove()
+                latencies.append(time.perf_counter() - started)
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        sweeper = RetentionSweeper(db, batch_size=args.batch_size, vacuum_pages=10 ** 9)
+        started = time.perf_counter()
+        deleted = sweeper.sweep()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        thread.join()
+        size_after = db_size(path)
+
+    print_table([[
+        deleted, sweeper.stats["rowsDeleted"], "%.2f" % elapsed,
+        "%.1f" % (size_before / 2 ** 20), "%.1f" % (size_after / 2 ** 20),
+        "%.1f" % (max(latencies) * 1000),
+    ]], ["tasks deleted", "rows deleted", "sweep s", "db MB before", "db MB after", "max lookup ms"])
+
+
+if __name__ == "__main__":
+    main()
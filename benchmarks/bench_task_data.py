@@ -0,0 +1,81 @@
+"""
+Reading a finished task's data to build its response: the ORM path
+(task.course_score, task.student_profile and task.attendance lazy loaded,
+to_dict on every row) against DataBase.get_task_data (one Core select per
+table, plain tuples, each distinct date formatted once). Counts the SQL
+statements and times every read with a new session, as a request would.
+Fails if the two don't build the same response body.
+
+    python benchmarks/bench_task_data.py --courses 8 --rows 40 --attendance 60
+"""
+from common import workdir, print_table
+
+import statistics
+import argparse
+import time
+
+from sqlalchemy import event
+
+from fake_portal import PortalData
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--courses", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=40)
+    parser.add_argument("--attendance", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with workdir():
+        from database import DataBase
+        from response import prepare_response_body, task_response_body
+
+        datasets = [("demo.json", PortalData.from_demo()),
+                    ("generated", PortalData.generate(args.courses, args.rows, args.attendance))]
+        db = DataBase()
+        for name, data in datasets:
+            profile, scores, attendance = data.scraped_items()
+            for position, row in enumerate(scores):
+                row["position"] = position
+            db.create_task(name)
+            db.write_batch(name, profile=profile, course_score_data=scores, attendance_data=attendance)
+        db.remove()
+
+        statements = []
+        event.listen(db.session.get_bind(), "before_cursor_execute", lambda *args: statements.append(1))
+
+        def orm(task_id):
+            db = DataBase()
+            task = db.get_task(task_id)
+            body = prepare_response_body(task) if task.course_score else None
+            db.remove()
+            return body
+
+        def core(task_id):
+            db = DataBase()
+            task_data = db.get_task_data(task_id)
+            body = task_response_body(task_data) if task_data[1] else None
+            db.remove()
+            return body
+
+        rows = []
+        for name, data in datasets:
+            reference = orm(name)
+            for read_name, read in [("ORM, lazy loads", orm), ("Core, get_task_data", core)]:
+                if read(name) != reference:
+                    raise SystemExit("%s built a different response for %s" % (read_name, name))
+                del statements[:]
+                times = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    read(name)
+                    times.append(time.perf_counter() - started)
+                rows.append([name, read_name, "%.1f" % (len(statements) / args.repeat),
+                             "%.2f" % (statistics.median(times) * 1000)])
+
+    print_table(rows, ["data", "read", "queries/request", "median ms"])
+
+
+if __name__ == "__main__":
+    main()
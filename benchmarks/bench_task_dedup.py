@@ -0,0 +1,104 @@
+"""
+Duplicate submissions: every session is POSTed several times at once
+(double clicks, several tabs), then once more after it finished. Counts the
+crawls started and the portal requests made, with single flight
+submissions and result reuse (the defaults) and with both turned off, which
+is how create_task behaved before.
+
+    python benchmarks/bench_task_dedup.py --sessions 10 --duplicates 5
+"""
+from common import workdir, print_table
+
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import argparse
+import json
+import time
+import sys
+import os
+
+from fake_portal import FakePortal
+
+
+CONFIGS = [
+    ("single flight + 300s result ttl", {}),
+    ("off (scrape every submission)", {"RESULT_TTL": "0", "RUNNING_TASK_TIMEOUT": "0"}),
+]
+
+
+def submit(app, session_ids):
+    client = app.test_client()
+    return [client.post("/task/", json={"sessionId": session_id}).status_code for session_id in session_ids]
+
+
+def wait_idle(scrape_pool, timeout=600):
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = scrape_pool.stats()
+        if stats["activeCrawls"] == 0 and stats["queueDepth"] == 0:
+            return
+        if time.monotonic() > deadline:
+            raise TimeoutError(stats)
+        time.sleep(0.1)
+
+
+def child(args):
+    portal = FakePortal(latency=args.latency).start()
+    os.environ["PORTAL_URL"] = portal.url
+    with workdir():
+        from app import app, scrape_pool, start
+        start()
+
+        scrape_pool.queue_size = args.sessions * args.duplicates
+        scrape_pool.start()
+        time.sleep(2)
+        sessions = ["session-%d" % i for i in range(args.sessions)]
+        started = time.monotonic()
+        with ThreadPoolExecutor(args.sessions * args.duplicates) as executor:
+            list(executor.map(lambda session_id: submit(app, [session_id]), sessions * args.duplicates))
+        # the first crawls only count once they are running
+        time.sleep(0.5)
+        wait_idle(scrape_pool)
+        submit(app, sessions)
+        wait_idle(scrape_pool)
+        elapsed = time.monotonic() - started
+
+        statuses = [app.test_client().get("/task/" + session_id).json["status"] for session_id in sessions]
+        scrape_pool.close()
+    portal.stop()
+    print(json.dumps({
+        "submissions": len(sessions) * (args.duplicates + 1),
+        "crawls": portal.requests["/"],
+        "portal_requests": sum(portal.requests.values()),
+        "succeeded": statuses.count("SUCCESS"),
+        "seconds": elapsed,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--duplicates", type=int, default=5, help="concurrent submissions per session")
+    parser.add_argument("--latency", type=float, default=0.1, help="portal latency in seconds")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    rows = []
+    for name, env in CONFIGS:
+        # the ttls are read at import, so every config runs in its own interpreter
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", "--sessions", str(args.sessions),
+             "--duplicates", str(args.duplicates), "--latency", str(args.latency)],
+            env=dict(os.environ, LOG_LEVEL="WARNING", **env), capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        rows.append([name, result["submissions"], result["crawls"], result["portal_requests"],
+                     "%d/%d" % (result["succeeded"], args.sessions), "%.1f" % result["seconds"]])
+
+    print_table(rows, ["submissions", "posts", "crawls", "portal requests", "succeeded", "seconds"])
+
+
+if __name__ == "__main__":
+    main()
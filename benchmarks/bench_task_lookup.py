@@ -0,0 +1,96 @@
+"""
+Task lookups on a database holding many historical tasks, with the task_id
+indexes and without them (as databases were before), plus the cost of
+create_task's old full scan of existing keys.
+
+    python benchmarks/bench_task_lookup.py --tasks 100000
+"""
+from common import workdir, print_table
+
+import statistics
+import argparse
+import random
+import time
+
+from sqlalchemy import insert, text
+
+
+def populate(db, n_tasks, n_rows):
+    from database import Task, CourseScore, Attendance
+    from datetime import datetime
+
+    now = datetime.now()
+    for start in range(0, n_tasks, 5000):
+        task_ids = ["session-%d" % i for i in range(start, min(start + 5000, n_tasks))]
+        db.session.execute(insert(Task.__table__), [
+            {"task_id": task_id, "key": "key-" + task_id, "status": "SUCCESS"} for task_id in task_ids
+        ])
+        db.session.execute(insert(CourseScore.__table__), [
+            {"task_id": task_id, "course_id": "CSC%d" % (n % 5), "marks": "1", "total_marks": "2",
+             "datetime": now}
+            for task_id in task_ids for n in range(n_rows)
+        ])
+        db.session.execute(insert(Attendance.__table__), [
+            {"task_id": task_id, "course_id": "CSC%d" % (n % 5), "attended": True,
+             "start_time": now, "end_time": now}
+            for task_id in task_ids for n in range(n_rows)
+        ])
+        db.session.commit()
+
+
+def timed(fn, samples):
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return "%.3f" % (statistics.median(timings) * 1000)
+
+
+def measure(db, n_tasks, samples):
+    def get_task():
+        db.get_task("session-%d" % random.randrange(n_tasks))
+        db.remove()
+
+    def load_relationships():
+        task = db.get_task("session-%d" % random.randrange(n_tasks))
+        task.course_score, task.attendance, task.student_profile
+        db.remove()
+
+    return [timed(get_task, samples), timed(load_relationships, samples)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=100000)
+    parser.add_argument("--rows", type=int, default=5, help="score and attendance rows per task")
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+
+    from database import DataBase, Task
+
+    with workdir():
+        db = DataBase()
+        started = time.perf_counter()
+        populate(db, args.tasks, args.rows)
+        print("populated %d tasks in %.1fs" % (args.tasks, time.perf_counter() - started))
+
+        rows = [["indexed"] + measure(db, args.tasks, args.samples)]
+        n = iter(range(10 ** 9))
+        create_task = timed(lambda: db.create_task("new-%d" % next(n)), args.samples)
+        legacy_key_scan = timed(lambda: [task.key for task in db.session.query(Task).all()], 3)
+        db.remove()
+
+        with db.session.begin():
+            for index in ["ix_task_task_id", "ix_course_score_task_id_course_id",
+                          "ix_attendance_task_id_course_id", "ix_student_profile_task_id"]:
+                db.session.execute(text("DROP INDEX %s" % index))
+        db.remove()
+        rows.append(["no task_id indexes"] + measure(db, args.tasks, args.samples))
+
+    print_table(rows, ["schema", "get_task ms", "get_task + relationships ms"])
+    print("create_task: %s ms, old existing-keys scan alone: %s ms" % (create_task, legacy_key_scan))
+
+
+if __name__ == "__main__":
+    main()
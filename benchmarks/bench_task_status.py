@@ -0,0 +1,66 @@
+"""
+Cost of a status poll: GET /taskdata/<id> for a running task, against
+GET /task/<id> answered from the database (status cache miss) and from the
+status cache, for a running task and one waiting in the queue, with the
+number of SQL statements each request runs.
+
+    python benchmarks/bench_task_status.py --requests 2000
+"""
+from common import workdir, print_table
+
+import argparse
+import time
+
+from sqlalchemy import event
+
+
+def measure(client, url, n_requests, before=None):
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    from app import db
+    engine = db.session.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    started = time.perf_counter()
+    for _ in range(n_requests):
+        if before:
+            before()
+        response = client.get(url)
+        assert response.status_code == 200, response.json
+    elapsed = time.perf_counter() - started
+    event.remove(engine, "before_cursor_execute", count)
+    return ["%.3f" % (elapsed / n_requests * 1000), "%.1f" % (len(statements) / n_requests)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    with workdir():
+        from app import app, db, task_events, scrape_pool
+        from task import Task
+
+        key = db.create_task("session")
+        db.update_task_status("session", Task.IN_PROGRESS)
+        db.create_task("queued")
+        db.update_task_status("queued", Task.STARTED)
+        scrape_pool.dispatcher.submit("queued")
+        db.remove()
+        client = app.test_client()
+
+        rows = [
+            ["/taskdata (running task)"] + measure(client, "/taskdata/session?key=" + key, args.requests),
+            ["/task, cache miss"] + measure(client, "/task/session", args.requests,
+                                            before=lambda: task_events.forget(["session"])),
+            ["/task, cached"] + measure(client, "/task/session", args.requests),
+            ["/task, cached, queued task"] + measure(client, "/task/queued", args.requests),
+        ]
+
+    print_table(rows, ["request", "ms/request", "sql statements/request"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Requests per completed task for clients waiting on /taskdata by polling it
+at a fixed interval, by long polling it (?wait=) and by following the
+/taskdata/<id>/events stream, against the API with a real ScrapePool
+crawling the local fake portal.
+
+    python benchmarks/bench_task_wait.py --tasks 20 --latency 0.2 --interval 0.5
+"""
+from common import workdir, print_table
+
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import threading
+import argparse
+import logging
+import time
+import os
+
+import requests
+from werkzeug.serving import make_server
+
+from fake_portal import FakePortal
+
+
+def poll(base, task_id, key, interval):
+    n = 0
+    while True:
+        n += 1
+        body = requests.get("%s/taskdata/%s" % (base, task_id), params={"key": key}).json()
+        if body["status"] != "IN PROGRESS" and body["status"] != "STARTED":
+            return n, body["status"]
+        time.sleep(interval)
+
+
+def long_poll(base, task_id, key, interval):
+    n = 0
+    while True:
+        n += 1
+        body = requests.get("%s/taskdata/%s" % (base, task_id), params={"key": key, "wait": 30}).json()
+        if body["status"] != "IN PROGRESS" and body["status"] != "STARTED":
+            return n, body["status"]
+
+
+def event_stream(base, task_id, key, interval):
+    with requests.get("%s/taskdata/%s/events" % (base, task_id), params={"key": key}, stream=True) as r:
+        for line in r.iter_lines(decode_unicode=True):
+            if line.startswith("data:") and ('"SUCCESS"' in line or '"FAILED"' in line):
+                break
+    body = requests.get("%s/taskdata/%s" % (base, task_id), params={"key": key}).json()
+    return 2, body["status"]
+
+
+def client(base, wait, session_id, interval):
+    started = time.monotonic()
+    r = requests.post(base + "/task/", json={"sessionId": session_id})
+    task = r.json()
+    n, status = wait(base, task["task_id"], task["key"], interval)
+    return n + 1, status, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2, help="portal latency in seconds")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between plain polls")
+    args = parser.parse_args()
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    portal = FakePortal(latency=args.latency).start()
+    os.environ["PORTAL_URL"] = portal.url
+    rows = []
+    with workdir():
+        from app import app, scrape_pool, start
+        start()
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:%d" % server.server_port
+        scrape_pool.start()
+        # reactor and scrapy startup of the workers
+        time.sleep(2)
+
+        for name, wait in [("poll every %gs" % args.interval, poll), ("long poll", long_poll),
+                           ("event stream", event_stream)]:
+            with ThreadPoolExecutor(args.tasks) as executor:
+                results = list(executor.map(
+                    lambda i: client(base, wait, "%s-%d" % (wait.__name__, i), args.interval),
+                    range(args.tasks)))
+            requests_per_task = statistics.mean(n for n, _, _ in results)
+            succeeded = sum(1 for _, status, _ in results if status == "SUCCESS")
+            rows.append([name, "%d/%d" % (succeeded, args.tasks), "%.1f" % requests_per_task,
+                         "%.2f" % statistics.mean(t for _, _, t in results)])
+
+        server.shutdown()
+        scrape_pool.close()
+    portal.stop()
+    print_table(rows, ["client", "succeeded", "requests/task", "seconds to result"])
+
+
+if __name__ == "__main__":
+    main()
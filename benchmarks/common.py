@@ -0,0 +1,37 @@
+import contextlib
+import tempfile
+import json
+import sys
+import os
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault("SCRAPY_SETTINGS_MODULE", "portal.settings")
+# set by run_suite.py: every table printed is saved there as well, one json
+# line each
+BENCH_RESULTS = os.environ.get("BENCH_RESULTS")
+
+
+@contextlib.contextmanager
+def workdir():
+    # the app and the pipeline keep their sqlite file in the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(cwd)
+
+
+def print_table(rows, headers):
+    widths = [max(len(str(v)) for v in column) for column in zip(headers, *rows)]
+    for row in [headers] + rows:
+        print("  ".join(str(v).ljust(w) for v, w in zip(row, widths)))
+    if BENCH_RESULTS:
+        with open(BENCH_RESULTS, "a") as f:
+            f.write(json.dumps({"headers": [str(v) for v in headers],
+                                "rows": [[str(v) for v in row] for row in rows]}) + "\n")
@@ -0,0 +1,401 @@
+"""
+Local stand-in for the atk-cms student portal.
+
+Serves Courses/MarksSummary/Attendance/Profile pages with the markup the
+spider expects, either for the student in demo.json or for generated data.
+Like the real portal, the selected course is kept in server side session
+state (keyed by the ASP.NET_SessionId cookie), so MarksSummary and Attendance
+return whichever course was set last for that session. With
+course_state="cookie" the selection is kept in a cookie instead, which models
+a portal where every cookiejar has its own course context. With a capacity,
+more concurrent requests than that slow every request down in proportion,
+and past twice the capacity the portal answers 503. With course_titles=False
+the MarksSummary and Attendance pages don't name their course.
+
+    portal = FakePortal(PortalData.from_demo(), latency=0.05).start()
+    settings["PORTAL_URL"] = portal.url
+"""
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime
+from html import escape
+import collections
+import threading
+import random
+import json
+import time
+import os
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEMO_FILE = os.path.join(ROOT_DIR, "demo.json")
+
+
+def portal_date(value, with_time=False):
+    # the portal renders dates the way ASP.NET does by default (en-US)
+    if with_time:
+        value = datetime.strptime(value, "%d-%m-%Y %I:%M %p")
+        return "{d.month}/{d.day}/{d.year} {hour}:{d:%M:%S %p}".format(
+            d=value, hour=value.hour % 12 or 12)
+    value = datetime.strptime(value, "%d-%m-%Y")
+    return "{d.month}/{d.day}/{d.year}".format(d=value)
+
+
+def portal_number(value):
+    return value if isinstance(value, str) else "%g" % value
+
+
+class PortalData:
+    def __init__(self, profile, courses):
+        # courses: list of dicts with course_id, course_name, credit_hours,
+        # teacher, sections ({title: [(title, marks, total_marks, date)]})
+        # and attendance ({"Class"/"Lab": [(topic, status, start, end)]})
+        self.profile = profile
+        self.courses = courses
+        self.by_id = {course["course_id"]: course for course in courses}
+
+    @classmethod
+    def from_demo(cls, path=DEMO_FILE):
+        with open(path, "r") as f:
+            demo = json.load(f)
+
+        courses = []
+        for course_id in demo["courseIds"]:
+            course_data = demo["coursesData"][course_id]
+            sections = {}
+            info = None
+            for section_title, section in course_data["courseScore"].items():
+                sections[section_title] = [
+                    (row["title"], portal_number(row["marks"]),
+                     portal_number(row["total_marks"]), portal_date(row["datetime"]))
+                    for row in section["data"]
+                ]
+                info = section["data"][0]
+            attendance = {}
+            for attendance_type in course_data["attendance"]["attendanceData"]:
+                attendance[attendance_type["attendanceType"].capitalize()] = [
+                    (row["topic"], "Present" if row["attended"] else "Absent",
+                     portal_date(row["start_time"], True), portal_date(row["end_time"], True))
+                    for row in attendance_type["attendance"]
+                ]
+            courses.append({
+                "course_id": course_id,
+                "course_name": info["course_name"],
+                "credit_hours": info["credit_hours"],
+                "teacher": info["teacher"],
+                "sections": sections,
+                "attendance": attendance,
+            })
+
+        profile = {
+            "name": demo["profileData"]["studentName"],
+            "registration_number": demo["profileData"]["registrationNumber"],
+        }
+        return cls(profile, courses)
+
+    @classmethod
+    def generate(cls, courses=6, rows=20, attendance=30, seed=0):
+        rnd = random.Random(seed)
+        section_titles = ["Assignments", "Quizzes", "Midterm Marks", "Final"]
+        generated = []
+        for n in range(courses):
+            sections = collections.defaultdict(list)
+            for i in range(rows):
+                section_title = section_titles[i % len(section_titles)]
+                total = rnd.choice([5, 10, 15, 25, 50])
+                sections[section_title].append((
+                    "%s%d" % (section_title[:6], i + 1),
+                    "%g" % (rnd.randint(0, total * 2) / 2),
+                    str(total),
+                    "%d/%d/2023" % (rnd.randint(1, 12), rnd.randint(1, 28)),
+                ))
+            classes = {"Class": [], "Lab": []}
+            for i in range(attendance):
+                day = "%d/%d/2023" % (2 + i // 28, 1 + i % 28)
+                classes["Class" if i % 3 else "Lab"].append((
+                    "Lecture %d of course %d" % (i + 1, n + 1),
+                    "Present" if rnd.random() < 0.9 else "Absent",
+                    day + " 10:00:00 AM",
+                    day + " 11:30:00 AM",
+                ))
+            generated.append({
+                "course_id": "CSC%03d" % (100 + n),
+                "course_name": "Generated Course %d" % (n + 1),
+                "credit_hours": str(rnd.choice([2, 3, 4])),
+                "teacher": "Teacher %d" % (n + 1),
+                "sections": dict(sections),
+                "attendance": {k: v for k, v in classes.items() if v},
+            })
+        profile = {"name": "Generated Student", "registration_number": "CIIT/SP23-BSE-000/ATK"}
+        return cls(profile, generated)
+
+    def scraped_items(self):
+        # the items ComsatsEduPkSpider yields for this data, as plain dicts
+        scores, attendance = [], []
+        for course in self.courses:
+            for section_title, rows in course["sections"].items():
+                for title, marks, total_marks, date in rows:
+                    scores.append({
+                        "course_id": course["course_id"],
+                        "course_name": course["course_name"],
+                        "credit_hours": course["credit_hours"],
+                        "teacher": course["teacher"],
+                        "section_title": section_title,
+                        "title": title,
+                        "marks": marks,
+                        "total_marks": total_marks,
+                        "datetime": date,
+                    })
+            for attendance_type, rows in course["attendance"].items():
+                for topic, status, start_time, end_time in rows:
+                    attendance.append({
+                        "course_id": course["course_id"],
+                        "attendance_type": attendance_type.lower(),
+                        "topic": topic.strip(),
+                        "attended": "present" in status.lower(),
+                        "start_time": start_time,
+                        "end_time": end_time,
+                    })
+        return dict(self.profile), scores, attendance
+
+    @property
+    def n_score_rows(self):
+        return sum(len(rows) for c in self.courses for rows in c["sections"].values())
+
+    @property
+    def n_attendance_rows(self):
+        return sum(len(rows) for c in self.courses for rows in c["attendance"].values())
+
+
+def page(body):
+    return "<!DOCTYPE html><html><head><title>CUOnline</title></head><body>%s</body></html>" % body
+
+
+def render_courses(data):
+    rows = "".join(
+        "<tr onclick=\"window.location='/Courses/SetCourse?id={id}'\">"
+        "<td>{id}</td><td>{name}</td><td>{ch}</td><td>{teacher}</td></tr>".format(
+            id=escape(c["course_id"]), name=escape(c["course_name"]),
+            ch=escape(c["credit_hours"]), teacher=escape(c["teacher"]))
+        for c in data.courses
+    )
+    return page(
+        '<div id="RegisteredCourses"><table class="table">'
+        "<thead><tr><th>Code</th><th>Title</th><th>Credit Hours</th><th>Teacher</th></tr></thead>"
+        "<tbody>%s</tbody></table></div>" % rows
+    )
+
+
+def cell_html(value):
+    # razor views leave the cell content on its own line
+    return "<td>\n    %s\n</td>" % escape(value)
+
+
+def course_header(course):
+    return '<h3 class="course-title">%s - %s</h3>' % (
+        escape(course["course_id"]), escape(course["course_name"]))
+
+
+def render_marks(course, title=True):
+    parts = []
+    for section_title, rows in course["sections"].items():
+        body = "".join(
+            "<tr>%s</tr>" % "".join(cell_html(cell) for cell in row)
+            for row in rows
+        )
+        parts.append(
+            '<div class="quiz_title">%s</div>'
+            '<table class="table"><thead><tr><th>Title</th><th>Obtained</th>'
+            "<th>Total</th><th>Date</th></tr></thead><tbody>%s</tbody></table>"
+            % (escape(section_title), body)
+        )
+    return page((course_header(course) if title else "") + '<div class="quiz_listing">%s</div>' % "".join(parts))
+
+
+def render_attendance(course, title=True):
+    parts = []
+    for attendance_type, rows in course["attendance"].items():
+        body = "".join(
+            "<tr>%s</tr>" % "".join(cell_html(cell) for cell in row)
+            for row in rows
+        )
+        parts.append(
+            '<div id="%s"><div class="table-responsive"><table class="table">'
+            "<thead><tr><th>Topic</th><th>Status</th><th>Start</th><th>End</th></tr></thead>"
+            "<tbody>%s</tbody></table></div></div>" % (attendance_type, body)
+        )
+    return page((course_header(course) if title else "") + "".join(parts))
+
+
+def render_profile(profile):
+    return page(
+        '<div class="profile"><div>\n<label>Full Name</label>\n%s\n</div>'
+        "<div>\n<label>Registration Number</label>\n%s\n</div></div>"
+        % (escape(profile["name"]), escape(profile["registration_number"]))
+    )
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        portal = self.server.portal
+        url = urlparse(self.path)
+        portal.count(url.path)
+        load = portal.enter()
+        try:
+            if portal.capacity and load > 2 * portal.capacity:
+                portal.count("503")
+                return self.send_page(page("Service Unavailable"), 503)
+            if portal.latency:
+                time.sleep(portal.latency * max(1, load / portal.capacity) if portal.capacity else portal.latency)
+            self.respond(portal, url)
+        finally:
+            portal.leave()
+
+    def respond(self, portal, url):
+        session_id = self.session_id()
+        if not portal.is_valid_session(session_id):
+            if url.path == "/Login":
+                return self.send_page(page("<form id='login'></form>"))
+            return self.redirect("/Login")
+
+        if url.path == "/":
+            return self.redirect("/COURSEREGISTRATION/Index")
+        if url.path == "/COURSEREGISTRATION/Index":
+            return self.send_page(page("<h1>Course Registration</h1>"))
+        if url.path == "/Courses/Index":
+            return self.send_page(render_courses(portal.data))
+        if url.path == "/Courses/SetCourse":
+            course_id = parse_qs(url.query).get("id", [""])[0]
+            if course_id not in portal.data.by_id:
+                return self.send_page(page("Not Found"), 404)
+            portal.select_course(session_id, course_id)
+            headers = {}
+            if portal.course_state == "cookie":
+                headers["Set-Cookie"] = "SelectedCourse=%s; Path=/" % course_id
+            return self.send_page(page(course_header(portal.data.by_id[course_id])), headers=headers)
+        if url.path == "/Profile/Index":
+            return self.send_page(render_profile(portal.data.profile))
+
+        if portal.course_state == "cookie":
+            course = portal.data.by_id.get(self.cookie("SelectedCourse"))
+        else:
+            course = portal.selected_course(session_id)
+        if url.path == "/MarksSummary/Index":
+            return self.send_page(render_marks(course, portal.course_titles) if course else page(""))
+        if url.path == "/Attendance/Index":
+            return self.send_page(render_attendance(course, portal.course_titles) if course else page(""))
+        return self.send_page(page("Not Found"), 404)
+
+    def cookie(self, name):
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        morsel = cookie.get(name)
+        return morsel.value if morsel else None
+
+    def session_id(self):
+        return self.cookie("ASP.NET_SessionId")
+
+    def redirect(self, location):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_page(self, html, status=200, headers=None):
+        body = html.encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakePortal:
+    def __init__(self, data=None, latency=0.0, host="127.0.0.1", port=0, course_state="session", capacity=0,
+                 course_titles=True):
+        self.data = data or PortalData.from_demo()
+        self.latency = latency
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.course_state = course_state
+        self.course_titles = course_titles
+        self.address = (host, port)
+        self.requests = collections.Counter()
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def is_valid_session(self, session_id):
+        return bool(session_id) and not session_id.startswith("invalid")
+
+    def select_course(self, session_id, course_id):
+        with self._lock:
+            self.sessions[session_id] = course_id
+
+    def selected_course(self, session_id):
+        with self._lock:
+            course_id = self.sessions.get(session_id)
+        return self.data.by_id.get(course_id)
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] += 1
+
+    def enter(self):
+        # requests being served, this one included
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return self.in_flight
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def start(self):
+        self.server = ThreadingHTTPServer(self.address, PortalHandler)
+        self.server.daemon_threads = True
+        self.server.portal = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in of the student portal")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, default=0, help="concurrent requests served at full speed")
+    parser.add_argument("--course-state", choices=["session", "cookie"], default="session")
+    parser.add_argument("--courses", type=int, help="generate data instead of serving demo.json")
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--attendance", type=int, default=30)
+    args = parser.parse_args()
+
+    data = PortalData.generate(args.courses, args.rows, args.attendance) if args.courses else None
+    portal = FakePortal(data, latency=args.latency, port=args.port,
+                        course_state=args.course_state, capacity=args.capacity).start()
+    print("Serving fake portal on", portal.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        portal.stop()
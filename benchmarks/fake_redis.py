@@ -0,0 +1,254 @@
+"""
+Local stand-in of a redis server, for trying out the redis dispatch backend
+without one: speaks RESP and implements the commands dispatch.RedisDispatcher
+uses, with everything in memory. EVAL only runs the scripts of dispatch.py.
+
+    python benchmarks/fake_redis.py --port 6390
+"""
+import common  # puts the repository on sys.path
+
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+import collections
+import threading
+import bisect
+import time
+
+from dispatch import LEASE_SCRIPT
+
+
+class Error(Exception):
+    pass
+
+
+class FakeRedisHandler(StreamRequestHandler):
+    def handle(self):
+        redis = self.server.redis
+        while True:
+            try:
+                command = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if command is None:
+                return
+            name, args = command[0].upper(), command[1:]
+            if name == "SUBSCRIBE":
+                for n, channel in enumerate(args, start=1):
+                    redis.subscribe(channel, self)
+                    self.write(["subscribe", channel, n])
+                continue
+            try:
+                reply = redis.execute(name, args)
+            except Error as e:
+                reply = e
+            try:
+                self.write(reply)
+            except OSError:
+                # the client is gone
+                return
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.decode().split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2].decode("utf-8"))
+        return args
+
+    def write(self, reply):
+        with self.server.redis.lock:
+            self.wfile.write(encode(reply))
+
+    def finish(self):
+        self.server.redis.unsubscribe(self)
+        super().finish()
+
+
+def encode(reply):
+    if isinstance(reply, Error):
+        return b"-ERR %s\r\n" % str(reply).encode()
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool):
+        return b":%d\r\n" % reply
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
+    if reply == "OK" or reply == "PONG":
+        return b"+%s\r\n" % reply.encode()
+    data = str(reply).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class FakeRedisData:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.lists = collections.defaultdict(list)
+        self.zsets = collections.defaultdict(dict)
+        self.hashes = collections.defaultdict(dict)
+        self.subscribers = collections.defaultdict(list)
+        self.commands = collections.Counter()
+
+    def subscribe(self, channel, handler):
+        with self.lock:
+            self.subscribers[channel].append(handler)
+
+    def unsubscribe(self, handler):
+        with self.lock:
+            for handlers in self.subscribers.values():
+                if handler in handlers:
+                    handlers.remove(handler)
+
+    def execute(self, name, args):
+        with self.lock:
+            self.commands[name] += 1
+            method = getattr(self, "cmd_" + name.lower(), None)
+            if method is None:
+                raise Error("unknown command '%s'" % name)
+            return method(*args)
+
+    def cmd_ping(self):
+        return "PONG"
+
+    def cmd_select(self, database):
+        return "OK"
+
+    def cmd_flushdb(self):
+        self.lists.clear()
+        self.zsets.clear()
+        self.hashes.clear()
+        return "OK"
+
+    def cmd_rpush(self, key, *values):
+        self.lists[key].extend(values)
+        return len(self.lists[key])
+
+    def cmd_lpop(self, key):
+        values = self.lists.get(key)
+        return values.pop(0) if values else None
+
+    def cmd_llen(self, key):
+        return len(self.lists.get(key, ()))
+
+    def cmd_lpos(self, key, value):
+        values = self.lists.get(key, [])
+        return values.index(value) if value in values else None
+
+    def cmd_lrem(self, key, count, value):
+        values = self.lists.get(key, [])
+        kept = [v for v in values if v != value]
+        removed = len(values) - len(kept)
+        self.lists[key] = kept
+        return removed
+
+    def cmd_zadd(self, key, *args):
+        xx = args[0].upper() == "XX"
+        if xx:
+            args = args[1:]
+        zset = self.zsets[key]
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            if xx and member not in zset:
+                continue
+            added += member not in zset
+            zset[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        zset = self.zsets.get(key, {})
+        return sum(zset.pop(member, None) is not None for member in members)
+
+    def cmd_zcard(self, key):
+        return len(self.zsets.get(key, ()))
+
+    def cmd_zrangebyscore(self, key, low, high):
+        low, high = float(low), float(high)
+        ranked = sorted((score, member) for member, score in self.zsets.get(key, {}).items())
+        scores = [score for score, _ in ranked]
+        return [member for _, member in ranked[bisect.bisect_left(scores, low):bisect.bisect_right(scores, high)]]
+
+    def cmd_hset(self, key, *args):
+        hash_ = self.hashes[key]
+        added = 0
+        for field, value in zip(args[::2], args[1::2]):
+            added += field not in hash_
+            hash_[field] = value
+        return added
+
+    def cmd_hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def cmd_hdel(self, key, *fields):
+        hash_ = self.hashes.get(key, {})
+        return sum(hash_.pop(field, None) is not None for field in fields)
+
+    def cmd_hincrby(self, key, field, increment):
+        hash_ = self.hashes[key]
+        hash_[field] = str(int(hash_.get(field, 0)) + int(increment))
+        return int(hash_[field])
+
+    def cmd_eval(self, script, numkeys, *args):
+        # the scripts of RedisDispatcher, as the commands they are made of;
+        # run under the lock they're atomic like in redis
+        keys, argv = args[:int(numkeys)], args[int(numkeys):]
+        if script == LEASE_SCRIPT:
+            task_id = self.cmd_lpop(keys[0])
+            if task_id is not None:
+                self.cmd_zadd(keys[1], argv[0], task_id)
+                self.cmd_hset(keys[2], task_id, argv[1])
+                self.cmd_hincrby(keys[3], task_id, 1)
+            return task_id
+        raise Error("unknown script")
+
+    def cmd_publish(self, channel, message):
+        handlers = list(self.subscribers.get(channel, ()))
+        for handler in handlers:
+            try:
+                handler.write(["message", channel, message])
+            except OSError:
+                self.unsubscribe(handler)
+        return len(handlers)
+
+
+class FakeRedis:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.address = (host, port)
+        self.redis = FakeRedisData()
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "redis://%s:%d/0" % (host, port)
+
+    def start(self):
+        ThreadingTCPServer.allow_reuse_address = True
+        self.server = ThreadingTCPServer(self.address, FakeRedisHandler)
+        self.server.daemon_threads = True
+        self.server.redis = self.redis
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in of a redis server")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    redis = FakeRedis(port=args.port).start()
+    print("Serving fake redis on", redis.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        redis.stop()
@@ -0,0 +1,161 @@
+"""
+Runs a set of benchmarks with their default arguments and saves every table
+they print to benchmarks/results/<date>-<commit>.json, then compares them
+with the results saved last (or --compare) and lists the numbers that moved
+by more than --threshold percent.
+
+The default suite is the end to end load test (bench_load.py) and the micro
+benchmarks of the response, the spider's parsing and database inserts;
+--all runs every bench_*.py.
+
+    python benchmarks/run_suite.py
+    python benchmarks/run_suite.py bench_parsers bench_db_inserts --compare benchmarks/results/<file>.json
+"""
+from common import print_table, ROOT_DIR
+
+from datetime import datetime
+import subprocess
+import platform
+import argparse
+import tempfile
+import glob
+import json
+import time
+import sys
+import os
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SUITE = ["bench_load", "bench_prepare_response", "bench_parsers", "bench_db_inserts"]
+
+
+def run(name, timeout):
+    with tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False) as f:
+        path = f.name
+    started = time.monotonic()
+    try:
+        process = subprocess.run([sys.executable, os.path.join(BENCH_DIR, name + ".py")], cwd=BENCH_DIR,
+                                 env=dict(os.environ, BENCH_RESULTS=path), timeout=timeout)
+        status = process.returncode
+    except subprocess.TimeoutExpired:
+        status = "timeout"
+    elapsed = time.monotonic() - started
+    with open(path, "r") as f:
+        tables = [json.loads(line) for line in f]
+    os.remove(path)
+    return {"status": status, "seconds": round(elapsed, 1), "tables": tables}
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def label(row):
+    # the cells naming a row: the ones before its first number
+    names = []
+    for value in row:
+        if number(value) is not None:
+            break
+        names.append(value)
+    return " / ".join(names) or "-"
+
+
+def compare(before, after, threshold):
+    changes = []
+    for name, result in after["benchmarks"].items():
+        previous = before["benchmarks"].get(name)
+        if previous is None:
+            continue
+        for table, old_table in zip(result["tables"], previous["tables"]):
+            # benchmarks print their rows in the same order every run
+            if table["headers"] != old_table["headers"] or len(table["rows"]) != len(old_table["rows"]):
+                continue
+            for old_row, row in zip(old_table["rows"], table["rows"]):
+                for header, old, new in zip(table["headers"], old_row, row):
+                    old_number, new_number = number(old), number(new)
+                    if old_number is not None and new_number is not None:
+                        if old_number == new_number:
+                            continue
+                        change = (new_number - old_number) / abs(old_number) * 100 if old_number else float("inf")
+                        if abs(change) >= threshold:
+                            changes.append([name, label(row), header, old, new, "%+.0f%%" % change])
+                    elif old != new:
+                        changes.append([name, label(row), header, old, new, "changed"])
+    return changes
+
+
+def latest_results(exclude=None):
+    paths = sorted(path for path in glob.glob(os.path.join(RESULTS_DIR, "*.json")) if path != exclude)
+    return paths[-1] if paths else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help="names of the benchmarks, e.g. bench_parsers")
+    parser.add_argument("--all", action="store_true", help="run every bench_*.py")
+    parser.add_argument("--compare", help="results file to compare with, the last saved one by default")
+    parser.add_argument("--threshold", type=float, default=10, help="percent change worth listing")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds a benchmark may take")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    if args.all:
+        names = sorted(os.path.basename(path)[:-3] for path in glob.glob(os.path.join(BENCH_DIR, "bench_*.py")))
+    else:
+        names = args.benchmarks or SUITE
+
+    results = {
+        "commit": commit(),
+        "date": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": "%s, %d cpus" % (platform.platform(), os.cpu_count() or 0),
+        "benchmarks": {},
+    }
+    for name in names:
+        print("== %s" % name, flush=True)
+        results["benchmarks"][name] = run(name, args.timeout)
+        print(flush=True)
+
+    path = None
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, "%s-%s.json" % (datetime.utcnow().strftime("%Y%m%d-%H%M%S"),
+                                                         results["commit"]))
+        with open(path, "w") as f:
+            json.dump(results, f, indent=1)
+
+    print_table([[name, result["status"], result["seconds"], len(result["tables"])]
+                 for name, result in results["benchmarks"].items()],
+                ["benchmark", "exit", "seconds", "tables"])
+    if path:
+        print("saved to %s" % os.path.relpath(path))
+
+    baseline = args.compare or latest_results(exclude=path)
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            before = json.load(f)
+        changes = compare(before, results, args.threshold)
+        print()
+        print("compared with %s (commit %s)" % (os.path.relpath(baseline), before["commit"]))
+        if changes:
+            print_table(changes, ["benchmark", "row", "column", "before", "after", "change"])
+        else:
+            print("nothing changed by %g%% or more" % args.threshold)
+    if any(result["status"] != 0 for result in results["benchmarks"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,200 +1,833 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
-from sqlalchemy import select
-
-from sqlalchemy.orm import (
-    sessionmaker, 
-    validates,
-    relationship,
-    backref
-    )
-
-import json
-import secrets
-import random
-import os
-import dateutil.parser as date_parser
-from datetime import datetime
-
-from task import Task
-
-
-DB_URI = "sqlite:///tasks_db____.db"
-# DB_URI = os.environ['DB_URI']
-
-Base = declarative_base()
-
-
-def convert_str_to_datetime(date_str):
-    return date_parser.parse(date_str)
-
-
-class Task(Base):
-    __tablename__ = 'task'
-
-    id = Column(Integer, primary_key=True)
-    task_id = Column(String)
-    key = Column(String, unique=True)
-    status = Column(String, default=Task.PENDING)
-    message = Column(String)
-
-    # Lazy=True -> https://docs.sqlalchemy.org/en/20/orm/relationship_api.html#sqlalchemy.orm.relationship.params.lazy
-    # cascade="all, delete-orphan" -> delete all related data when task is deleted
-    course_score = relationship("CourseScore", backref="task", cascade="all,delete", lazy=True)
-    student_profile = relationship("StudentProfile", backref="task", cascade="all,delete", lazy=True, uselist=False)
-    attendance = relationship("Attendance", backref="task", cascade="all,delete", lazy=True)
-
-    def to_dict(self):
-        return {
-            'task_id': self.task_id,
-            'status': self.status,
-            'message': self.message
-        }
-
-    def __repr__(self):
-        return '<Task %r>' % self.task_id
-
-
-class CourseScore(Base):
-    __tablename__ = 'course_score'
-
-    id = Column(Integer, primary_key=True)
-    task_id = Column(String, ForeignKey('task.task_id'), nullable=False)
-    course_id = Column(String)
-    course_name = Column(String)
-    credit_hours = Column(String)
-    teacher = Column(String)
-    section_title = Column(String)
-    title = Column(String)
-    marks = Column(String)
-    total_marks = Column(String)
-    datetime = Column(DateTime)
-
-    def to_dict(self):
-        return {
-            'course_id': self.course_id,
-            'course_name': self.course_name,
-            'credit_hours': self.credit_hours,
-            'teacher': self.teacher,
-            'section_title': self.section_title,
-            'title': self.title,
-            'marks': self.marks,
-            'total_marks': self.total_marks,
-            'datetime': datetime.strftime(self.datetime, "%d-%m-%Y")
-        }
-
-    @validates('datetime')
-    def validate_datetime(self, key, datetime):
-        return convert_str_to_datetime(datetime)
-
-    def __repr__(self):
-        return '<CourseScore %r>' % self.course_id
-
-
-class StudentProfile(Base):
-    __tablename__ = 'student_profile'
-
-    id = Column(Integer, primary_key=True)
-    task_id = Column(String, ForeignKey('task.task_id'), nullable=False)
-    name = Column(String)
-    registration_number = Column(String)
-
-    def to_dict(self):
-        return {
-            'studentName': self.name,
-            'registrationNumber': self.registration_number
-        }
-
-    def __repr__(self):
-        return '<StudentProfile %r>' % self.name
-
-
-class Attendance(Base):
-    __tablename__ = 'attendance'
-
-    id = Column(Integer, primary_key=True)
-    task_id = Column(String, ForeignKey('task.task_id'), nullable=False)
-    course_id = Column(String)
-    attendance_type = Column(String)
-    topic = Column(String)
-    attended = Column(Boolean)
-    start_time = Column(DateTime)
-    end_time = Column(DateTime)
-
-    @validates('start_time')
-    def validate_start_time(self, key, start_time):
-        return convert_str_to_datetime(start_time)
-
-    @validates('end_time')
-    def validate_end_time(self, key, end_time):
-        return convert_str_to_datetime(end_time)
-
-    def to_dict(self):
-        return {
-            'course_id': self.course_id,
-            'attendance_type': self.attendance_type,
-            'topic': self.topic,
-            'attended': self.attended,
-            'start_time': datetime.strftime(self.start_time, "%d-%m-%Y %I:%M %p"),
-            'end_time': datetime.strftime(self.end_time, "%d-%m-%Y %I:%M %p")
-        }
-
-    def __repr__(self):
-        return '<Attendance %r>' % self.course_id
-
-
-class DataBase:
-    def __init__(self, db_uri=DB_URI):
-        engine = create_engine(db_uri, echo=False)
-        Base.metadata.create_all(engine)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
-
-    def create_task(self, task_id):
-        if self.get_task(task_id) is not None:
-            return
-
-        existing_keys = [task.key for task in self.session.query(Task).all()]
-        n_chars = random.randint(8, 16)
-        key = secrets.token_urlsafe(n_chars)
-        while key in existing_keys:
-            key = secrets.token_urlsafe(n_chars)
-
-        task = Task(task_id=task_id, key=key)
-        self.session.add(task)
-        self.session.commit()
-        return key
-
-    def delete_task(self, task_id):
-        if task := self.session.scalars(select(Task).filter_by(task_id=task_id)).first():
-            self.session.delete(task)
-            self.session.commit()
-
-    def get_task(self, task_id):
-        return self.session.query(Task).filter_by(task_id=task_id).first()
-
-    def update_task_status(self, task_id, status, message=''):
-        task = self.session.query(Task).filter_by(task_id=task_id).first()
-        task.status = status
-        task.message = message
-        self.session.commit()
-
-    def add_course_score_data(self, task_id, data):
-        data = [data] if not isinstance(data, list) else data
-        for item in data:
-            score_data = CourseScore(task_id=task_id, **item)
-            self.session.add(score_data)
-        self.session.commit()
-
-    def add_attendance_data(self, task_id, data):
-        data = [data] if not isinstance(data, list) else data
-        for item in data:
-            attendance = Attendance(task_id=task_id, **item)
-            self.session.add(attendance)
-        self.session.commit()
-
-    def add_student_profile_data(self, task_id, data):
-        profile_data = StudentProfile(task_id=task_id, **data)
-        self.session.add(profile_data)
-        self.session.commit()
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, LargeBinary, Index
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import create_engine, event
+from sqlalchemy import select, insert, update, delete, inspect, text, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+
+from sqlalchemy.orm import (
+    sessionmaker, 
+    scoped_session,
+    validates,
+    relationship,
+    backref,
+    deferred
+    )
+
+import collections
+import hashlib
+import threading
+import json
+import gzip
+import secrets
+import random
+import os
+import dateutil.parser as date_parser
+from datetime import datetime, timedelta
+
+from task import Task
+from response import sum_marks
+
+
+DB_URI = os.environ.get("DB_URI", "sqlite:///tasks_db____.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+# sqlite only: WAL lets readers run while a scraper writes, and writers wait
+# for the lock for up to SQLITE_BUSY_TIMEOUT ms instead of failing at once
+SQLITE_WAL = os.environ.get("SQLITE_WAL", "1") == "1"
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+
+Base = declarative_base()
+
+
+# formats the portal renders dates in, tried before dateutil's slower guessing
+PORTAL_DATE_FORMATS = (
+    "%m/%d/%Y %I:%M:%S %p",
+    "%m/%d/%Y",
+)
+DATE_CACHE_SIZE = int(os.environ.get("DATE_CACHE_SIZE", 4096))
+# formats of the dates in a task's response
+SCORE_DATE_FORMAT = "%d-%m-%Y"
+ATTENDANCE_DATE_FORMAT = "%d-%m-%Y %I:%M %p"
+
+
+class DateParser:
+    """
+    Parses date strings with strptime and a list of known formats, the format
+    that matched last is tried first. Results are memoized, a class has the
+    same start time on every page, and dateutil is only used for strings none
+    of the formats match.
+    """
+
+    def __init__(self, formats=PORTAL_DATE_FORMATS, cache_size=DATE_CACHE_SIZE):
+        self.formats = list(formats)
+        self.cache_size = cache_size
+        self.cache = {}
+        self.counts = collections.Counter()
+
+    def parse(self, date_str):
+        value = self.cache.get(date_str)
+        if value is not None:
+            self.counts["cached"] += 1
+            return value
+
+        value = self._strptime(date_str)
+        if value is not None:
+            self.counts["strptime"] += 1
+        else:
+            value = date_parser.parse(date_str)
+            self.counts["dateutil"] += 1
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[date_str] = value
+        return value
+
+    def _strptime(self, date_str):
+        formats = self.formats
+        for n, date_format in enumerate(formats):
+            try:
+                value = datetime.strptime(date_str, date_format)
+            except ValueError:
+                continue
+            if n:
+                # a list copy, so a parse running in another thread doesn't
+                # see the list change under it
+                self.formats = [date_format] + formats[:n] + formats[n + 1:]
+            return value
+        return None
+
+    def stats(self):
+        return dict(self.counts, formats=list(self.formats), cacheSize=len(self.cache))
+
+
+portal_dates = DateParser()
+
+
+def convert_str_to_datetime(date_str):
+    return portal_dates.parse(date_str)
+
+
+def parse_marks(value):
+    # (number, None) for marks like "8" or "8.5", (None, text) for the
+    # portal's non numeric marks like "-" or "Absent"
+    if value is None:
+        return None, None
+    try:
+        return float(value), None
+    except (TypeError, ValueError):
+        return None, str(value).strip()
+
+
+def marks_columns(item):
+    # marks are converted once, when they are stored
+    marks, marks_status = parse_marks(item["marks"])
+    total_marks, _ = parse_marks(item["total_marks"])
+    return {"marks": marks, "total_marks": total_marks, "marks_status": marks_status}
+
+
+class Task(Base):
+    __tablename__ = 'task'
+    __table_args__ = (
+        Index('ix_task_status_updated_at', 'status', 'updated_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, unique=True, index=True)
+    key = Column(String, unique=True)
+    status = Column(String, default=Task.PENDING)
+    message = Column(String)
+    # finished response body (gzip compressed json) and its ETag, stored when
+    # the task succeeds so reads don't rebuild it. Deferred so status polls
+    # don't load it
+    response_data = deferred(Column(LargeBinary))
+    response_etag = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # used by the retention sweeper (retention.py) to expire tasks
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # progress of a running scrape, written by the pipeline with every flush
+    courses_total = Column(Integer)
+    courses_done = Column(Integer, default=0)
+    rows_ingested = Column(Integer, default=0)
+    # what an incremental re-scrape didn't have to parse / write again
+    pages_skipped = Column(Integer, default=0)
+    rows_skipped = Column(Integer, default=0)
+
+    # Lazy=True -> https://docs.sqlalchemy.org/en/20/orm/relationship_api.html#sqlalchemy.orm.relationship.params.lazy
+    # cascade="all, delete-orphan" -> delete all related data when task is deleted
+    # ordered by the rows' position on the portal (id for rows stored
+    # without one), the (task_id, course_id) index would otherwise return
+    # them sorted by course
+    course_score = relationship("CourseScore", backref="task", cascade="all,delete", lazy=True,
+                                order_by="[CourseScore.position, CourseScore.id]")
+    student_profile = relationship("StudentProfile", backref="task", cascade="all,delete", lazy=True, uselist=False)
+    attendance = relationship("Attendance", backref="task", cascade="all,delete", lazy=True,
+                              order_by="[Attendance.position, Attendance.id]")
+    course_pages = relationship("CoursePage", backref="task", cascade="all,delete", lazy=True)
+    course_totals = relationship("CourseTotal", backref="task", cascade="all,delete", lazy=True)
+
+    def to_dict(self):
+        return {
+            'task_id': self.task_id,
+            'status': self.status,
+            'message': self.message
+        }
+
+    def progress(self):
+        return task_progress(self)
+
+    def __repr__(self):
+        return '<Task %r>' % self.task_id
+
+
+def task_progress(task):
+    # progress of a task, or of a row with its progress columns
+    return {
+        'coursesTotal': task.courses_total,
+        'coursesDone': task.courses_done or 0,
+        'rowsIngested': task.rows_ingested or 0,
+        'pagesSkipped': task.pages_skipped or 0,
+        'rowsSkipped': task.rows_skipped or 0,
+    }
+
+
+class CourseScore(Base):
+    __tablename__ = 'course_score'
+    __table_args__ = (
+        Index('ix_course_score_task_id_course_id', 'task_id', 'course_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, ForeignKey('task.task_id'), nullable=False)
+    course_id = Column(String)
+    course_name = Column(String)
+    credit_hours = Column(String)
+    teacher = Column(String)
+    section_title = Column(String)
+    title = Column(String)
+    # NULL marks have their text in marks_status (see parse_marks)
+    marks = Column(Float)
+    total_marks = Column(Float)
+    marks_status = Column(String)
+    datetime = Column(DateTime)
+    # order of the row on the portal (course, then row), kept when an
+    # incremental re-scrape only replaces some rows
+    position = Column(Integer)
+
+    def to_dict(self):
+        return {
+            'course_id': self.course_id,
+            'course_name': self.course_name,
+            'credit_hours': self.credit_hours,
+            'teacher': self.teacher,
+            'section_title': self.section_title,
+            'title': self.title,
+            'marks': self.marks if self.marks is not None else self.marks_status,
+            'total_marks': self.total_marks if self.total_marks is not None else 0.0,
+            'datetime': datetime.strftime(self.datetime, SCORE_DATE_FORMAT)
+        }
+
+    @validates('datetime')
+    def validate_datetime(self, key, datetime):
+        return convert_str_to_datetime(datetime)
+
+    def __repr__(self):
+        return '<CourseScore %r>' % self.course_id
+
+
+class StudentProfile(Base):
+    __tablename__ = 'student_profile'
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, ForeignKey('task.task_id'), nullable=False, index=True)
+    name = Column(String)
+    registration_number = Column(String)
+
+    def to_dict(self):
+        return {
+            'studentName': self.name,
+            'registrationNumber': self.registration_number
+        }
+
+    def __repr__(self):
+        return '<StudentProfile %r>' % self.name
+
+
+class Attendance(Base):
+    __tablename__ = 'attendance'
+    __table_args__ = (
+        Index('ix_attendance_task_id_course_id', 'task_id', 'course_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, ForeignKey('task.task_id'), nullable=False)
+    course_id = Column(String)
+    attendance_type = Column(String)
+    topic = Column(String)
+    attended = Column(Boolean)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)
+    position = Column(Integer)
+
+    @validates('start_time')
+    def validate_start_time(self, key, start_time):
+        return convert_str_to_datetime(start_time)
+
+    @validates('end_time')
+    def validate_end_time(self, key, end_time):
+        return convert_str_to_datetime(end_time)
+
+    def to_dict(self):
+        return {
+            'course_id': self.course_id,
+            'attendance_type': self.attendance_type,
+            'topic': self.topic,
+            'attended': self.attended,
+            'start_time': datetime.strftime(self.start_time, ATTENDANCE_DATE_FORMAT),
+            'end_time': datetime.strftime(self.end_time, ATTENDANCE_DATE_FORMAT)
+        }
+
+    def __repr__(self):
+        return '<Attendance %r>' % self.course_id
+
+
+class CoursePage(Base):
+    # fingerprint of a course's marks or attendance page from the last scrape
+    # of a session, a re-scrape skips the pages that didn't change
+    __tablename__ = 'course_page'
+    __table_args__ = (
+        Index('ix_course_page_task_id_course_id', 'task_id', 'course_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, ForeignKey('task.task_id'), nullable=False)
+    course_id = Column(String)
+    page = Column(String)
+    fingerprint = Column(String)
+    rows = Column(Integer)
+
+    def __repr__(self):
+        return '<CoursePage %r %r>' % (self.course_id, self.page)
+
+
+class CourseTotal(Base):
+    # marks of a course section (or of the whole course, with a NULL
+    # section_title) summed up when the course's marks are stored
+    __tablename__ = 'course_total'
+    __table_args__ = (
+        Index('ix_course_total_task_id_course_id', 'task_id', 'course_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, ForeignKey('task.task_id'), nullable=False)
+    course_id = Column(String)
+    section_title = Column(String)
+    marks = Column(Float)
+    total_marks = Column(Float)
+
+    def __repr__(self):
+        return '<CourseTotal %r %r>' % (self.course_id, self.section_title)
+
+
+class QueuedTask(Base):
+    # a task waiting for a scrape worker, or leased by one until lease_expires_at
+    # (see dispatch.DatabaseDispatcher)
+    __tablename__ = 'task_queue'
+
+    QUEUED = "queued"
+    LEASED = "leased"
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, nullable=False, unique=True)
+    status = Column(String, default=QUEUED, index=True)
+    worker_id = Column(String)
+    lease_expires_at = Column(DateTime)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<QueuedTask %r>' % self.task_id
+
+
+class TaskEvent(Base):
+    # status change published by a scrape worker running on another node,
+    # read by the API processes (see dispatch.DatabaseDispatcher.listen)
+    __tablename__ = 'task_event'
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, nullable=False, index=True)
+    status = Column(String)
+    message = Column(String)
+    progress = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<TaskEvent %r %r>' % (self.task_id, self.status)
+
+
+def add_missing_columns(engine):
+    # create_all doesn't alter existing tables, so columns added to the models
+    # later are added to databases created before them
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column_type)))
+
+
+def convert_marks_columns(engine):
+    # marks were stored as strings before, the table is rebuilt with the
+    # numeric columns and its rows converted
+    columns = {column["name"]: column["type"] for column in inspect(engine).get_columns("course_score")}
+    if not isinstance(columns["marks"], String):
+        return
+    table = CourseScore.__table__
+    with engine.begin() as conn:
+        rows = [dict(row._mapping) for row in conn.execute(select(table))]
+        table.drop(conn)
+        table.create(conn)
+        if rows:
+            conn.execute(insert(table), [dict(row, **marks_columns(row)) for row in rows])
+
+
+def add_missing_indexes(engine):
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                if index.name == "ix_task_task_id":
+                    # task ids weren't unique before, keeping the latest task of a session
+                    conn.execute(text(
+                        "DELETE FROM task WHERE id NOT IN (SELECT max(id) FROM task GROUP BY task_id)"
+                    ))
+                index.create(conn)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA busy_timeout = %d" % SQLITE_BUSY_TIMEOUT)
+    # only takes effect for new database files, lets the retention sweeper
+    # give the pages of deleted tasks back with incremental_vacuum
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    if SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.close()
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_uri=DB_URI):
+    # one engine (and connection pool) per database for the whole process,
+    # the schema is created / migrated when it is first used
+    with _engines_lock:
+        if db_uri not in _engines:
+            url = make_url(db_uri)
+            options = {}
+            if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+                options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+            engine = create_engine(db_uri, echo=False, **options)
+            if url.get_backend_name() == "sqlite":
+                event.listen(engine, "connect", set_sqlite_pragmas)
+            Base.metadata.create_all(engine)
+            add_missing_columns(engine)
+            convert_marks_columns(engine)
+            add_missing_indexes(engine)
+            _engines[db_uri] = engine
+        return _engines[db_uri]
+
+
+def _dispose_engines_after_fork():
+    # pooled connections must not be shared with a forked scraper process
+    for engine in _engines.values():
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+class DataBase:
+    def __init__(self, db_uri=DB_URI):
+        # every thread gets its own session, call remove() when a unit of
+        # work (e.g. a flask request) is done with it
+        self.Session = scoped_session(sessionmaker(bind=get_engine(db_uri)))
+
+    @property
+    def session(self):
+        return self.Session()
+
+    def remove(self):
+        self.Session.remove()
+
+    def create_task(self, task_id):
+        if self.get_task(task_id) is not None:
+            return
+
+        # the unique constraints on task_id and key catch a collision, instead
+        # of loading every existing key first
+        while True:
+            key = secrets.token_urlsafe(random.randint(8, 16))
+            self.session.add(Task(task_id=task_id, key=key))
+            try:
+                self.session.commit()
+                return key
+            except IntegrityError:
+                self.session.rollback()
+                # created at the same time by someone else (e.g. the pipeline)
+                if self.get_task(task_id) is not None:
+                    return
+
+    def delete_task(self, task_id):
+        if task := self.session.scalars(select(Task).filter_by(task_id=task_id)).first():
+            self.session.delete(task)
+            self.session.commit()
+
+    def get_task(self, task_id):
+        return self.session.query(Task).filter_by(task_id=task_id).first()
+
+    def get_task_data(self, task_id):
+        # (profile, score rows, attendance rows, totals) of a task as built by
+        # the models' to_dict, read with one select per table and without
+        # loading ORM objects; attendance is sorted by class time
+        profile = self.session.execute(
+            select(StudentProfile.name, StudentProfile.registration_number).filter_by(task_id=task_id)
+        ).first()
+        profile_data = {"studentName": profile[0], "registrationNumber": profile[1]} if profile else None
+
+        formatted = {}
+
+        def format_date(value, date_format):
+            # a date is formatted once, however many rows have it
+            key = (value, date_format)
+            text = formatted.get(key)
+            if text is None:
+                text = formatted[key] = value.strftime(date_format)
+            return text
+
+        score_data = [
+            {
+                "course_id": course_id,
+                "course_name": course_name,
+                "credit_hours": credit_hours,
+                "teacher": teacher,
+                "section_title": section_title,
+                "title": title,
+                "marks": marks if marks is not None else marks_status,
+                "total_marks": total_marks if total_marks is not None else 0.0,
+                "datetime": format_date(date, SCORE_DATE_FORMAT),
+            }
+            for course_id, course_name, credit_hours, teacher, section_title, title, marks, marks_status,
+            total_marks, date in self.session.execute(
+                select(CourseScore.course_id, CourseScore.course_name, CourseScore.credit_hours,
+                       CourseScore.teacher, CourseScore.section_title, CourseScore.title, CourseScore.marks,
+                       CourseScore.marks_status, CourseScore.total_marks, CourseScore.datetime)
+                .where(CourseScore.task_id == task_id)
+                .order_by(CourseScore.position, CourseScore.id)
+            )
+        ]
+        attendance_data = [
+            {
+                "course_id": course_id,
+                "attendance_type": attendance_type,
+                "topic": topic,
+                "attended": attended,
+                "start_time": format_date(start_time, ATTENDANCE_DATE_FORMAT),
+                "end_time": format_date(end_time, ATTENDANCE_DATE_FORMAT),
+            }
+            for course_id, attendance_type, topic, attended, start_time, end_time in self.session.execute(
+                select(Attendance.course_id, Attendance.attendance_type, Attendance.topic, Attendance.attended,
+                       Attendance.start_time, Attendance.end_time)
+                .where(Attendance.task_id == task_id)
+                .order_by(Attendance.start_time, Attendance.position, Attendance.id)
+            )
+        ]
+        totals = collections.defaultdict(dict)
+        for course_id, section_title, marks, total_marks in self.session.execute(
+            select(CourseTotal.course_id, CourseTotal.section_title, CourseTotal.marks, CourseTotal.total_marks)
+            .where(CourseTotal.task_id == task_id)
+        ):
+            totals[course_id][section_title] = (marks, total_marks)
+        return profile_data, score_data, attendance_data, totals
+
+    def get_task_status(self, task_id):
+        # only the status columns of the task row, nothing else is loaded
+        return self.session.execute(
+            select(Task.status, Task.message, Task.courses_total, Task.courses_done, Task.rows_ingested,
+                   Task.pages_skipped, Task.rows_skipped)
+            .filter_by(task_id=task_id)
+        ).first()
+
+    def update_task_status(self, task_id, status, message='', response=None):
+        # any status change replaces (or drops) the stored response
+        task = self.session.query(Task).filter_by(task_id=task_id).first()
+        task.status = status
+        task.message = message
+        task.response_data = gzip.compress(response) if response is not None else None
+        task.response_etag = hashlib.sha1(response).hexdigest() if response is not None else None
+        self.session.commit()
+
+    def add_course_score_data(self, task_id, data):
+        data = [data] if not isinstance(data, list) else data
+        for item in data:
+            score_data = CourseScore(task_id=task_id, **dict(item, **marks_columns(item)))
+            self.session.add(score_data)
+        self.update_course_totals(task_id, {item["course_id"] for item in data})
+        self.session.commit()
+
+    def add_attendance_data(self, task_id, data):
+        data = [data] if not isinstance(data, list) else data
+        for item in data:
+            attendance = Attendance(task_id=task_id, **item)
+            self.session.add(attendance)
+        self.session.commit()
+
+    def add_bulk_data(self, task_id, course_score_data=(), attendance_data=()):
+        self.write_batch(task_id, course_score_data=course_score_data, attendance_data=attendance_data)
+
+    def write_batch(self, task_id, profile=None, course_score_data=(), attendance_data=(),
+                    pages=(), diff=False, commit=True):
+        # rows skip the ORM (and its @validates hooks): dates are parsed here
+        # and every table gets a single executemany, all in one transaction
+        course_score_rows = [
+            dict(item, task_id=task_id, datetime=convert_str_to_datetime(item["datetime"]), **marks_columns(item))
+            for item in course_score_data
+        ]
+        attendance_rows = [
+            dict(
+                item,
+                task_id=task_id,
+                start_time=convert_str_to_datetime(item["start_time"]),
+                end_time=convert_str_to_datetime(item["end_time"]),
+            )
+            for item in attendance_data
+        ]
+        # courses whose totals have to be summed up again
+        totals = {row["course_id"] for row in course_score_rows}
+        totals.update(page["course_id"] for page in pages if page["page"] == "marks" and page["changed"])
+        kept = 0
+        if diff:
+            # incremental re-scrape: the rows of every re-parsed page replace
+            # the stored rows of its course, rows that are still the same are kept
+            tables = {"marks": (CourseScore.__table__, course_score_rows),
+                      "attendance": (Attendance.__table__, attendance_rows)}
+            inserts = {"marks": [], "attendance": []}
+            for page in pages:
+                if page["changed"]:
+                    table, rows = tables[page["page"]]
+                    rows = [row for row in rows if row["course_id"] == page["course_id"]]
+                    new_rows, kept_rows = self.diff_rows(table, task_id, page["course_id"], rows)
+                    inserts[page["page"]].extend(new_rows)
+                    kept += kept_rows
+            course_score_rows, attendance_rows = inserts["marks"], inserts["attendance"]
+
+        if course_score_rows:
+            self.session.execute(insert(CourseScore.__table__), course_score_rows)
+        if attendance_rows:
+            self.session.execute(insert(Attendance.__table__), attendance_rows)
+        if totals:
+            self.update_course_totals(task_id, totals)
+        if pages:
+            for page in pages:
+                self.session.execute(delete(CoursePage).filter_by(
+                    task_id=task_id, course_id=page["course_id"], page=page["page"]))
+            self.session.execute(insert(CoursePage.__table__), [
+                {"task_id": task_id, "course_id": page["course_id"], "page": page["page"],
+                 "fingerprint": page["fingerprint"], "rows": page["rows"]}
+                for page in pages
+            ])
+        if profile is not None:
+            self.session.execute(delete(StudentProfile).filter_by(task_id=task_id))
+            self.session.add(StudentProfile(task_id=task_id, **profile))
+        if commit:
+            self.session.commit()
+        return {"written": len(course_score_rows) + len(attendance_rows), "kept": kept}
+
+    def diff_rows(self, table, task_id, course_id, rows):
+        # (rows to insert, number of stored rows kept), stored rows that
+        # aren't among the given ones are deleted
+        columns = [column for column in table.columns if column.name not in ("id", "task_id")]
+        stored = collections.defaultdict(list)
+        for row in self.session.execute(
+            select(table.c.id, *columns).where(table.c.task_id == task_id, table.c.course_id == course_id)
+        ):
+            stored[tuple(row[1:])].append(row[0])
+        new_rows = []
+        for row in rows:
+            ids = stored.get(tuple(row.get(column.name) for column in columns))
+            if ids:
+                ids.pop()
+            else:
+                new_rows.append(row)
+        stale = [row_id for ids in stored.values() for row_id in ids]
+        if stale:
+            self.session.execute(delete(table).where(table.c.id.in_(stale)))
+        return new_rows, len(rows) - len(new_rows)
+
+    def update_course_totals(self, task_id, course_ids):
+        # summed in the order the rows are read for a response, so the totals
+        # are the same as summing them there
+        self.session.flush()
+        sections = collections.defaultdict(lambda: collections.defaultdict(lambda: ([], [])))
+        for course_id, section_title, marks, total_marks in self.session.execute(
+            select(CourseScore.course_id, CourseScore.section_title, CourseScore.marks, CourseScore.total_marks)
+            .where(CourseScore.task_id == task_id, CourseScore.course_id.in_(list(course_ids)))
+            .order_by(CourseScore.position, CourseScore.id)
+        ):
+            for section in (sections[course_id][section_title], sections[course_id][None]):
+                section[0].append(marks or 0.0)
+                section[1].append(total_marks or 0.0)
+
+        self.session.execute(delete(CourseTotal).where(
+            CourseTotal.task_id == task_id, CourseTotal.course_id.in_(list(course_ids))))
+        rows = [
+            {"task_id": task_id, "course_id": course_id, "section_title": section_title,
+             "marks": sum_marks(marks), "total_marks": sum_marks(total_marks)}
+            for course_id, course in sections.items()
+            for section_title, (marks, total_marks) in course.items()
+        ]
+        if rows:
+            self.session.execute(insert(CourseTotal.__table__), rows)
+
+    def update_progress(self, task_id, commit=True, **progress):
+        self.session.execute(update(Task).filter_by(task_id=task_id).values(**progress))
+        if commit:
+            self.session.commit()
+
+    def get_course_pages(self, task_id):
+        return {
+            (page.course_id, page.page): (page.fingerprint, page.rows)
+            for page in self.session.execute(select(CoursePage).filter_by(task_id=task_id)).scalars()
+        }
+
+    def has_course_pages(self, task_id):
+        # whether the task's rows were written with page fingerprints, which
+        # an incremental re-scrape needs to update them in place
+        return self.session.scalar(select(CoursePage.id).filter_by(task_id=task_id).limit(1)) is not None
+
+    def delete_other_courses(self, task_id, course_ids, commit=True):
+        # data of courses the student isn't registered in anymore
+        for model in (CourseScore, Attendance, CoursePage, CourseTotal):
+            self.session.execute(delete(model).where(
+                model.task_id == task_id, model.course_id.notin_(list(course_ids))))
+        if commit:
+            self.session.commit()
+
+    def add_student_profile_data(self, task_id, data):
+        profile_data = StudentProfile(task_id=task_id, **data)
+        self.session.add(profile_data)
+        self.session.commit()
+
+    def enqueue_task(self, task_id):
+        # a task already in the queue (or leased) is queued again from scratch
+        try:
+            self.session.execute(insert(QueuedTask.__table__).values(
+                task_id=task_id, status=QueuedTask.QUEUED, attempts=0, created_at=datetime.utcnow()))
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            self.session.execute(update(QueuedTask).filter_by(task_id=task_id).values(
+                status=QueuedTask.QUEUED, worker_id=None, lease_expires_at=None, attempts=0))
+            self.session.commit()
+
+    def lease_task(self, worker_id, lease_seconds):
+        # the oldest queued task, leased to the worker; the status check in the
+        # update makes sure only one of several workers gets it
+        while True:
+            row = self.session.execute(
+                select(QueuedTask.id, QueuedTask.task_id)
+                .filter_by(status=QueuedTask.QUEUED).order_by(QueuedTask.id).limit(1)
+            ).first()
+            if row is None:
+                self.session.commit()
+                return None
+            result = self.session.execute(
+                update(QueuedTask).filter_by(id=row.id, status=QueuedTask.QUEUED).values(
+                    status=QueuedTask.LEASED, worker_id=worker_id, attempts=QueuedTask.attempts + 1,
+                    lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+            )
+            self.session.commit()
+            if result.rowcount == 1:
+                return row.task_id
+
+    def extend_leases(self, worker_id, task_ids, lease_seconds):
+        self.session.execute(
+            update(QueuedTask)
+            .where(QueuedTask.task_id.in_(list(task_ids)), QueuedTask.worker_id == worker_id,
+                   QueuedTask.status == QueuedTask.LEASED)
+            .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+        )
+        self.session.commit()
+
+    def finish_lease(self, worker_id, task_id):
+        # a lease that expired and went to another worker is left to that one
+        self.session.execute(delete(QueuedTask).filter_by(
+            task_id=task_id, worker_id=worker_id, status=QueuedTask.LEASED))
+        self.session.commit()
+
+    def requeue_expired_leases(self, max_attempts):
+        # leases of workers that died or hung go back to the queue, tasks that
+        # were leased max_attempts times already are dropped and returned
+        now = datetime.utcnow()
+        expired = QueuedTask.status == QueuedTask.LEASED, QueuedTask.lease_expires_at < now
+        dropped = self.session.scalars(
+            select(QueuedTask.task_id).where(*expired, QueuedTask.attempts >= max_attempts)).all()
+        if dropped:
+            self.session.execute(delete(QueuedTask).where(*expired, QueuedTask.task_id.in_(dropped)))
+        requeued = self.session.execute(update(QueuedTask).where(*expired).values(
+            status=QueuedTask.QUEUED, worker_id=None, lease_expires_at=None)).rowcount
+        self.session.commit()
+        return requeued, dropped
+
+    def count_queued_tasks(self):
+        count = self.session.scalar(
+            select(func.count()).select_from(QueuedTask).filter_by(status=QueuedTask.QUEUED))
+        self.session.commit()
+        return count
+
+    def get_queue_position(self, task_id):
+        # number of queued tasks leased before this one, None when it isn't
+        # queued (anymore)
+        row_id = self.session.scalar(
+            select(QueuedTask.id).filter_by(task_id=task_id, status=QueuedTask.QUEUED))
+        position = None
+        if row_id is not None:
+            position = self.session.scalar(
+                select(func.count()).select_from(QueuedTask)
+                .where(QueuedTask.status == QueuedTask.QUEUED, QueuedTask.id < row_id))
+        self.session.commit()
+        return position
+
+    def add_task_event(self, task_id, status, message, progress):
+        self.session.execute(insert(TaskEvent.__table__).values(
+            task_id=task_id, status=status, message=message,
+            progress=json.dumps(progress) if progress is not None else None, created_at=datetime.utcnow()))
+        self.session.commit()
+
+    def last_task_event_id(self):
+        last_id = self.session.scalar(select(func.max(TaskEvent.id)))
+        self.session.commit()
+        return last_id or 0
+
+    def get_task_events(self, after_id, limit=500):
+        # (id, task_id, status, message, progress) published after the given event
+        events = [
+            (event.id, event.task_id, event.status, event.message,
+             json.loads(event.progress) if event.progress else None)
+            for event in self.session.execute(
+                select(TaskEvent).where(TaskEvent.id > after_id).order_by(TaskEvent.id).limit(limit)
+            ).scalars()
+        ]
+        self.session.commit()
+        return events
+
+    def delete_task_events(self, older_than):
+        self.session.execute(delete(TaskEvent).where(
+            TaskEvent.created_at < datetime.utcnow() - timedelta(seconds=older_than)))
+        self.session.commit()
@@ -0,0 +1,318 @@
+from urllib.parse import urlparse
+import threading
+import logging
+import socket
+import json
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# where submitted tasks wait for a scrape worker: "db" (the task_queue table
+# of the database) or "redis" (REDIS_URL)
+DISPATCH_BACKEND = os.environ.get("DISPATCH_BACKEND", "db")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.environ.get("REDIS_PREFIX", "portal:")
+# a worker holds a task for LEASE_SECONDS and renews the lease while it runs,
+# a lease nobody renewed in time goes back to the queue
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", 60))
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+# a task whose lease expired this many times (its crawls killed the worker
+# every time) isn't queued again
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get("DISPATCH_MAX_ATTEMPTS", 3))
+DISPATCH_POLL_INTERVAL = float(os.environ.get("DISPATCH_POLL_INTERVAL", 0.2))
+# task events of other nodes are kept in the database this long
+TASK_EVENT_TTL = int(os.environ.get("TASK_EVENT_TTL", 300))
+
+
+class DatabaseDispatcher:
+    """
+    Task queue in the task_queue table, shared by every API and scrape worker
+    process using the same database. Task events of workers on other nodes go
+    through the task_event table.
+    """
+
+    name = "db"
+
+    def __init__(self, lease_seconds=LEASE_SECONDS, max_attempts=DISPATCH_MAX_ATTEMPTS,
+                 poll_interval=DISPATCH_POLL_INTERVAL):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._db = None
+
+    def __getstate__(self):
+        # the engine stays in the process that made it
+        return dict(self.__dict__, _db=None)
+
+    @property
+    def db(self):
+        # sessions are per thread, so each caller thread gets its own
+        if self._db is None:
+            from database import DataBase
+            self._db = DataBase()
+        return self._db
+
+    def _run(self, method, *args):
+        # the thread's session is given back after every operation
+        try:
+            return method(*args)
+        finally:
+            self.db.remove()
+
+    def submit(self, task_id):
+        self._run(self.db.enqueue_task, task_id)
+
+    def lease(self, worker_id, timeout=None):
+        # the next task for the worker, or None when none came within timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            task_id = self._run(self.db.lease_task, worker_id, self.lease_seconds)
+            if task_id is not None:
+                return task_id
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def heartbeat(self, worker_id, task_ids):
+        if task_ids:
+            self._run(self.db.extend_leases, worker_id, task_ids, self.lease_seconds)
+
+    def complete(self, worker_id, task_id):
+        self._run(self.db.finish_lease, worker_id, task_id)
+
+    def requeue_expired(self):
+        # (number of tasks queued again, ids of the tasks given up on)
+        return self._run(self.db.requeue_expired_leases, self.max_attempts)
+
+    def depth(self):
+        return self._run(self.db.count_queued_tasks)
+
+    def position(self, task_id):
+        # tasks ahead of it in the queue, None when it isn't queued
+        return self._run(self.db.get_queue_position, task_id)
+
+    def publish(self, event):
+        self._run(self.db.add_task_event, *event)
+
+    def listen(self, callback):
+        # calls callback(task_id, status, message, progress) for every event
+        # published from now on, forever
+        db = self.db
+        last_id = self._run(db.last_task_event_id)
+        last_cleanup = time.monotonic()
+        while True:
+            events = None
+            try:
+                events = db.get_task_events(last_id)
+                for event_id, task_id, status, message, progress in events:
+                    # an event the callback failed on isn't read again
+                    last_id = event_id
+                    callback(task_id, status, message, progress)
+                if time.monotonic() - last_cleanup > TASK_EVENT_TTL:
+                    last_cleanup = time.monotonic()
+                    db.delete_task_events(TASK_EVENT_TTL)
+            except Exception:
+                logger.exception("Could not read task events")
+            finally:
+                db.remove()
+            if not events:
+                time.sleep(self.poll_interval)
+
+
+class RedisClient:
+    # just enough of the redis protocol (RESP) for RedisDispatcher
+
+    def __init__(self, url=REDIS_URL, timeout=10):
+        url = urlparse(url)
+        self.address = (url.hostname or "localhost", url.port or 6379)
+        self.database = int(url.path.strip("/") or 0)
+        self.password = url.password
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.file = self.sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.database:
+            self._call("SELECT", self.database)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def execute(self, *args):
+        with self.lock:
+            # one reconnect, the server may have closed an idle connection
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    return self._call(*args)
+                except (ConnectionError, socket.timeout):
+                    self.close()
+                    if attempt:
+                        raise
+
+    def _call(self, *args):
+        self.send(*args)
+        return self.read()
+
+    def send(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(parts))
+
+    def read(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("connection closed by the redis server")
+        kind, value = line[:1], line[1:-2]
+        if kind == b"+":
+            return value.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(value.decode("utf-8"))
+        if kind == b":":
+            return int(value)
+        if kind == b"$":
+            if value == b"-1":
+                return None
+            data = self.file.read(int(value) + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            if value == b"-1":
+                return None
+            return [self.read() for _ in range(int(value))]
+        raise RuntimeError("unexpected reply from the redis server: %r" % line)
+
+
+# takes the first queued task and leases it in one step, so a worker dying
+# in between can't take a task off the queue without a lease
+LEASE_SCRIPT = """
+local task_id = redis.call("LPOP", KEYS[1])
+if task_id then
+    redis.call("ZADD", KEYS[2], ARGV[1], task_id)
+    redis.call("HSET", KEYS[3], task_id, ARGV[2])
+    redis.call("HINCRBY", KEYS[4], task_id, 1)
+end
+return task_id
+"""
+
+
+class RedisDispatcher:
+    """
+    Task queue in redis: a list of queued task ids, a sorted set of leased
+    ids scored by lease expiry, and the worker and attempts of every lease in
+    hashes. Task events are published on a channel.
+    """
+
+    name = "redis"
+
+    def __init__(self, url=REDIS_URL, prefix=REDIS_PREFIX, lease_seconds=LEASE_SECONDS,
+                 max_attempts=DISPATCH_MAX_ATTEMPTS, poll_interval=DISPATCH_POLL_INTERVAL):
+        self.url = url
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.queue_key = prefix + "queue"
+        self.leases_key = prefix + "leases"
+        self.workers_key = prefix + "workers"
+        self.attempts_key = prefix + "attempts"
+        self.events_channel = prefix + "events"
+        self._clients = {}
+
+    def __getstate__(self):
+        # connections stay in the process that made them
+        return dict(self.__dict__, _clients={})
+
+    @property
+    def redis(self):
+        # a connection per process
+        pid = os.getpid()
+        if pid not in self._clients:
+            self._clients = {pid: RedisClient(self.url)}
+        return self._clients[pid]
+
+    def submit(self, task_id):
+        self.redis.execute("LREM", self.queue_key, 0, task_id)
+        self.redis.execute("HDEL", self.attempts_key, task_id)
+        self.redis.execute("RPUSH", self.queue_key, task_id)
+
+    def lease(self, worker_id, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            task_id = self.redis.execute("EVAL", LEASE_SCRIPT, 4, self.queue_key, self.leases_key,
+                                         self.workers_key, self.attempts_key,
+                                         time.time() + self.lease_seconds, worker_id)
+            if task_id is not None:
+                return task_id
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def heartbeat(self, worker_id, task_ids):
+        expires = time.time() + self.lease_seconds
+        for task_id in task_ids:
+            if self.redis.execute("HGET", self.workers_key, task_id) == worker_id:
+                self.redis.execute("ZADD", self.leases_key, "XX", expires, task_id)
+
+    def complete(self, worker_id, task_id):
+        if self.redis.execute("HGET", self.workers_key, task_id) == worker_id:
+            self.redis.execute("ZREM", self.leases_key, task_id)
+            self.redis.execute("HDEL", self.workers_key, task_id)
+            self.redis.execute("HDEL", self.attempts_key, task_id)
+
+    def requeue_expired(self):
+        requeued, dropped = 0, []
+        for task_id in self.redis.execute("ZRANGEBYSCORE", self.leases_key, "-inf", time.time()):
+            # whoever removes the lease requeues it
+            if not self.redis.execute("ZREM", self.leases_key, task_id):
+                continue
+            self.redis.execute("HDEL", self.workers_key, task_id)
+            if int(self.redis.execute("HGET", self.attempts_key, task_id) or 0) >= self.max_attempts:
+                self.redis.execute("HDEL", self.attempts_key, task_id)
+                dropped.append(task_id)
+            else:
+                self.redis.execute("RPUSH", self.queue_key, task_id)
+                requeued += 1
+        return requeued, dropped
+
+    def depth(self):
+        return self.redis.execute("LLEN", self.queue_key)
+
+    def position(self, task_id):
+        return self.redis.execute("LPOS", self.queue_key, task_id)
+
+    def publish(self, event):
+        self.redis.execute("PUBLISH", self.events_channel, json.dumps(event))
+
+    def listen(self, callback):
+        # a connection of its own, a subscribed connection can't send commands
+        while True:
+            client = RedisClient(self.url, timeout=None)
+            try:
+                client.execute("SUBSCRIBE", self.events_channel)
+                while True:
+                    kind, _, data = client.read()
+                    if kind == "message":
+                        callback(*json.loads(data))
+            except (ConnectionError, OSError):
+                client.close()
+                time.sleep(1)
+
+
+DISPATCHERS = {
+    DatabaseDispatcher.name: DatabaseDispatcher,
+    RedisDispatcher.name: RedisDispatcher,
+}
+
+
+def get_dispatcher(backend=DISPATCH_BACKEND):
+    return DISPATCHERS[backend]()
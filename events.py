@@ -0,0 +1,147 @@
+import multiprocessing
+import collections
+import threading
+import json
+import time
+
+
+# progress of a task nothing was written for yet (see database.Task.progress)
+NO_PROGRESS = {"coursesTotal": None, "coursesDone": 0, "rowsIngested": 0, "pagesSkipped": 0, "rowsSkipped": 0}
+
+# set in the scrape workers (see run.serve and worker.py), task status changes
+# made by the pipeline are sent to the API processes through it
+_sink = None
+
+
+def set_sink(sink):
+    # a callable taking (task_id, status, message, progress)
+    global _sink
+    _sink = sink
+
+
+def publish(task_id, status, message="", progress=None):
+    if _sink is not None:
+        _sink((task_id, status, message, progress))
+
+
+class TaskEvents:
+    """
+    Latest status of the tasks this process knows about. Requests waiting for
+    a task (long polls, event streams) block on a condition until it changes,
+    instead of querying the database again and again.
+    """
+
+    def __init__(self, max_tasks=10000):
+        self.max_tasks = max_tasks
+        self.condition = threading.Condition()
+        self.states = collections.OrderedDict()
+        self.queue = None
+        # events that came through the queue or were published here, skipped
+        # when the dispatcher delivers them again
+        self.delivered = collections.Counter()
+
+    def update(self, task_id, status, message="", progress=None):
+        with self.condition:
+            state = self.states.pop(task_id, None)
+            self.states[task_id] = {
+                "version": state["version"] + 1 if state else 1,
+                "status": status,
+                "message": message,
+                # status only changes keep the last progress
+                "progress": progress if progress is not None else state and state["progress"],
+                "checked": time.monotonic(),
+            }
+            while len(self.states) > self.max_tasks:
+                self.states.popitem(last=False)
+            self.condition.notify_all()
+
+    def remember(self, task_id, status, message="", progress=None, version=None):
+        # state read from the database, kept unless something newer arrived;
+        # given the version of the cached state it was read to check, it
+        # replaces that state (waking the waiters when it changed)
+        with self.condition:
+            state = self.states.get(task_id)
+            if state is not None and state["version"] != version:
+                return state
+            changed = state is not None and (state["status"], state["message"], state["progress"]) != \
+                (status, message, progress)
+            self.states[task_id] = {
+                "version": state["version"] + changed if state else 0,
+                "status": status,
+                "message": message,
+                "progress": progress,
+                "checked": time.monotonic(),
+            }
+            while len(self.states) > self.max_tasks:
+                self.states.popitem(last=False)
+            if changed:
+                self.condition.notify_all()
+            return self.states[task_id]
+
+    def annotate(self, task_id, **values):
+        # values kept with the task's state until it changes
+        with self.condition:
+            state = self.states.get(task_id)
+            if state is not None:
+                state.update(values)
+
+    def forget(self, task_ids):
+        with self.condition:
+            for task_id in task_ids:
+                self.states.pop(task_id, None)
+
+    def get(self, task_id):
+        with self.condition:
+            return self.states.get(task_id)
+
+    def wait(self, task_id, version=0, timeout=None):
+        # the state of the task once its version is newer than the given one,
+        # or whatever is known when the timeout runs out
+        with self.condition:
+            self.condition.wait_for(
+                lambda: task_id in self.states and self.states[task_id]["version"] > version,
+                timeout,
+            )
+            return self.states.get(task_id)
+
+    def listen(self, context=multiprocessing):
+        # queue the scrape workers publish to, read by a daemon thread; made
+        # with the multiprocessing context the workers are started with
+        if self.queue is None:
+            self.queue = context.Queue()
+            threading.Thread(target=self._consume, daemon=True).start()
+        return self.queue
+
+    def _consume(self):
+        while True:
+            event = self.queue.get()
+            self._deliver(event)
+            self.update(*event)
+
+    def publish(self, dispatcher, task_id, status, message="", progress=None):
+        # a change made by this process, sent to the other API processes too
+        event = (task_id, status, message, progress)
+        self._deliver(event)
+        self.update(*event)
+        dispatcher.publish(event)
+
+    def _deliver(self, event):
+        with self.condition:
+            if len(self.delivered) >= self.max_tasks:
+                self.delivered.clear()
+            self.delivered[json.dumps(event)] += 1
+
+    def follow(self, dispatcher):
+        # events of scrape workers on other nodes (see worker.py), the local
+        # workers publish there too
+        threading.Thread(target=dispatcher.listen, args=(self._followed,), daemon=True).start()
+
+    def _followed(self, *event):
+        key = json.dumps(event)
+        with self.condition:
+            if self.delivered[key]:
+                self.delivered[key] -= 1
+                if not self.delivered[key]:
+                    del self.delivered[key]
+                return
+        self.update(*event)
@@ -0,0 +1,45 @@
+from flask.json.provider import DefaultJSONProvider
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# "orjson" (when installed) or "json", the standard library encoder
+JSON_ENCODER = os.environ.get("JSON_ENCODER", "orjson" if orjson is not None else "json")
+use_orjson = JSON_ENCODER == "orjson" and orjson is not None
+
+
+def dumps(obj):
+    # compact, with sorted keys, as bytes; orjson writes non ascii characters
+    # as utf-8 instead of escaping them and NaN as null
+    if use_orjson:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data):
+    return orjson.loads(data) if use_orjson else json.loads(data)
+
+
+class JSONProvider(DefaultJSONProvider):
+    # jsonify with orjson, dates and the other types flask handles still go
+    # through flask's default()
+
+    def dumps(self, obj, **kwargs):
+        if not use_orjson:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME \
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if not use_orjson or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
@@ -0,0 +1,372 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextlib
+import threading
+import atexit
+import logging
+import socket
+import json
+import time
+import os
+
+
+# "0" turns metrics off, every metric and span is then a shared no-op
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+# every process (the API's and the scrape workers) writes its metrics there
+# every METRICS_WRITE_SECONDS, /metrics adds them all up. The snapshot of a
+# process that stopped (or wasn't written for METRICS_STALE_WRITES intervals,
+# the process died) is kept as retired, so the sums never go down: prometheus
+# would take that for a counter reset. Past METRICS_RETIRED_FILES retired
+# snapshots are added up into one.
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+METRICS_WRITE_SECONDS = float(os.environ.get("METRICS_WRITE_SECONDS", 5))
+METRICS_STALE_WRITES = 3
+METRICS_RETIRED_FILES = 20
+RETIRED_PREFIX = "retired-"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+# spans of a task are logged here at debug level, one json line each
+trace_logger = logging.getLogger("portal.trace")
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, metric):
+        self.metric = metric
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.metric.lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, metric):
+        self.metric = metric
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        with self.metric.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def sample(self):
+        return [list(self.counts), self.sum]
+
+    @staticmethod
+    def merge(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1]]
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Metric:
+    def __init__(self, kind, name, help, labels=()):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.kind(self))
+        return child
+
+    def snapshot(self):
+        with self.lock:
+            samples = [[[str(v) for v in values], child.sample()] for values, child in self.children.items()]
+        return {"type": self.kind.kind, "help": self.help, "labels": list(self.label_names), "samples": samples}
+
+
+class NoOp:
+    # stands in for metrics, their children and timers when metrics are off
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return NULL_CONTEXT
+
+
+NOOP = NoOp()
+NULL_CONTEXT = contextlib.nullcontext()
+
+registry = {}
+
+
+def counter(name, help, labels=()):
+    return _register(Counter, name, help, labels)
+
+
+def histogram(name, help, labels=()):
+    return _register(Histogram, name, help, labels)
+
+
+def _register(kind, name, help, labels):
+    if not METRICS_ENABLED:
+        return NOOP
+    metric = registry[name] = Metric(kind, name, help, labels)
+    # a metric without labels is its own only child
+    return metric if labels else metric.labels()
+
+
+STAGE_SECONDS = histogram(
+    "portal_stage_seconds", "Time a task spends in each stage, from the worker's start to its response",
+    ["stage"])
+PORTAL_REQUEST_SECONDS = histogram(
+    "portal_request_seconds", "Round trips to the portal by spider callback", ["callback"])
+PORTAL_RESPONSES = counter(
+    "portal_responses_total", "Responses of the portal by spider callback and status", ["callback", "status"])
+ITEMS = counter("portal_items_total", "Items scraped by type", ["type"])
+COMMITS = counter("portal_commits_total", "Batches of items committed by the pipeline")
+TASKS = counter("portal_tasks_total", "Finished tasks by status", ["status"])
+FAILURES = counter("portal_failures_total", "Failed crawls and expired leases", ["kind"])
+
+
+class Span:
+    def __init__(self, stage, task_id):
+        self.stage = stage
+        self.task_id = task_id
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        record_span(self.stage, self.task_id, self.started, error=exc_type is not None)
+
+
+def span(stage, task_id=None):
+    # times a stage of a task: with span("flush", task_id): ...
+    if not METRICS_ENABLED:
+        return NULL_CONTEXT
+    return Span(stage, task_id)
+
+
+def record_span(stage, task_id, started, ended=None, error=False):
+    # a stage that started earlier (time.time()), ending now unless given
+    if not METRICS_ENABLED:
+        return
+    ended = ended or time.time()
+    STAGE_SECONDS.labels(stage).observe(ended - started)
+    if trace_logger.isEnabledFor(logging.DEBUG):
+        trace_logger.debug(json.dumps({"task": task_id, "span": stage, "start": round(started, 6),
+                                       "seconds": round(ended - started, 6), "error": error, "pid": os.getpid()}))
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in registry.items()}
+
+
+def snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, "%s-%d.json" % (socket.gethostname(), pid or os.getpid()))
+
+
+def write_snapshot(path=None, snap=None):
+    if not METRICS_ENABLED:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = path or snapshot_path()
+    with open(path + ".tmp", "w") as f:
+        json.dump(snap if snap is not None else snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def retired_path(path):
+    return os.path.join(METRICS_DIR, RETIRED_PREFIX + os.path.basename(path))
+
+
+def retire_snapshot():
+    # when the process stops: its last snapshot is kept as retired, and the
+    # writer doesn't write it again
+    if _stopped.is_set():
+        return
+    _stopped.set()
+    write_snapshot(retired_path(snapshot_path()))
+    try:
+        os.remove(snapshot_path())
+    except FileNotFoundError:
+        pass
+
+
+_writer = None
+_stopped = threading.Event()
+
+
+def start_writer():
+    # writes this process's snapshot every METRICS_WRITE_SECONDS, until
+    # retire_snapshot (at the latest at exit)
+    global _writer
+    if not METRICS_ENABLED or _writer is not None:
+        return
+
+    def write():
+        while not _stopped.wait(METRICS_WRITE_SECONDS):
+            try:
+                write_snapshot()
+            except OSError:
+                logging.getLogger(__name__).exception("Could not write metrics")
+
+    _writer = threading.Thread(target=write, daemon=True)
+    _writer.start()
+    atexit.register(retire_snapshot)
+
+
+def merge(snapshots):
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            kind = Histogram if metric["type"] == "histogram" else Counter
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for values, sample in metric["samples"]:
+                key = tuple(values)
+                target["samples"][key] = kind.merge(target["samples"][key], sample) \
+                    if key in target["samples"] else sample
+    return merged
+
+
+def unmerge(merged):
+    # merged metrics as a snapshot
+    return {name: dict(metric, samples=[[list(values), sample] for values, sample in metric["samples"].items()])
+            for name, metric in merged.items()}
+
+
+def compact_retired(paths):
+    # adds the retired snapshots up into one; each is claimed by renaming it
+    # first, so no other process adds it up too
+    claimed, snapshots = [], []
+    for path in paths:
+        try:
+            os.rename(path, path + ".claimed")
+            claimed.append(path + ".claimed")
+            with open(path + ".claimed", "r") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    if snapshots:
+        name = "%s-%d-%d.json" % (socket.gethostname(), os.getpid(), time.time_ns())
+        write_snapshot(retired_path(name), unmerge(merge(snapshots)))
+    for path in claimed:
+        os.remove(path)
+
+
+def collect():
+    # the metrics of this process and the last snapshots of all the others,
+    # in the prometheus text format
+    own = snapshot_path()
+    snapshots = [snapshot()]
+    stale = time.time() - METRICS_STALE_WRITES * METRICS_WRITE_SECONDS
+    retired = []
+    if os.path.isdir(METRICS_DIR):
+        for name in os.listdir(METRICS_DIR):
+            path = os.path.join(METRICS_DIR, name)
+            if not name.endswith(".json") or path == own:
+                continue
+            try:
+                if not name.startswith(RETIRED_PREFIX) and os.path.getmtime(path) < stale:
+                    # of a process that died, whoever renames it retires it
+                    os.rename(path, retired_path(path))
+                    path = retired_path(path)
+                with open(path, "r") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+            if os.path.basename(path).startswith(RETIRED_PREFIX):
+                retired.append(path)
+    if len(retired) > METRICS_RETIRED_FILES:
+        compact_retired(retired)
+    return render(merge(snapshots))
+
+
+def render(metrics):
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append("# HELP %s %s" % (name, metric["help"]))
+        lines.append("# TYPE %s %s" % (name, metric["type"]))
+        for values, sample in sorted(metric["samples"].items()):
+            labels = list(zip(metric["labels"], values))
+            if metric["type"] != "histogram":
+                lines.append("%s%s %s" % (name, format_labels(labels), format_value(sample)))
+                continue
+            counts, total = sample
+            cumulative = 0
+            for bound, count in zip(BUCKETS, counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else format_value(bound)
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + [("le", le)]), cumulative))
+            lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(total)))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), cumulative))
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = collect().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, host="0.0.0.0"):
+    # /metrics of a process without the API (see worker.py)
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,140 @@
+# Limits on the requests all crawls of a scrape process make to the portal.
+#
+# A CrawlerService runs many crawls on one reactor, each with scrapy's own
+# per crawl concurrency, so without a shared limit the portal sees the sum of
+# all of them. The governor is one per process (see get_governor) and used
+# by GovernorMiddleware for every request.
+
+import collections
+import asyncio
+import time
+
+
+class PortalGovernor:
+    """
+    A token bucket of rate requests per second (up to burst at once) and a
+    limit on the requests in flight, adapted to the portal's health like TCP
+    congestion control (AIMD): it grows by one per limit requests answered
+    in time, and is multiplied by backoff when a request fails (5xx, 429,
+    connection errors) or the moving average latency goes over
+    target_latency, at most once per round trip.
+    """
+
+    def __init__(self, rate=30.0, burst=30, min_concurrency=2, max_concurrency=48, start_concurrency=16,
+                 target_latency=2.0, backoff=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(start_concurrency)
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.wake_handle = None
+        self.last_decrease = 0.0
+        # moving averages
+        self.latency = None
+        self.error_rate = 0.0
+        self.counts = collections.Counter()
+
+    def _take(self):
+        if self.in_flight >= int(self.limit):
+            return False
+        if self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        self.in_flight += 1
+        return True
+
+    async def acquire(self):
+        # first come first served, a request never overtakes waiting ones
+        if not self.waiters and self._take():
+            return
+        self.counts["waited"] += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        if self.wake_handle is None:
+            # nothing in flight may be left to wake it up
+            self._wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was given to it just before
+                self.in_flight -= 1
+                self._wake()
+            raise
+
+    def release(self, latency=None, failed=False):
+        # latency is None when no response came back
+        self.in_flight -= 1
+        self.counts["requests"] += 1
+        self.error_rate = 0.9 * self.error_rate + 0.1 * failed
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if failed or (self.latency or 0) > self.target_latency:
+            self.counts["failed" if failed else "slow"] += 1
+            # the requests still in flight were sent before the portal
+            # slowed down, they don't count again
+            now = time.monotonic()
+            if now - self.last_decrease > (self.latency or self.target_latency):
+                self.limit = max(self.min_concurrency, self.limit * self.backoff)
+                self.last_decrease = now
+                self.counts["decreases"] += 1
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        self._wake()
+
+    def _wake(self):
+        if self.wake_handle is not None:
+            self.wake_handle.cancel()
+            self.wake_handle = None
+        while self.waiters:
+            waiter = self.waiters[0]
+            if waiter.done():
+                # cancelled
+                self.waiters.popleft()
+                continue
+            if not self._take():
+                break
+            self.waiters.popleft()
+            waiter.set_result(None)
+        # out of tokens, the next one comes in (1 - tokens) / rate seconds
+        if self.waiters and self.in_flight < int(self.limit):
+            delay = (1 - self.tokens) / self.rate
+            self.wake_handle = asyncio.get_running_loop().call_later(delay, self._wake)
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 1),
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiters),
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            **self.counts,
+        }
+
+
+_governor = None
+
+
+def get_governor(settings):
+    # the governor of this process, made from the first crawler's settings
+    global _governor
+    if _governor is None:
+        _governor = PortalGovernor(
+            rate=settings.getfloat("GOVERNOR_RATE"),
+            burst=settings.getint("GOVERNOR_BURST"),
+            min_concurrency=settings.getint("GOVERNOR_MIN_CONCURRENCY"),
+            max_concurrency=settings.getint("GOVERNOR_MAX_CONCURRENCY"),
+            start_concurrency=settings.getint("GOVERNOR_START_CONCURRENCY"),
+            target_latency=settings.getfloat("GOVERNOR_TARGET_LATENCY"),
+        )
+    return _governor
@@ -1,38 +1,50 @@
-# Define here the models for your scraped items
-#
-# See documentation in:
-# https://docs.scrapy.org/en/latest/topics/items.html
-
-import scrapy
-
-
-# item as a dict
-class CourseScoreItem(scrapy.Item):
-    course_id = scrapy.Field()
-    course_name = scrapy.Field()
-    credit_hours = scrapy.Field()
-    teacher = scrapy.Field()
-    section_title = scrapy.Field()
-    title = scrapy.Field()
-    marks = scrapy.Field()
-    total_marks = scrapy.Field()
-    datetime = scrapy.Field()
-
-
-class StudentProfileItem(scrapy.Item):
-    name = scrapy.Field()
-    registration_number = scrapy.Field()
-
-
-class AttendanceItem(scrapy.Item):
-    course_id = scrapy.Field()
-    attendance_type = scrapy.Field()
-    topic = scrapy.Field()
-    attended = scrapy.Field()
-    start_time = scrapy.Field()
-    end_time = scrapy.Field()
-
-
-class ErrorItem(scrapy.Item):
-    url = scrapy.Field()
-    error = scrapy.Field()
+# Define here the models for your scraped items
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/items.html
+
+import scrapy
+
+
+# item as a dict
+class CourseScoreItem(scrapy.Item):
+    course_id = scrapy.Field()
+    course_name = scrapy.Field()
+    credit_hours = scrapy.Field()
+    teacher = scrapy.Field()
+    section_title = scrapy.Field()
+    title = scrapy.Field()
+    marks = scrapy.Field()
+    total_marks = scrapy.Field()
+    datetime = scrapy.Field()
+    position = scrapy.Field()
+
+
+class StudentProfileItem(scrapy.Item):
+    name = scrapy.Field()
+    registration_number = scrapy.Field()
+
+
+class AttendanceItem(scrapy.Item):
+    course_id = scrapy.Field()
+    attendance_type = scrapy.Field()
+    topic = scrapy.Field()
+    attended = scrapy.Field()
+    start_time = scrapy.Field()
+    end_time = scrapy.Field()
+    position = scrapy.Field()
+
+
+# follows the rows of a course's marks or attendance page, changed=False
+# when the page is the same as in the last scrape and wasn't parsed
+class CoursePageItem(scrapy.Item):
+    course_id = scrapy.Field()
+    page = scrapy.Field()
+    fingerprint = scrapy.Field()
+    rows = scrapy.Field()
+    changed = scrapy.Field()
+
+
+class ErrorItem(scrapy.Item):
+    url = scrapy.Field()
+    error = scrapy.Field()
@@ -1,103 +1,320 @@
-# Define here the models for your spider middleware
-#
-# See documentation in:
-# https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-
-from scrapy import signals
-
-# useful for handling different item types with a single interface
-from itemadapter import is_item, ItemAdapter
-
-
-class PortalSpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
-
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
-
-        # Should return None or raise an exception.
-        return None
-
-    def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
-
-        # Must return an iterable of Request, or item objects.
-        for i in result:
-            yield i
-
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
-
-        # Should return either None or an iterable of Request or item objects.
-        pass
-
-    def process_start_requests(self, start_requests, spider):
-        # Called with the start requests of the spider, and works
-        # similarly to the process_spider_output() method, except
-        # that it doesn’t have a response associated.
-
-        # Must return only requests (not items).
-        for r in start_requests:
-            yield r
-
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
-
-
-class PortalDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
-
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
-        return None
-
-    def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
-
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
-        return response
-
-    def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
-
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
-
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
+# Define here the models for your spider middleware
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+# useful for handling different item types with a single interface
+from itemadapter import is_item, ItemAdapter
+
+from portal.governor import get_governor
+import metrics
+
+from urllib.parse import urlparse
+import collections
+import functools
+import hashlib
+import asyncio
+import gzip
+import json
+import time
+import os
+
+
+class PortalSpiderMiddleware:
+    # Not all methods need to be defined. If a method is not defined,
+    # scrapy acts as if the spider middleware does not modify the
+    # passed objects.
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # This method is used by Scrapy to create your spiders.
+        s = cls()
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_spider_input(self, response, spider):
+        # Called for each response that goes through the spider
+        # middleware and into the spider.
+
+        # Should return None or raise an exception.
+        return None
+
+    def process_spider_output(self, response, result, spider):
+        # Called with the results returned from the Spider, after
+        # it has processed the response.
+
+        # Must return an iterable of Request, or item objects.
+        for i in result:
+            yield i
+
+    def process_spider_exception(self, response, exception, spider):
+        # Called when a spider or process_spider_input() method
+        # (from other spider middleware) raises an exception.
+
+        # Should return either None or an iterable of Request or item objects.
+        pass
+
+    def process_start_requests(self, start_requests, spider):
+        # Called with the start requests of the spider, and works
+        # similarly to the process_spider_output() method, except
+        # that it doesn’t have a response associated.
+
+        # Must return only requests (not items).
+        for r in start_requests:
+            yield r
+
+    def spider_opened(self, spider):
+        spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class PortalDownloaderMiddleware:
+    # Not all methods need to be defined. If a method is not defined,
+    # scrapy acts as if the downloader middleware does not modify the
+    # passed objects.
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # This method is used by Scrapy to create your spiders.
+        s = cls()
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_request(self, request, spider):
+        # Called for each request that goes through the downloader
+        # middleware.
+
+        # Must either:
+        # - return None: continue processing this request
+        # - or return a Response object
+        # - or return a Request object
+        # - or raise IgnoreRequest: process_exception() methods of
+        #   installed downloader middleware will be called
+        return None
+
+    def process_response(self, request, response, spider):
+        # Called with the response returned from the downloader.
+
+        # Must either;
+        # - return a Response object
+        # - return a Request object
+        # - or raise IgnoreRequest
+        return response
+
+    def process_exception(self, request, exception, spider):
+        # Called when a download handler or a process_request()
+        # (from other downloader middleware) raises an exception.
+
+        # Must either:
+        # - return None: continue processing this exception
+        # - return a Response object: stops process_exception() chain
+        # - return a Request object: stops process_exception() chain
+        pass
+
+    def spider_opened(self, spider):
+        spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class GovernorMiddleware:
+    """
+    Every request to the portal waits for the PortalGovernor of the process
+    (see portal/governor.py), shared by all crawls of a CrawlerService, and
+    reports back how long the portal took to answer and whether it failed.
+    """
+
+    def __init__(self, governor, stats):
+        self.governor = governor
+        self.stats = stats
+        # requests holding a slot of the governor, with their start time
+        self.held = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("GOVERNOR_ENABLED"):
+            raise NotConfigured
+        middleware = cls(get_governor(crawler.settings), crawler.stats)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    async def process_request(self, request, spider):
+        started = time.monotonic()
+        await self.governor.acquire()
+        now = time.monotonic()
+        self.held[request] = now
+        self.stats.inc_value("governor/wait_time", now - started, spider=spider)
+        return None
+
+    def process_response(self, request, response, spider):
+        started = self.held.pop(request, None)
+        if started is not None:
+            self.governor.release(time.monotonic() - started, failed=response.status >= 500 or response.status == 429)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if self.held.pop(request, None) is not None:
+            # a request dropped by a middleware isn't the portal's fault
+            self.governor.release(failed=not isinstance(exception, IgnoreRequest))
+        return None
+
+    def spider_closed(self, spider):
+        # requests cancelled with the crawl
+        for _ in range(len(self.held)):
+            self.governor.release()
+        self.held.clear()
+        spider.logger.debug("Portal governor: %s" % self.governor.stats())
+
+
+class MetricsMiddleware:
+    """
+    Times every round trip to the portal and counts its responses, by the
+    spider callback the request is for (see metrics.py).
+    """
+
+    def __init__(self):
+        # requests sent, with their start time
+        self.sent = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not metrics.METRICS_ENABLED:
+            raise NotConfigured
+        return cls()
+
+    def process_request(self, request, spider):
+        self.sent[request] = time.perf_counter()
+        return None
+
+    def process_response(self, request, response, spider):
+        started = self.sent.pop(request, None)
+        if started is not None:
+            callback = callback_name(request)
+            metrics.PORTAL_REQUEST_SECONDS.labels(callback).observe(time.perf_counter() - started)
+            metrics.PORTAL_RESPONSES.labels(callback, response.status).inc()
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if self.sent.pop(request, None) is not None and not isinstance(exception, IgnoreRequest):
+            metrics.PORTAL_RESPONSES.labels(callback_name(request), "error").inc()
+        return None
+
+
+def callback_name(request):
+    return getattr(request.callback, "__name__", "parse")
+
+
+class ReplayMiddleware:
+    """
+    Records the portal's responses of a crawl to REPLAY_DIR and replays them
+    later without the network (REPLAY_MODE = "record" or "replay").
+
+    Bodies are stored gzipped under their sha1, so pages that are the same
+    across sessions are stored once. Every session has an index mapping a
+    request (method, path, cookiejar, and how many times it was requested
+    before, as the same page is loaded once per course) to its response.
+    Replayed responses can be delayed by REPLAY_LATENCY seconds.
+    """
+
+    def __init__(self, mode, directory, session, latency, stats):
+        self.mode = mode
+        self.directory = directory
+        self.session = session
+        self.latency = latency
+        self.stats = stats
+        self.seen = collections.Counter()
+        self.index = {} if mode == "record" else load_index(self.index_path())
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        mode = settings.get("REPLAY_MODE")
+        if not mode:
+            raise NotConfigured
+        if mode not in ("record", "replay"):
+            raise NotConfigured("Unknown REPLAY_MODE %r" % mode)
+        middleware = cls(
+            mode,
+            settings.get("REPLAY_DIR"),
+            settings.get("REPLAY_SESSION") or settings.get("SESSION_ID"),
+            settings.getfloat("REPLAY_LATENCY"),
+            crawler.stats,
+        )
+        if mode == "record":
+            crawler.signals.connect(middleware.save_index, signal=signals.spider_closed)
+        return middleware
+
+    def index_path(self):
+        return os.path.join(self.directory, "sessions", "%s.json" % self.session)
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest[:2], "%s.gz" % digest)
+
+    def request_key(self, request):
+        url = urlparse(request.url)
+        path = url.path + ("?" + url.query if url.query else "")
+        key = "%s %s %s" % (request.method, path, request.meta.get("cookiejar", ""))
+        # n-th time this request is made in the crawl
+        self.seen[key] += 1
+        return "%s #%d" % (key, self.seen[key])
+
+    async def process_request(self, request, spider):
+        if self.mode == "record":
+            return None
+
+        key = self.request_key(request)
+        recorded = self.index.get(key)
+        if recorded is None:
+            self.stats.inc_value("replay/miss", spider=spider)
+            raise IgnoreRequest("No recorded response for %s" % key)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.stats.inc_value("replay/hit", spider=spider)
+        headers = Headers(recorded["headers"])
+        body = load_blob(self.blob_path(recorded["body"]))
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return respcls(url=request.url, status=recorded["status"], headers=headers, body=body,
+                       request=request)
+
+    def process_response(self, request, response, spider):
+        if self.mode != "record":
+            return response
+
+        digest = hashlib.sha1(response.body).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(gzip.compress(response.body))
+            os.replace(path + ".tmp", path)
+        self.index[self.request_key(request)] = {
+            "status": response.status,
+            "headers": {
+                k.decode("latin-1"): [v.decode("latin-1") for v in values]
+                for k, values in response.headers.items()
+            },
+            "body": digest,
+        }
+        self.stats.inc_value("replay/recorded", spider=spider)
+        return response
+
+    def save_index(self, spider):
+        os.makedirs(os.path.dirname(self.index_path()), exist_ok=True)
+        with open(self.index_path(), "w") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        spider.logger.info("Recorded %d responses to %s" % (len(self.index), self.index_path()))
+
+
+@functools.lru_cache(maxsize=64)
+def load_index(path):
+    # shared by the crawls of a process replaying the same session
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=1024)
+def load_blob(path):
+    with open(path, "rb") as f:
+        return gzip.decompress(f.read())
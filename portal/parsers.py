@@ -0,0 +1,61 @@
+# Table extraction for the marks and attendance pages.
+#
+# Each table is walked once with precompiled XPath (the same expressions
+# scrapy builds for the spider's css selectors) and the cells of a row are
+# read straight from the lxml tree, instead of one css selector per cell.
+
+from lxml import etree
+from parsel import Selector
+from parsel.csstranslator import HTMLTranslator
+
+
+css_to_xpath = HTMLTranslator().css_to_xpath
+
+QUIZ_LISTINGS = etree.XPath(css_to_xpath("div.quiz_listing"))
+TABLE_ROWS = etree.XPath(css_to_xpath("tbody > tr"))
+TEXT = etree.XPath(css_to_xpath("::text"))
+ATTENDANCE_ROWS = {
+    _id: etree.XPath(css_to_xpath(f"#{_id} .table-responsive table tbody > tr"))
+    for _id in ["Class", "Lab"]
+}
+
+
+def first_text(element):
+    # first text node directly inside the element, like "::text" .get()
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+def row_texts(row, n):
+    # css("td:nth-child(k)::text").get() for k = 1..n
+    cells = [child for child in row if isinstance(child.tag, str)][:n]
+    if len(cells) == n and all(cell.tag == "td" and next(cell.iterdescendants("td"), None) is None
+                               for cell in cells):
+        return [first_text(cell) for cell in cells]
+    # missing cells or tables inside cells, where the selectors can match
+    # other cells than the row's own
+    row = Selector(root=row, type="html")
+    return [row.css(f"td:nth-child({k})::text").get() for k in range(1, n + 1)]
+
+
+def marks_rows(response):
+    # (section_title, title, marks, total_marks, datetime) of every row
+    listings = QUIZ_LISTINGS(response.selector.root)
+    # zipping adjacent div and table
+    section_title_elems = [child for listing in listings for child in listing if child.tag == "div"]
+    quiz_tables = [child for listing in listings for child in listing if child.tag == "table"]
+    for section_title_elem, quiz_table in zip(section_title_elems, quiz_tables):
+        section_title = TEXT(section_title_elem)[0].strip()
+        for row in TABLE_ROWS(quiz_table):
+            title, marks, total_marks, datetime = row_texts(row, 4)
+            yield section_title, title.strip(), marks.strip(), total_marks.strip(), datetime.strip()
+
+
+def attendance_rows(response, _id):
+    # (topic, status, start_time, end_time) of every row of the Class or Lab table
+    for row in ATTENDANCE_ROWS[_id](response.selector.root):
+        yield tuple(text.strip() for text in row_texts(row, 4))
@@ -1,64 +1,182 @@
-# Define your item pipelines here
-#
-# Don't forget to add your pipeline to the ITEM_PIPELINES setting
-# See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-
-import sys
-
-sys.path.append("..")
-
-# useful for handling different item types with a single interface
-from itemadapter import ItemAdapter
-
-from database import DataBase
-from task import Task
-
-from portal.items import (
-    StudentProfileItem, 
-    CourseScoreItem, 
-    AttendanceItem,
-    ErrorItem
-    )
-
-import json
-
-
-class PortalPipeline:
-    def open_spider(self, spider):
-        self.task_id = spider.settings.get("SESSION_ID")
-        self.db = DataBase()
-
-        self.items = []
-
-        # update task status to IN_PROGRESS
-        self.db.create_task(self.task_id)
-        self.db.update_task_status(self.task_id, Task.IN_PROGRESS)
-
-    def process_item(self, item, spider):
-        if isinstance(item, ErrorItem):
-            # update task status to FAILED
-            self.close_spider(spider)
-            self.db.update_task_status(self.task_id, Task.FAILED, item['error'])
-            return {}
-        elif isinstance(item, StudentProfileItem):
-            self.db.add_student_profile_data(self.task_id, item)
-        elif isinstance(item, CourseScoreItem) or isinstance(item, AttendanceItem):
-            self.items.append(item)
-            if len(self.items) >= 100:
-                self.add_data_to_db()
-        return item
-
-    def close_spider(self, spider):
-        self.add_data_to_db()
-        # update task status
-        task = self.db.get_task(self.task_id)
-        if task.status != Task.FAILED:
-            self.db.update_task_status(self.task_id, Task.SUCCESS)
-
-    def add_data_to_db(self):
-        self.db.create_task(self.task_id)
-        course_score_items = [i for i in self.items if isinstance(i, CourseScoreItem)]
-        self.db.add_course_score_data(self.task_id, course_score_items)
-        attendance_items = [i for i in self.items if isinstance(i, AttendanceItem)]
-        self.db.add_attendance_data(self.task_id, attendance_items)
-        self.items = []
+# Define your item pipelines here
+#
+# Don't forget to add your pipeline to the ITEM_PIPELINES setting
+# See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+
+import sys
+
+sys.path.append("..")
+
+# useful for handling different item types with a single interface
+from itemadapter import ItemAdapter
+
+from database import DataBase, portal_dates
+from task import Task
+import events
+from response import task_response_body
+import metrics
+
+from portal.items import (
+    StudentProfileItem, 
+    CourseScoreItem, 
+    AttendanceItem,
+    CoursePageItem,
+    ErrorItem
+    )
+
+import json
+import time
+
+
+def split_pages(items, page, done):
+    # (items of the pages in done, the others)
+    complete, pending = [], []
+    for item in items:
+        (complete if (item["course_id"], page) in done else pending).append(item)
+    return complete, pending
+
+
+class PortalPipeline:
+    def open_spider(self, spider):
+        self.task_id = spider.settings.get("SESSION_ID")
+        self.db = DataBase()
+
+        # items are written in batches, a batch is flushed when it's big
+        # enough or has waited long enough, in one transaction
+        self.flush_items = spider.settings.getint("PIPELINE_FLUSH_ITEMS")
+        self.flush_seconds = spider.settings.getfloat("PIPELINE_FLUSH_SECONDS")
+        self.profile = None
+        self.course_score_items = []
+        self.attendance_items = []
+        self.pages = []
+        self.last_flush = time.monotonic()
+
+        # progress published with every flush
+        self.courses_total = None
+        self.courses_done = 0
+        self.rows_ingested = 0
+        self.pages_skipped = 0
+        self.rows_skipped = 0
+
+        # update task status to IN_PROGRESS
+        self.db.create_task(self.task_id)
+        self.db.update_task_status(self.task_id, Task.IN_PROGRESS)
+        events.publish(self.task_id, Task.IN_PROGRESS)
+
+        # pages of the session's last scrape, when its data was kept for an
+        # incremental re-scrape
+        self.incremental = bool(self.previous_pages(spider))
+
+    def previous_pages(self, spider):
+        spider.previous_pages = self.db.get_course_pages(self.task_id)
+        return spider.previous_pages
+
+    def process_item(self, item, spider):
+        metrics.ITEMS.labels(type(item).__name__).inc()
+        if isinstance(item, ErrorItem):
+            # update task status to FAILED
+            self.flush(spider)
+            self.db.update_task_status(self.task_id, Task.FAILED, item['error'])
+            events.publish(self.task_id, Task.FAILED, item['error'])
+            return {}
+        elif isinstance(item, StudentProfileItem):
+            self.profile = item
+        elif isinstance(item, CourseScoreItem):
+            self.course_score_items.append(item)
+            return item
+        elif isinstance(item, AttendanceItem):
+            self.attendance_items.append(item)
+            return item
+        elif isinstance(item, CoursePageItem):
+            self.pages.append(item)
+            if not item["changed"]:
+                self.pages_skipped += 1
+                self.rows_skipped += item["rows"]
+            # the attendance page is the last one of a course
+            if item["page"] == "attendance":
+                self.courses_done += 1
+        else:
+            return item
+
+        if (len(self.course_score_items) + len(self.attendance_items) >= self.flush_items
+                or time.monotonic() - self.last_flush >= self.flush_seconds):
+            self.flush(spider)
+        return item
+
+    def close_spider(self, spider):
+        # the last batch is committed together with the final status
+        self.flush(spider, commit=False, whole_pages=False)
+        task = self.db.get_task(self.task_id)
+        if task.status != Task.FAILED:
+            if self.incremental and getattr(spider, "course_positions", None) is not None:
+                self.db.delete_other_courses(self.task_id, spider.course_positions, commit=False)
+            # the response is stored with the task, /taskdata serves it as is
+            with metrics.span("response", self.task_id):
+                task_data = self.db.get_task_data(self.task_id)
+                response = task_response_body(task_data) if task_data[1] else None
+            with metrics.span("commit", self.task_id):
+                self.db.update_task_status(self.task_id, Task.SUCCESS, response=response)
+            metrics.COMMITS.inc()
+            metrics.TASKS.labels(Task.SUCCESS).inc()
+            events.publish(self.task_id, Task.SUCCESS, progress=self.progress())
+            if self.incremental:
+                spider.logger.info("Incremental re-scrape skipped %d pages and %d rows"
+                                   % (self.pages_skipped, self.rows_skipped))
+        else:
+            self.db.session.commit()
+            metrics.TASKS.labels(Task.FAILED).inc()
+        spider.logger.debug("Date parsing: %s" % portal_dates.stats())
+        self.db.remove()
+
+    def flush(self, spider, commit=True, whole_pages=True):
+        with metrics.span("flush", self.task_id):
+            self._flush(spider, commit, whole_pages)
+        if commit:
+            metrics.COMMITS.inc()
+
+    def _flush(self, spider, commit, whole_pages):
+        course_score_items, attendance_items = self.course_score_items, self.attendance_items
+        self.course_score_items, self.attendance_items = [], []
+        if whole_pages:
+            # rows whose CoursePageItem hasn't come yet (items of parallel
+            # course chains interleave) wait for it, a page's rows are
+            # written, and diffed on a re-scrape, all in one batch
+            done = {(page["course_id"], page["page"]) for page in self.pages}
+            course_score_items, self.course_score_items = split_pages(course_score_items, "marks", done)
+            attendance_items, self.attendance_items = split_pages(attendance_items, "attendance", done)
+        self.rows_ingested += len(course_score_items) + len(attendance_items)
+        self.courses_total = spider.courses_total
+        counts = self.db.write_batch(
+            self.task_id,
+            profile=self.profile,
+            course_score_data=course_score_items,
+            attendance_data=attendance_items,
+            pages=self.pages,
+            diff=self.incremental,
+            commit=False,
+        )
+        self.rows_skipped += counts["kept"]
+        self.db.update_progress(
+            self.task_id,
+            courses_total=self.courses_total,
+            courses_done=self.courses_done,
+            rows_ingested=self.rows_ingested,
+            pages_skipped=self.pages_skipped,
+            rows_skipped=self.rows_skipped,
+            commit=commit,
+        )
+        if commit:
+            events.publish(self.task_id, Task.IN_PROGRESS, progress=self.progress())
+        self.profile = None
+        self.pages = []
+        self.last_flush = time.monotonic()
+
+    def progress(self):
+        # same shape as database.Task.progress
+        return {
+            "coursesTotal": self.courses_total,
+            "coursesDone": self.courses_done,
+            "rowsIngested": self.rows_ingested,
+            "pagesSkipped": self.pages_skipped,
+            "rowsSkipped": self.rows_skipped,
+        }
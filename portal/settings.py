@@ -1,95 +1,152 @@
-# Scrapy settings for portal project
-#
-# For simplicity, this file contains only settings considered important or
-# commonly used. You can find more settings consulting the documentation:
-#
-#     https://docs.scrapy.org/en/latest/topics/settings.html
-#     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-
-BOT_NAME = "portal"
-
-SPIDER_MODULES = ["portal.spiders"]
-NEWSPIDER_MODULE = "portal.spiders"
-
-
-# Crawl responsibly by identifying yourself (and your website) on the user-agent
-#USER_AGENT = "portal (+http://www.yourdomain.com)"
-
-# Obey robots.txt rules
-ROBOTSTXT_OBEY = False
-
-ITEM_PIPELINES = {
-   "portal.pipelines.PortalPipeline": 300,
-}
-
-# Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
-
-# Configure a delay for requests for the same website (default: 0)
-# See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
-# See also autothrottle settings and docs
-#DOWNLOAD_DELAY = 3
-# The download delay setting will honor only one of:
-#CONCURRENT_REQUESTS_PER_DOMAIN = 16
-#CONCURRENT_REQUESTS_PER_IP = 16
-
-# Disable cookies (enabled by default)
-#COOKIES_ENABLED = False
-
-# Disable Telnet Console (enabled by default)
-#TELNETCONSOLE_ENABLED = False
-
-# Override the default request headers:
-#DEFAULT_REQUEST_HEADERS = {
-#    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-#    "Accept-Language": "en",
-#}
-
-# Enable or disable spider middlewares
-# See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    "portal.middlewares.PortalSpiderMiddleware": 543,
-#}
-
-# Enable or disable downloader middlewares
-# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    "portal.middlewares.PortalDownloaderMiddleware": 543,
-#}
-
-# Enable or disable extensions
-# See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-#}
-
-# Configure item pipelines
-# See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-
-
-# Enable and configure the AutoThrottle extension (disabled by default)
-# See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-#AUTOTHROTTLE_ENABLED = True
-# The initial download delay
-#AUTOTHROTTLE_START_DELAY = 5
-# The maximum download delay to be set in case of high latencies
-#AUTOTHROTTLE_MAX_DELAY = 60
-# The average number of requests Scrapy should be sending in parallel to
-# each remote server
-#AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
-# Enable showing throttling stats for every response received:
-#AUTOTHROTTLE_DEBUG = False
-
-# Enable and configure HTTP caching (disabled by default)
-# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = "httpcache"
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
-
-# Set settings whose default value is deprecated to a future-proof value
-REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
-TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
-FEED_EXPORT_ENCODING = "utf-8"
+# Scrapy settings for portal project
+#
+# For simplicity, this file contains only settings considered important or
+# commonly used. You can find more settings consulting the documentation:
+#
+#     https://docs.scrapy.org/en/latest/topics/settings.html
+#     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+#     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+
+import os
+
+BOT_NAME = "portal"
+
+SPIDER_MODULES = ["portal.spiders"]
+NEWSPIDER_MODULE = "portal.spiders"
+
+
+# Crawl responsibly by identifying yourself (and your website) on the user-agent
+#USER_AGENT = "portal (+http://www.yourdomain.com)"
+
+# Obey robots.txt rules
+ROBOTSTXT_OBEY = False
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+
+# Base url of the student portal
+PORTAL_URL = os.environ.get("PORTAL_URL", "https://atk-cms.comsats.edu.pk:8090")
+
+# Crawl all courses of a student at once. The portal keeps the selected course
+# in session state, so every MarksSummary/Attendance page is checked against
+# the course title found with COURSE_CONTEXT_XPATH; courses that came back for
+# another course are crawled again one at a time, and so are all courses left
+# once a page has no such title to check.
+PARALLEL_COURSES = os.environ.get("PARALLEL_COURSES", "") == "1"
+COURSE_CONTEXT_XPATH = "string(//*[contains(@class, 'course-title')])"
+COURSE_CONTEXT_RETRIES = 2
+
+ITEM_PIPELINES = {
+   "portal.pipelines.PortalPipeline": 300,
+}
+# PortalPipeline writes its buffered items once this many are waiting or
+# this many seconds have passed since its last write
+PIPELINE_FLUSH_ITEMS = int(os.environ.get("PIPELINE_FLUSH_ITEMS", 500))
+PIPELINE_FLUSH_SECONDS = float(os.environ.get("PIPELINE_FLUSH_SECONDS", 2))
+# parts of a course page (regexes) that change on every request and are left
+# out of its fingerprint, so an incremental re-scrape can tell unchanged pages
+PAGE_FINGERPRINT_IGNORE = [
+    r'<input[^>]*type="hidden"[^>]*>',
+]
+
+# Configure maximum concurrent requests performed by Scrapy (default: 16)
+#CONCURRENT_REQUESTS = 32
+
+# Configure a delay for requests for the same website (default: 0)
+# See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
+# See also autothrottle settings and docs
+#DOWNLOAD_DELAY = 3
+# The download delay setting will honor only one of:
+#CONCURRENT_REQUESTS_PER_DOMAIN = 16
+#CONCURRENT_REQUESTS_PER_IP = 16
+
+# Disable cookies (enabled by default)
+#COOKIES_ENABLED = False
+
+# Disable Telnet Console (enabled by default)
+#TELNETCONSOLE_ENABLED = False
+
+# Override the default request headers:
+#DEFAULT_REQUEST_HEADERS = {
+#    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+#    "Accept-Language": "en",
+#}
+
+# Enable or disable spider middlewares
+# See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+#SPIDER_MIDDLEWARES = {
+#    "portal.middlewares.PortalSpiderMiddleware": 543,
+#}
+
+# Enable or disable downloader middlewares
+# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+#DOWNLOADER_MIDDLEWARES = {
+#    "portal.middlewares.PortalDownloaderMiddleware": 543,
+#}
+DOWNLOADER_MIDDLEWARES = {
+    # after scrapy's middlewares, so redirects, cookies and compression are
+    # handled by them like for live responses
+    "portal.middlewares.ReplayMiddleware": 950,
+    # after retries, redirects and replays, so every request sent to the
+    # portal counts
+    "portal.middlewares.GovernorMiddleware": 960,
+    # closest to the downloader, timing the portal and nothing else
+    "portal.middlewares.MetricsMiddleware": 970,
+}
+
+# limit on the requests all crawls of a scrape process send to the portal
+# (portal/governor.py): GOVERNOR_RATE requests per second, and at most
+# GOVERNOR_MAX_CONCURRENCY in flight, less while the portal is slower than
+# GOVERNOR_TARGET_LATENCY seconds or fails. Every scrape process has its own,
+# the portal sees the sum of all of them
+GOVERNOR_ENABLED = os.environ.get("GOVERNOR_ENABLED", "1") == "1"
+GOVERNOR_RATE = float(os.environ.get("GOVERNOR_RATE", 30))
+GOVERNOR_BURST = int(os.environ.get("GOVERNOR_BURST", 30))
+GOVERNOR_MIN_CONCURRENCY = int(os.environ.get("GOVERNOR_MIN_CONCURRENCY", 2))
+GOVERNOR_MAX_CONCURRENCY = int(os.environ.get("GOVERNOR_MAX_CONCURRENCY", 48))
+GOVERNOR_START_CONCURRENCY = int(os.environ.get("GOVERNOR_START_CONCURRENCY", 16))
+GOVERNOR_TARGET_LATENCY = float(os.environ.get("GOVERNOR_TARGET_LATENCY", 2))
+
+# "record" saves the portal's responses of every crawl to REPLAY_DIR,
+# "replay" answers requests from a recording instead of the portal
+REPLAY_MODE = os.environ.get("REPLAY_MODE", "")
+REPLAY_DIR = os.environ.get("REPLAY_DIR", "fixtures")
+# recording to use (or record to), defaults to the crawl's SESSION_ID
+REPLAY_SESSION = os.environ.get("REPLAY_SESSION", "")
+# seconds added to every replayed response
+REPLAY_LATENCY = float(os.environ.get("REPLAY_LATENCY", 0))
+
+# Enable or disable extensions
+# See https://docs.scrapy.org/en/latest/topics/extensions.html
+#EXTENSIONS = {
+#    "scrapy.extensions.telnet.TelnetConsole": None,
+#}
+
+# Configure item pipelines
+# See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+
+
+# Enable and configure the AutoThrottle extension (disabled by default)
+# See https://docs.scrapy.org/en/latest/topics/autothrottle.html
+#AUTOTHROTTLE_ENABLED = True
+# The initial download delay
+#AUTOTHROTTLE_START_DELAY = 5
+# The maximum download delay to be set in case of high latencies
+#AUTOTHROTTLE_MAX_DELAY = 60
+# The average number of requests Scrapy should be sending in parallel to
+# each remote server
+#AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
+# Enable showing throttling stats for every response received:
+#AUTOTHROTTLE_DEBUG = False
+
+# Enable and configure HTTP caching (disabled by default)
+# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
+#HTTPCACHE_ENABLED = True
+#HTTPCACHE_EXPIRATION_SECS = 0
+#HTTPCACHE_DIR = "httpcache"
+#HTTPCACHE_IGNORE_HTTP_CODES = []
+#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+
+# Set settings whose default value is deprecated to a future-proof value
+REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
+TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+FEED_EXPORT_ENCODING = "utf-8"
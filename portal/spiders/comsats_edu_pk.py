@@ -1,156 +1,301 @@
-import scrapy
-import re
-
-
-from portal.items import (
-    StudentProfileItem, 
-    CourseScoreItem, 
-    AttendanceItem,
-    ErrorItem
-    )
-
-
-class ComsatsEduPkSpider(scrapy.Spider):
-    name = "comsats.edu.pk"
-    allowed_domains = ["comsats.edu.pk"]
-    start_urls = ["http://comsats.edu.pk/"]
-
-    custom_settings = dict(
-        DEFAULT_REQUEST_HEADERS={
-            'authority': 'atk-cms.comsats.edu.pk:8090',
-            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'accept-language': 'en-US,en;q=0.9',
-            'cache-control': 'max-age=0',
-            'referer': 'https://atk-cms.comsats.edu.pk:8090/Announcements',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36 Edg/113.0.1774.50',
-        }
-    )
-
-    courses = None
-
-    def start_requests(self):
-        session_id = self.settings.get("SESSION_ID")
-        self.cookies = {"ASP.NET_SessionId": session_id}
-        yield scrapy.Request(
-            url="https://atk-cms.comsats.edu.pk:8090/",
-            callback=self.parse,
-            cookies=self.cookies
-        )
-    
-    def parse(self, response):
-        if "COURSEREGISTRATION" not in response.url:
-            yield ErrorItem(error="Invalid Session ID")
-            return
-
-        # for course scores
-        yield scrapy.Request(
-            url="https://atk-cms.comsats.edu.pk:8090/Courses/Index",
-            callback=self.parse_index,
-        )
-
-        # for student profile
-        yield scrapy.Request(
-            url="https://atk-cms.comsats.edu.pk:8090/Profile/Index",
-            callback=self.parse_profile,
-        )
-
-    def parse_profile(self, response):
-        name = response.xpath("//*[contains(text(), 'Full Name')]/parent::div/text()[2]").get().strip()
-        registration_number = response.xpath("//*[contains(text(), 'Registration Number')]/parent::div/text()[2]").get().strip()
-        yield StudentProfileItem(
-            name=name,
-            registration_number=registration_number
-        )
-
-    def get_course_request(self):
-        # the site works by setting course first and then navigating to other pages. 
-        # Sending requests for all courses at once will result in wrong data
-        if self.courses:
-            course = self.courses.pop(0)
-            course_id = course.css("td:nth-child(1)::text").get().strip()
-            course_name = course.css("td:nth-child(2)::text").get().strip()
-            credit_hours = course.css("td:nth-child(3)::text").get().strip()
-            teacher = course.css("td:nth-child(4)::text").get().strip()
-
-            url = course.attrib['onclick']
-            url = re.search(r"window.location='(.*)'", url).group(1)
-            # settings course
-            return scrapy.Request(
-                url="https://atk-cms.comsats.edu.pk:8090" + url,
-                callback=self.parse_course,
-                meta={
-                    "course_id": course_id,
-                    "course_name": course_name,
-                    "credit_hours": credit_hours,
-                    "teacher": teacher,
-                },
-                dont_filter=True,
-            )
-
-
-    def parse_index(self, response):
-        self.courses = response.css("#RegisteredCourses table tbody > tr")
-        yield self.get_course_request()
-
-    def parse_course(self, response):
-        # marks summary request
-        yield scrapy.Request(
-            url=response.urljoin("/MarksSummary/Index"),
-            callback=self.parse_marks,
-            meta=response.meta,
-            dont_filter=True,
-        )
-
-    def parse_attendance(self, response):
-        # class and lab attendance
-        for _id in ["Class", "Lab"]:
-            for row in response.css(f"#{_id} .table-responsive table tbody > tr"):
-                topic = row.css("td:nth-child(1)::text").get().strip()
-                status = row.css("td:nth-child(2)::text").get().strip()
-                attended = "present" in status.lower()
-                start_time = row.css("td:nth-child(3)::text").get().strip()
-                end_time = row.css("td:nth-child(4)::text").get().strip()
-                yield AttendanceItem(
-                    course_id=response.meta["course_id"],
-                    attendance_type=_id.lower(),
-                    topic=topic,
-                    attended=attended,
-                    start_time=start_time,
-                    end_time=end_time,
-                )
-
-        if self.courses:
-            yield self.get_course_request()
-    
-    def parse_marks(self, response):
-        quizes_elems = response.css("div.quiz_listing")
-        # zipping adjacent div and table
-        quizes = zip(quizes_elems.xpath("./div"), quizes_elems.xpath("./table"))
-        for section_title_elem, quiz_table in quizes:
-            section_title = section_title_elem.css("::text").get().strip()
-            quiz_rows = quiz_table.css("tbody > tr")
-            for quiz_row in quiz_rows:
-                title = quiz_row.css("td:nth-child(1)::text").get().strip()
-                marks = quiz_row.css("td:nth-child(2)::text").get().strip()
-                total_marks = quiz_row.css("td:nth-child(3)::text").get().strip()
-                datetime = quiz_row.css("td:nth-child(4)::text").get().strip()
-                yield CourseScoreItem(
-                    course_id=response.meta["course_id"],
-                    course_name=response.meta["course_name"],
-                    credit_hours=response.meta["credit_hours"],
-                    teacher=response.meta["teacher"],
-                    section_title=section_title,
-                    title=title,
-                    marks=marks,
-                    total_marks=total_marks,
-                    datetime=datetime
-                )
-
-        # attendance request
-        yield scrapy.Request(
-            url="https://atk-cms.comsats.edu.pk:8090/Attendance/Index",
-            callback=self.parse_attendance,
-            meta=response.meta,
-            dont_filter=True,
-        )
-  
\ No newline at end of file
+import scrapy
+import hashlib
+import re
+
+from urllib.parse import urlparse
+
+
+from portal.items import (
+    StudentProfileItem, 
+    CourseScoreItem, 
+    AttendanceItem,
+    CoursePageItem,
+    ErrorItem
+    )
+from portal import parsers
+
+
+class ComsatsEduPkSpider(scrapy.Spider):
+    name = "comsats.edu.pk"
+    allowed_domains = ["comsats.edu.pk"]
+    start_urls = ["http://comsats.edu.pk/"]
+
+    custom_settings = dict(
+        DEFAULT_REQUEST_HEADERS={
+            'authority': 'atk-cms.comsats.edu.pk:8090',
+            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+            'accept-language': 'en-US,en;q=0.9',
+            'cache-control': 'max-age=0',
+            'referer': 'https://atk-cms.comsats.edu.pk:8090/Announcements',
+            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36 Edg/113.0.1774.50',
+        }
+    )
+
+    courses = None
+    courses_total = None
+    parallel = False
+    # False once a page of a parallel chain had no course title to check it
+    # with, the courses left are then crawled one at a time
+    course_context_found = True
+    # (course_id, page) -> (fingerprint, rows) of the last scrape of this
+    # session, set by PortalPipeline for an incremental re-scrape
+    previous_pages = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.portal_url = crawler.settings.get("PORTAL_URL").rstrip("/")
+        # allowing a portal stand-in (e.g. a local server) to be crawled
+        portal_host = urlparse(spider.portal_url).hostname
+        if not any(portal_host.endswith(domain) for domain in spider.allowed_domains):
+            spider.allowed_domains = spider.allowed_domains + [portal_host]
+        spider.fingerprint_ignore = [
+            re.compile(pattern.encode()) for pattern in crawler.settings.getlist("PAGE_FINGERPRINT_IGNORE")
+        ]
+        return spider
+
+    def start_requests(self):
+        session_id = self.settings.get("SESSION_ID")
+        # path is set so the cookie also applies when it is first added to
+        # a cookiejar by a request that isn't for "/" (see PARALLEL_COURSES)
+        self.cookies = [{"name": "ASP.NET_SessionId", "value": session_id, "path": "/"}]
+        yield scrapy.Request(
+            url=self.portal_url + "/",
+            callback=self.parse,
+            cookies=self.cookies
+        )
+    
+    def parse(self, response):
+        if "COURSEREGISTRATION" not in response.url:
+            yield ErrorItem(error="Invalid Session ID")
+            return
+
+        # for course scores
+        yield scrapy.Request(
+            url=self.portal_url + "/Courses/Index",
+            callback=self.parse_index,
+        )
+
+        # for student profile
+        yield scrapy.Request(
+            url=self.portal_url + "/Profile/Index",
+            callback=self.parse_profile,
+        )
+
+    def parse_profile(self, response):
+        name = response.xpath("//*[contains(text(), 'Full Name')]/parent::div/text()[2]").get().strip()
+        registration_number = response.xpath("//*[contains(text(), 'Registration Number')]/parent::div/text()[2]").get().strip()
+        yield StudentProfileItem(
+            name=name,
+            registration_number=registration_number
+        )
+
+    def get_course_info(self, row):
+        url = row.attrib['onclick']
+        return {
+            "course_id": row.css("td:nth-child(1)::text").get().strip(),
+            "course_name": row.css("td:nth-child(2)::text").get().strip(),
+            "credit_hours": row.css("td:nth-child(3)::text").get().strip(),
+            "teacher": row.css("td:nth-child(4)::text").get().strip(),
+            "url": re.search(r"window.location='(.*)'", url).group(1),
+        }
+
+    def get_course_request(self, course=None, cookiejar=None):
+        # the site works by setting course first and then navigating to other pages. 
+        # Sending requests for all courses at once will result in wrong data
+        # unless every response is checked against its course (PARALLEL_COURSES)
+        if course is None and self.courses:
+            course = self.courses.pop(0)
+        if course is not None:
+            meta = {
+                "course": course,
+                "course_id": course["course_id"],
+                "course_name": course["course_name"],
+                "credit_hours": course["credit_hours"],
+                "teacher": course["teacher"],
+            }
+            cookies = None
+            if cookiejar is not None:
+                # a new cookiejar doesn't have the session cookie yet
+                meta["cookiejar"] = cookiejar
+                cookies = self.cookies
+            # settings course
+            return scrapy.Request(
+                url=self.portal_url + course["url"],
+                callback=self.parse_course,
+                meta=meta,
+                cookies=cookies,
+                dont_filter=True,
+            )
+
+    def parse_index(self, response):
+        rows = response.css("#RegisteredCourses table tbody > tr")
+        self.courses = [self.get_course_info(row) for row in rows]
+        self.courses_total = len(self.courses)
+        # rows are stored with their position on the portal (see row_position)
+        self.course_positions = {course["course_id"]: n for n, course in enumerate(self.courses)}
+        self.parallel = self.settings.getbool("PARALLEL_COURSES")
+        if not self.parallel:
+            yield self.get_course_request()
+            return
+
+        # every course chain gets its own cookiejar, courses whose responses
+        # come back for another course are crawled one by one afterwards
+        courses, self.courses = self.courses, []
+        self.parallel_chains = len(courses)
+        # items are released in the portal's course order, see release_courses
+        self.course_order = [course["course_id"] for course in courses]
+        self.course_items = {}
+        for jar, course in enumerate(courses, start=1):
+            yield self.get_course_request(course, cookiejar=jar)
+
+    def is_course_context(self, response):
+        # the serial chain sets one course at a time, its pages are for it
+        if "cookiejar" not in response.meta:
+            return True
+        course_title = response.xpath(self.settings.get("COURSE_CONTEXT_XPATH")).get()
+        if not course_title and self.course_context_found:
+            self.logger.warning("No course title found with COURSE_CONTEXT_XPATH on %s, crawling the courses "
+                                "left one at a time" % response.url)
+            self.course_context_found = False
+        return self.course_context_found and response.meta["course_id"] in course_title
+
+    def retry_course(self, response):
+        course = response.meta["course"]
+        if not self.course_context_found:
+            # not a mismatch, the page couldn't be checked
+            self.courses.append(course)
+            yield from self.end_course_chain(response)
+            return
+        retries = course.get("retries", 0)
+        self.logger.debug("Course context mismatch for %s" % course["course_id"])
+        if retries >= self.settings.getint("COURSE_CONTEXT_RETRIES"):
+            yield ErrorItem(url=response.url, error="Could not load course %s" % course["course_id"])
+            return
+        course = dict(course, retries=retries + 1)
+        self.courses.append(course)
+        yield from self.end_course_chain(response)
+
+    def end_course_chain(self, response):
+        if "cookiejar" in response.meta:
+            self.parallel_chains -= 1
+            # the serial chain starts once all parallel chains are done
+            if self.parallel_chains == 0 and self.courses:
+                yield self.get_course_request()
+        elif self.courses:
+            yield self.get_course_request()
+
+    def parse_course(self, response):
+        # marks summary request
+        yield scrapy.Request(
+            url=response.urljoin("/MarksSummary/Index"),
+            callback=self.parse_marks,
+            meta=response.meta,
+            dont_filter=True,
+        )
+
+    def parse_attendance(self, response):
+        if not self.is_course_context(response):
+            yield from self.retry_course(response)
+            return
+
+        items = self.parse_attendance_items(response)
+        if self.parallel:
+            # marks of parallel chains are held back until the whole chain is verified
+            self.course_items[response.meta["course_id"]] = response.meta["marks_items"] + list(items)
+            yield from self.release_courses()
+        else:
+            yield from items
+
+        yield from self.end_course_chain(response)
+
+    def release_courses(self):
+        while self.course_order and self.course_order[0] in self.course_items:
+            yield from self.course_items.pop(self.course_order.pop(0))
+
+    def page_fingerprint(self, response):
+        body = response.body
+        # parts of the page that change on every request (e.g. form tokens)
+        for pattern in self.fingerprint_ignore:
+            body = pattern.sub(b"", body)
+        return hashlib.sha1(body).hexdigest()
+
+    def previous_page(self, response, page):
+        # fingerprint of the page, and its CoursePageItem when it is the same
+        # as in the last scrape (its rows are kept instead of parsed again)
+        course_id = response.meta["course_id"]
+        fingerprint = self.page_fingerprint(response)
+        previous = self.previous_pages.get((course_id, page))
+        if previous is not None and previous[0] == fingerprint:
+            return fingerprint, CoursePageItem(course_id=course_id, page=page, fingerprint=fingerprint,
+                                               rows=previous[1], changed=False)
+        return fingerprint, None
+
+    def row_position(self, response, n):
+        return self.course_positions.get(response.meta["course_id"], 0) * 100000 + n
+
+    def parse_attendance_items(self, response):
+        fingerprint, page = self.previous_page(response, "attendance")
+        if page is not None:
+            yield page
+            return
+
+        n = 0
+        # class and lab attendance
+        for _id in ["Class", "Lab"]:
+            for topic, status, start_time, end_time in parsers.attendance_rows(response, _id):
+                attended = "present" in status.lower()
+                n += 1
+                yield AttendanceItem(
+                    course_id=response.meta["course_id"],
+                    attendance_type=_id.lower(),
+                    topic=topic,
+                    attended=attended,
+                    start_time=start_time,
+                    end_time=end_time,
+                    position=self.row_position(response, n),
+                )
+        yield CoursePageItem(course_id=response.meta["course_id"], page="attendance",
+                             fingerprint=fingerprint, rows=n, changed=True)
+
+    def parse_marks(self, response):
+        if not self.is_course_context(response):
+            yield from self.retry_course(response)
+            return
+
+        marks_items = []
+        fingerprint, page = self.previous_page(response, "marks")
+        if page is None:
+            n = 0
+            for n, (section_title, title, marks, total_marks, datetime) in enumerate(
+                    parsers.marks_rows(response), start=1):
+                item = CourseScoreItem(
+                    course_id=response.meta["course_id"],
+                    course_name=response.meta["course_name"],
+                    credit_hours=response.meta["credit_hours"],
+                    teacher=response.meta["teacher"],
+                    section_title=section_title,
+                    title=title,
+                    marks=marks,
+                    total_marks=total_marks,
+                    datetime=datetime,
+                    position=self.row_position(response, n),
+                )
+                if self.parallel:
+                    marks_items.append(item)
+                else:
+                    yield item
+            page = CoursePageItem(course_id=response.meta["course_id"], page="marks",
+                                  fingerprint=fingerprint, rows=n, changed=True)
+        if self.parallel:
+            marks_items.append(page)
+        else:
+            yield page
+
+        # attendance request
+        yield scrapy.Request(
+            url=self.portal_url + "/Attendance/Index",
+            callback=self.parse_attendance,
+            meta=dict(response.meta, marks_items=marks_items),
+            dont_filter=True,
+        )
@@ -0,0 +1,202 @@
+from task import Task
+import json_encoding
+
+import collections
+
+
+COLUMNS = ["section_title", "title", "marks", "total_marks", "datetime"]
+COURSE_INFO_COLUMNS = ["course_id", "course_name", "credit_hours", "teacher"]
+COLUMNS_TITLES = {
+    "course_id": "Course ID",
+    "course_name": "Course Name",
+    "credit_hours": "Credit Hours",
+    "teacher": "Teacher",
+    "section_title": "Section",
+    "title": "Title",
+    "marks": "Marks",
+    "total_marks": "Total Marks",
+    "datetime": "Date"
+}
+
+
+def sum_marks(values):
+    # numpy's pairwise summation (8 partial sums per block of up to 128
+    # values), so totals keep the exact floats the pandas version returned
+    n = len(values)
+    if n < 8:
+        total = 0.0
+        for value in values:
+            total += value
+        return total
+    if n <= 128:
+        r = list(values[:8])
+        i = 8
+        while i < n - n % 8:
+            for j in range(8):
+                r[j] += values[i + j]
+            i += 8
+        total = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        for value in values[i:]:
+            total += value
+        return total
+    half = n // 2
+    half -= half % 8
+    return sum_marks(values[:half]) + sum_marks(values[half:])
+
+
+def percentage(marks, total_marks):
+    if not total_marks:
+        return float("nan") if not marks else float("inf") * marks
+    # rounds like numpy (x * 100, round half to even, / 100) so the numbers
+    # stay the same as when this was computed with pandas
+    return round(marks / total_marks * 100 * 100) / 100
+
+
+def prepare_response(task):
+    profile_data = task.student_profile.to_dict()
+    score_data = [i.to_dict() for i in task.course_score]
+    # sorting by class time
+    attendance_data = [i.to_dict() for i in sorted(task.attendance, key=lambda x: x.start_time)]
+    return build_response(profile_data, score_data, attendance_data, course_totals(task))
+
+
+def course_totals(task):
+    # {course_id: {section_title: (marks, total_marks)}} as summed up when the
+    # marks were stored, the course's own total is under None
+    totals = collections.defaultdict(dict)
+    for total in task.course_totals:
+        totals[total.course_id][total.section_title] = (total.marks, total.total_marks)
+    return totals
+
+
+def number(value):
+    # non numeric marks ("-", "Absent") count as 0
+    return value if value.__class__ is float else 0.0
+
+
+def section_total(rows):
+    return sum_marks([number(row["marks"]) for row in rows]), sum_marks([number(row["total_marks"]) for row in rows])
+
+
+def prepare_response_body(task):
+    # the complete /taskdata body of a finished task
+    return response_body(prepare_response(task))
+
+
+def task_response_body(task_data):
+    # the same from the rows of DataBase.get_task_data
+    return response_body(build_response(*task_data))
+
+
+def response_body(data):
+    # body of a successful task's response, serialized like jsonify does it
+    return json_encoding.dumps({
+        "status": Task.SUCCESS,
+        "data": data,
+        "message": "Task completed successfully",
+        "taskCompleted": True
+    }) + b"\n"
+
+
+def compact_response(data):
+    # optional shape of a response: course_id, course_name, credit_hours and
+    # teacher are the same on every row of a course, they are given once in
+    # the course's courseInfo instead
+    courses_data = {}
+    for course_id, course in data["coursesData"].items():
+        info = None
+        course_score = {}
+        for section_title, section in course["courseScore"].items():
+            rows = []
+            for row in section["data"]:
+                if info is None:
+                    info = {column: row[column] for column in COURSE_INFO_COLUMNS}
+                rows.append({k: v for k, v in row.items() if k not in COURSE_INFO_COLUMNS})
+            course_score[section_title] = dict(section, data=rows)
+        attendance_data = [
+            dict(attendance_type, attendance=[
+                {k: v for k, v in row.items() if k != "course_id"} for row in attendance_type["attendance"]
+            ])
+            for attendance_type in course["attendance"]["attendanceData"]
+        ]
+        courses_data[course_id] = dict(
+            course,
+            courseInfo=info or {"course_id": course_id},
+            courseScore=course_score,
+            attendance=dict(course["attendance"], attendanceData=attendance_data),
+        )
+    return dict(data, coursesData=courses_data, shape="compact")
+
+
+def build_response(profile_data, score_data, attendance_data, totals=None):
+    # one pass over each list, grouping rows by course, section and attendance
+    # type, marks are summed up here only for courses without stored totals
+    totals = totals or {}
+    courses = {}
+    for row in score_data:
+        course = courses.get(row["course_id"])
+        if course is None:
+            course = courses[row["course_id"]] = {"rows": [], "sections": {}}
+        course["rows"].append(row)
+        section = course["sections"].get(row["section_title"])
+        if section is None:
+            section = course["sections"][row["section_title"]] = []
+        section.append(row)
+
+    attendance = collections.defaultdict(lambda: collections.defaultdict(list))
+    for row in attendance_data:
+        attendance[row["course_id"]][row["attendance_type"]].append(row)
+
+    response = {
+        "profileData": profile_data,
+        "courseIds": list(courses),
+        "columns": COLUMNS,
+        "courseInfoColumns": COURSE_INFO_COLUMNS,
+        "columnsTitles": COLUMNS_TITLES,
+        "coursesData": {}
+    }
+
+    for course_id in sorted(courses):
+        course = courses[course_id]
+        attendance_obj = {"attendanceData": []}
+        overview = {"total": 0, "present": 0, "absent": 0}
+        for attendance_type in sorted(attendance[course_id]):
+            rows = attendance[course_id][attendance_type]
+            present = sum(1 for row in rows if row["attended"] is True)
+            absent = sum(1 for row in rows if row["attended"] is False)
+            attendance_obj["attendanceData"].append({
+                "attendanceType": attendance_type,
+                "attendance": rows,
+                "total": len(rows),
+                "present": present,
+                "absent": absent,
+            })
+            overview["total"] += len(rows)
+            overview["present"] += present
+            overview["absent"] += absent
+        attendance_obj["overview"] = overview
+
+        stored = totals.get(course_id, {})
+        course_score = {}
+        for section_title in sorted(course["sections"]):
+            rows = course["sections"][section_title]
+            marks, total_marks = stored.get(section_title) or section_total(rows)
+            course_score[section_title] = {
+                "totalMarks": total_marks,
+                "marks": marks,
+                "percentage": percentage(marks, total_marks),
+                "data": rows
+            }
+
+        marks, total_marks = stored.get(None) or section_total(course["rows"])
+        response["coursesData"][course_id] = {
+            "courseScore": course_score,
+            "attendance": attendance_obj,
+            "overview": {
+                "totalMarks": total_marks,
+                "marks": marks,
+                "percentage": percentage(marks, total_marks)
+            },
+        }
+
+    return response
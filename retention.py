@@ -0,0 +1,140 @@
+from sqlalchemy import select, delete, update, and_, or_
+
+from datetime import datetime, timedelta
+import threading
+import logging
+import time
+import os
+
+from database import Base, Task as TaskModel
+from task import Task
+
+
+logger = logging.getLogger(__name__)
+
+# seconds a task is kept after its last update, per status
+TASK_TTL = {
+    Task.SUCCESS: int(os.environ.get("TASK_TTL_SUCCESS", 7 * 24 * 3600)),
+    Task.FAILED: int(os.environ.get("TASK_TTL_FAILED", 24 * 3600)),
+}
+# statuses without their own ttl (e.g. crawls that died while IN PROGRESS)
+DEFAULT_TASK_TTL = int(os.environ.get("TASK_TTL_DEFAULT", 24 * 3600))
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", 15 * 60))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 500))
+# pages given back to the file system after a sweep (incremental auto_vacuum only)
+RETENTION_VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", 2000))
+
+
+class RetentionSweeper:
+    def __init__(self, db, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH_SIZE,
+                 ttl=None, default_ttl=DEFAULT_TASK_TTL, vacuum_pages=RETENTION_VACUUM_PAGES,
+                 task_events=None):
+        self.db = db
+        # status cache (events.TaskEvents) deleted tasks are dropped from
+        self.task_events = task_events
+        self.interval = interval
+        self.batch_size = batch_size
+        self.ttl = TASK_TTL if ttl is None else ttl
+        self.default_ttl = default_ttl
+        self.vacuum_pages = vacuum_pages
+        self.stats = {
+            "sweeps": 0,
+            "tasksDeleted": 0,
+            "rowsDeleted": 0,
+            "pagesVacuumed": 0,
+            "lastSweepSeconds": None,
+            "lastSweepAt": None,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+        # every table holding rows of a task, so tables added later are swept too
+        self.child_tables = [
+            table for table in Base.metadata.sorted_tables
+            if table.name != TaskModel.__tablename__ and "task_id" in table.columns
+        ]
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Retention sweep failed")
+
+    def expired_condition(self, now):
+        conditions = [
+            and_(TaskModel.status == status, TaskModel.updated_at < now - timedelta(seconds=ttl))
+            for status, ttl in self.ttl.items()
+        ]
+        conditions.append(and_(
+            TaskModel.status.notin_(list(self.ttl)),
+            TaskModel.updated_at < now - timedelta(seconds=self.default_ttl),
+        ))
+        return or_(*conditions)
+
+    def sweep(self, now=None):
+        started = time.monotonic()
+        now = now or datetime.utcnow()
+        session = self.db.session
+        tasks_deleted = rows_deleted = 0
+        try:
+            # tasks from before updated_at existed start their ttl now
+            session.execute(update(TaskModel).where(TaskModel.updated_at.is_(None)).values(updated_at=now))
+            session.commit()
+
+            # one transaction per batch, so scrapers writing at the same
+            # time only wait for a batch and not for the whole sweep
+            while True:
+                task_ids = session.scalars(
+                    select(TaskModel.task_id).where(self.expired_condition(now)).limit(self.batch_size)
+                ).all()
+                if not task_ids:
+                    break
+                for table in self.child_tables:
+                    rows_deleted += session.execute(delete(table).where(table.c.task_id.in_(task_ids))).rowcount
+                tasks_deleted += session.execute(delete(TaskModel).where(TaskModel.task_id.in_(task_ids))).rowcount
+                session.commit()
+                if self.task_events is not None:
+                    self.task_events.forget(task_ids)
+            pages = self.vacuum() if tasks_deleted else 0
+        finally:
+            self.db.remove()
+
+        elapsed = time.monotonic() - started
+        self.stats["sweeps"] += 1
+        self.stats["tasksDeleted"] += tasks_deleted
+        self.stats["rowsDeleted"] += rows_deleted + tasks_deleted
+        self.stats["pagesVacuumed"] += pages
+        self.stats["lastSweepSeconds"] = round(elapsed, 3)
+        self.stats["lastSweepAt"] = now.isoformat()
+        logger.info("Retention sweep deleted %d tasks (%d rows) in %.2fs",
+                    tasks_deleted, rows_deleted + tasks_deleted, elapsed)
+        return tasks_deleted
+
+    def vacuum(self):
+        engine = self.db.session.get_bind()
+        if engine.dialect.name != "sqlite":
+            return 0
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            # 2 = incremental, databases created before it was enabled reuse
+            # the free pages instead
+            if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+            free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            # executescript steps the pragma until it is done, a plain execute
+            # gives back a single page
+            cursor.executescript("PRAGMA incremental_vacuum(%d)" % self.vacuum_pages)
+            # in WAL mode the file only shrinks once the log is checkpointed
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return free_pages - cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        finally:
+            connection.close()
@@ -1,19 +1,193 @@
-from scrapy.crawler import CrawlerProcess
-from scrapy.utils.project import get_project_settings
-from portal.spiders.comsats_edu_pk import ComsatsEduPkSpider
-
-from multiprocessing import Pool
-
-
-def start_scraper(session_id):
-    # Create a CrawlerProcess instance
-    process = CrawlerProcess(settings={
-        **get_project_settings(),
-        "SESSION_ID": session_id,
-        # "LOG_FILE": "Logs/{}.log".format(session_id),
-    })
-    process.crawl(ComsatsEduPkSpider)
-    process.start()
-
-
-# start_scraper("n0x0sfkmilu1xpibjdo4v4mb")
+from scrapy import signals
+from scrapy.crawler import Crawler, CrawlerProcess, CrawlerRunner
+from scrapy.utils.log import configure_logging
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.reactor import install_reactor
+from portal.spiders.comsats_edu_pk import ComsatsEduPkSpider
+
+from dispatch import HEARTBEAT_SECONDS
+from database import DataBase
+from task import Task
+import metrics
+import events
+
+import threading
+import logging
+import socket
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# number of crawls a single CrawlerService runs at the same time
+CONCURRENT_CRAWLS = int(os.environ.get("CONCURRENT_CRAWLS", 8))
+
+
+def start_scraper(session_id):
+    # Create a CrawlerProcess instance
+    process = CrawlerProcess(settings={
+        **get_project_settings(),
+        "SESSION_ID": session_id,
+        # "LOG_FILE": "Logs/{}.log".format(session_id),
+    })
+    process.crawl(ComsatsEduPkSpider)
+    process.start()
+
+
+class CrawlerService:
+    """
+    Long running crawler that leases session ids from a dispatcher (see
+    dispatch.py) and runs their crawls on a single reactor, so scrapy's
+    startup cost is paid once per process instead of once per task. Leases
+    of running crawls are renewed until they finish. Setting the stop event
+    stops the service once its crawls are done.
+    """
+
+    def __init__(self, dispatcher, max_crawls=CONCURRENT_CRAWLS, settings=None, stats=None,
+                 worker_id=None, stop=None, spawned_at=None):
+        self.dispatcher = dispatcher
+        self.max_crawls = max_crawls
+        self.settings = settings or get_project_settings()
+        # optional dict of shared multiprocessing Values (see ScrapePool)
+        self.stats = stats
+        self.worker_id = worker_id or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.stop = stop or threading.Event()
+        self.slots = threading.BoundedSemaphore(max_crawls)
+        self.leases = set()
+        self.leases_lock = threading.Lock()
+        # when the process was started (time.time()), and when each running
+        # crawl's task was leased
+        self.spawned_at = spawned_at or time.time()
+        self.leased_at = {}
+
+    def serve(self, install_signal_handlers=True):
+        install_reactor(self.settings["TWISTED_REACTOR"])
+        configure_logging(self.settings)
+        from twisted.internet import reactor
+
+        self.reactor = reactor
+        self.runner = CrawlerRunner(self.settings)
+        reactor.callWhenRunning(metrics.record_span, "worker_start", None, self.spawned_at)
+        metrics.start_writer()
+        threading.Thread(target=self._consume, daemon=True).start()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        reactor.run(installSignalHandlers=install_signal_handlers)
+
+    def _consume(self):
+        last_requeue = 0
+        while True:
+            # taking a new session only when a crawl slot is free, so tasks
+            # that don't fit keep waiting in the queue for any worker
+            self.slots.acquire()
+            session_id = None
+            while session_id is None and not self.stop.is_set():
+                # a failing dispatcher (e.g. a locked database) is tried
+                # again, this thread ending would stop the worker for good
+                try:
+                    if time.monotonic() - last_requeue > HEARTBEAT_SECONDS:
+                        last_requeue = time.monotonic()
+                        self._requeue_expired()
+                    session_id = self.dispatcher.lease(self.worker_id, timeout=1)
+                except Exception:
+                    logger.exception("Could not lease a task")
+                    time.sleep(1)
+            if session_id is None:
+                self.reactor.callFromThread(self._stop)
+                return
+            with self.leases_lock:
+                self.leases.add(session_id)
+                self.leased_at[session_id] = time.time()
+            self.reactor.callFromThread(self._crawl, session_id)
+
+    def _heartbeat(self):
+        while not self.stop.wait(HEARTBEAT_SECONDS):
+            with self.leases_lock:
+                leases = list(self.leases)
+            try:
+                self.dispatcher.heartbeat(self.worker_id, leases)
+            except Exception:
+                logger.exception("Could not renew leases")
+
+    def _requeue_expired(self):
+        # tasks of workers that died are queued again, or failed when they
+        # were leased too often already
+        requeued, dropped = self.dispatcher.requeue_expired()
+        metrics.FAILURES.labels("lease_expired").inc(requeued + len(dropped))
+        if dropped:
+            db = DataBase()
+            try:
+                for session_id in dropped:
+                    # the retention sweep may have deleted it meanwhile
+                    if db.get_task(session_id) is None:
+                        continue
+                    db.update_task_status(session_id, Task.FAILED, "Scraping failed, please try again later")
+                    events.publish(session_id, Task.FAILED, "Scraping failed, please try again later")
+            finally:
+                db.remove()
+
+    def _crawl(self, session_id):
+        settings = self.settings.copy()
+        settings.set("SESSION_ID", session_id)
+        crawler = Crawler(ComsatsEduPkSpider, settings)
+        # from the lease to the spider's start: creating the crawler, its
+        # middlewares and pipelines
+        crawler.signals.connect(self._crawl_started, signal=signals.spider_opened)
+
+        started = time.monotonic()
+        self._update("active", 1)
+        d = self.runner.crawl(crawler)
+        d.addCallbacks(
+            lambda _: self._finished(session_id, started),
+            lambda failure: self._finished(session_id, started, failure),
+        )
+        return d
+
+    def _crawl_started(self, spider):
+        session_id = spider.settings.get("SESSION_ID")
+        metrics.record_span("crawl_start", session_id, self.leased_at.get(session_id, time.time()))
+
+    def _finished(self, session_id, started, failure=None):
+        with self.leases_lock:
+            self.leases.discard(session_id)
+            leased_at = self.leased_at.pop(session_id, None)
+        if leased_at is not None:
+            metrics.record_span("task", session_id, leased_at, error=failure is not None)
+        if failure is not None:
+            metrics.FAILURES.labels("crawl").inc()
+        self.dispatcher.complete(self.worker_id, session_id)
+        self._update("active", -1)
+        self._update("failed" if failure else "completed", 1)
+        if self.stats is not None:
+            avg = self.stats["avg_duration"]
+            with avg.get_lock():
+                avg.value = 0.8 * avg.value + 0.2 * (time.monotonic() - started)
+        self.slots.release()
+
+    def _update(self, name, value):
+        if self.stats is not None:
+            counter = self.stats[name]
+            with counter.get_lock():
+                counter.value += value
+
+    def _stop(self):
+        d = self.runner.join()
+        # a forked worker ends without running atexit handlers
+        d.addBoth(lambda _: metrics.retire_snapshot())
+        d.addBoth(lambda _: self.reactor.stop())
+
+
+def serve(dispatcher, max_crawls=CONCURRENT_CRAWLS, stats=None, settings=None, events_queue=None, stop=None,
+          spawned_at=None):
+    # status changes of the pipelines go to every API process through the
+    # dispatcher, and straight back to the one that started this worker
+    def sink(event):
+        if events_queue is not None:
+            events_queue.put(event)
+        dispatcher.publish(event)
+
+    events.set_sink(sink)
+    CrawlerService(dispatcher, max_crawls, settings=settings, stats=stats, stop=stop, spawned_at=spawned_at).serve()
+
+
+# start_scraper("n0x0sfkmilu1xpibjdo4v4mb")
@@ -0,0 +1,117 @@
+import multiprocessing
+import threading
+import time
+import os
+
+from run import serve, CONCURRENT_CRAWLS
+from dispatch import get_dispatcher
+
+
+# worker processes started with the API, 0 when all scraping is done by
+# worker.py on other nodes
+SCRAPE_WORKERS = int(os.environ.get("SCRAPE_WORKERS", 2))
+# number of tasks allowed to wait for a free crawl slot
+SCRAPE_QUEUE_SIZE = int(os.environ.get("SCRAPE_QUEUE_SIZE", 20))
+
+
+# workers are spawned, not forked: threads of the API process (task events,
+# retention) use the database, a forked worker could inherit its locks held
+context = multiprocessing.get_context("spawn")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ScrapePool:
+    def __init__(self, workers=SCRAPE_WORKERS, queue_size=SCRAPE_QUEUE_SIZE,
+                 crawls_per_worker=CONCURRENT_CRAWLS, events=None, dispatcher=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.crawls_per_worker = crawls_per_worker
+        # shared with the worker processes
+        self.stats_values = {
+            "active": context.Value("i", 0),
+            "completed": context.Value("i", 0),
+            "failed": context.Value("i", 0),
+            # moving average of a scrape's duration, used for the retry hint
+            "avg_duration": context.Value("d", 10.0),
+        }
+        # queue of task status changes (see events.TaskEvents.listen)
+        self.events = events
+        # where submitted tasks wait for a worker, of this pool or any other
+        self.dispatcher = dispatcher or get_dispatcher()
+        self.stop = None
+        self.processes = []
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return self.workers * self.crawls_per_worker
+
+    def start(self):
+        with self._lock:
+            if self.stop is not None:
+                return
+            self.stop = context.Event()
+            # each worker is a long lived process running a CrawlerService
+            for _ in range(self.workers):
+                process = context.Process(
+                    target=serve,
+                    args=(self.dispatcher, self.crawls_per_worker, self.stats_values, None, self.events,
+                          self.stop),
+                    kwargs={"spawned_at": time.time()},
+                    daemon=True,
+                )
+                process.start()
+                self.processes.append(process)
+
+    def is_full(self):
+        return self.dispatcher.depth() >= self.queue_size
+
+    def submit(self, session_id):
+        self.start()
+        if self.is_full():
+            raise QueueFull()
+        self.dispatcher.submit(session_id)
+
+    def retry_after(self):
+        # seconds until roughly one crawl slot frees up
+        avg_duration = self.stats_values["avg_duration"].value
+        return max(1, round(avg_duration / max(self.capacity, 1)))
+
+    def wait_estimate(self, session_id):
+        # (tasks ahead in the queue, seconds until its crawl starts) of a
+        # queued task, None when it isn't queued
+        position = self.dispatcher.position(session_id)
+        if position is None:
+            return None
+        # the slots free now take the first tasks, then one slot frees up
+        # every avg_duration / capacity seconds
+        free = self.capacity - self.stats_values["active"].value
+        avg_duration = self.stats_values["avg_duration"].value
+        return position, round(max(0, position + 1 - free) * avg_duration / max(self.capacity, 1), 1)
+
+    def stats(self):
+        active = self.stats_values["active"].value
+        return {
+            "workers": self.workers,
+            "crawlSlots": self.capacity,
+            "activeCrawls": active,
+            "queueDepth": self.dispatcher.depth(),
+            "dispatch": self.dispatcher.name,
+            "queueSize": self.queue_size,
+            "utilisation": round(active / self.capacity, 2) if self.capacity else 0,
+            "completed": self.stats_values["completed"].value,
+            "failed": self.stats_values["failed"].value,
+            "avgTaskSeconds": round(self.stats_values["avg_duration"].value, 2),
+        }
+
+    def close(self):
+        if self.stop is None:
+            return
+        self.stop.set()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.stop = None
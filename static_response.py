@@ -0,0 +1,86 @@
+from flask import request, current_app
+
+import hashlib
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# responses smaller than this are sent as they are
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+COMPRESS_MIMETYPES = ["application/json", "text/html", "text/plain"]
+
+
+def encodings():
+    # content codings this server can produce, in order of preference
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(body, encoding, level=COMPRESS_LEVEL):
+    # brotli's quality goes up to 11, gzip's level up to 9
+    if encoding == "br":
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, min(level, 9))
+
+
+def compress_response(response):
+    # after_request hook: compresses a response when it's big enough and the
+    # client accepts one of encodings(), streamed and already encoded
+    # responses (event streams, stored gzipped task data) are left alone
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(encodings())
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag("%s-%s" % (etag, encoding), weak)
+    return response
+
+
+class StaticResponse:
+    """
+    Response for a payload that never changes while the app runs (e.g. /demo):
+    serialized and compressed once, then served with an ETag, Cache-Control and
+    304s for conditional requests. Brotli is used when the brotli package is
+    installed.
+    """
+
+    def __init__(self, body, mimetype="application/json", max_age=3600):
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.etag = hashlib.sha1(body).hexdigest()
+        # content coding -> body, in order of preference
+        self.variants = {encoding: compress(body, encoding, level=11) for encoding in encodings()}
+        self.variants["identity"] = body
+
+    def encoding(self):
+        encoding = request.accept_encodings.best_match(list(self.variants), default="identity")
+        return encoding if encoding in self.variants else "identity"
+
+    def response(self):
+        encoding = self.encoding()
+        etag = self.etag + ("-" + encoding if encoding != "identity" else "")
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(self.variants[encoding], mimetype=self.mimetype)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        return response
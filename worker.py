@@ -0,0 +1,45 @@
+from scrapy.utils.project import get_project_settings
+
+from run import CrawlerService, CONCURRENT_CRAWLS
+from dispatch import get_dispatcher, DISPATCH_BACKEND
+import metrics
+import events
+
+import argparse
+import threading
+import signal
+
+
+# Scrape worker running on its own, e.g. on another node than the API: takes
+# tasks from the dispatch backend (DISPATCH_BACKEND, the database or redis the
+# API uses too) and publishes their status changes back through it.
+#
+#     DISPATCH_BACKEND=redis REDIS_URL=redis://queue:6379/0 python worker.py --crawls 8
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a scrape worker")
+    parser.add_argument("--crawls", type=int, default=CONCURRENT_CRAWLS, help="crawls run at the same time")
+    parser.add_argument("--backend", default=DISPATCH_BACKEND, help="dispatch backend, db or redis")
+    parser.add_argument("--worker-id", help="name of the worker in leases, host-pid by default")
+    parser.add_argument("--metrics-port", type=int, help="serve this worker's /metrics on the port")
+    args = parser.parse_args()
+
+    if args.metrics_port and metrics.METRICS_ENABLED:
+        metrics.serve(args.metrics_port)
+
+    dispatcher = get_dispatcher(args.backend)
+    events.set_sink(dispatcher.publish)
+
+    # SIGTERM / ctrl-c: no new tasks are leased, running crawls finish
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    service = CrawlerService(dispatcher, args.crawls, settings=get_project_settings(),
+                             worker_id=args.worker_id, stop=stop)
+    service.serve(install_signal_handlers=False)
+
+
+if __name__ == "__main__":
+    main()
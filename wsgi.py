@@ -0,0 +1,4 @@
+# entry point of the API: FLASK_APP=wsgi.py, or wsgi:app for a WSGI server
+from app import app, start
+
+start()